@@ -1,44 +1,247 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import asyncio
+import json
+import time
 
-from services import doc_parser
-from services.logic import answer_query
+from services.document_index import DocumentIndex
+from services.ingest_jobs import ingest_queue
+from services.logic import answer_query, answer_queries_batched
+from services.answer_cache import answer_cache
+from services.llm_service import LLMError
+from core.config import LLM_BATCH_QUESTIONS, MAX_CONCURRENT_REQUESTS, SLOW_REQUEST_LOG_MS
+from core.executors import PoolSaturatedError, pool_stats
+from core.metrics import Trace, question, register_stats, span, start_trace
 
 router = APIRouter()
 
+FAILED_ANSWER = "Error: Failed to retrieve answer."
+
+# Answering requests currently admitted (see _admit)
+_in_flight = {"requests": 0, "rejected": 0}
+
+
+def _admit():
+    """
+    Admits one answering request or raises 429 when MAX_CONCURRENT_REQUESTS
+    are already in flight. The caller must call _release() when done.
+    """
+    if MAX_CONCURRENT_REQUESTS and _in_flight["requests"] >= MAX_CONCURRENT_REQUESTS:
+        _in_flight["rejected"] += 1
+        raise HTTPException(status_code=429, detail="Too many requests in flight; retry shortly.",
+                            headers={"Retry-After": "1"})
+    _in_flight["requests"] += 1
+
+
+def _release():
+    _in_flight["requests"] -= 1
+
+
+register_stats("requests", lambda: {"in_flight": _in_flight["requests"], "rejected": _in_flight["rejected"]},
+               counters=("rejected",))
+
+
+def _log_if_slow(trace: Trace, request: "QueryRequest | AskRequest"):
+    total_ms = trace.total_ms()
+    if SLOW_REQUEST_LOG_MS and total_ms >= SLOW_REQUEST_LOG_MS:
+        stages = ", ".join(f"{stage} {v['ms']:.0f}ms" for stage, v in trace.breakdown()["stages"].items())
+        print(f"Slow request ({total_ms:.0f}ms, {len(request.questions)} questions): {stages}")
+
 class QueryRequest(BaseModel):
     documents: str
     questions: List[str]
+    # Pack several questions into one LLM call (see answer_queries_batched);
+    # None uses the LLM_BATCH_QUESTIONS default
+    batch_questions: Optional[bool] = None
+    # Add a per-stage and per-question timing breakdown to the response
+    include_timings: bool = False
 
 class QueryResponse(BaseModel):
     answers: List[str]
+    timings: Optional[dict] = None
+
+class DocumentRequest(BaseModel):
+    # URL of a PDF, or raw text, as in QueryRequest
+    documents: str
+
+class AskRequest(BaseModel):
+    questions: List[str]
+    batch_questions: Optional[bool] = None
+    include_timings: bool = False
 
 # ✅ POST /api/v1/hackrx/run
-@router.post("/hackrx/run", response_model=QueryResponse)
+@router.post("/hackrx/run", response_model=QueryResponse, response_model_exclude_none=True)
 async def run_hackrx(request: QueryRequest):
-    # Step 1: Download and parse
-    doc_text, _ = await doc_parser.process_document(request.documents)
-    if not doc_text.strip():
-        raise HTTPException(status_code=400, detail="Document text is empty.")
+    _admit()
+    trace = start_trace()
+    try:
+        response = await _run_hackrx(request)
+    finally:
+        _release()
+        _log_if_slow(trace, request)
+    if request.include_timings:
+        response.timings = trace.breakdown()
+    return response
 
-    # Step 2: Split into clauses
-    clauses = doc_parser.split_into_clauses(doc_text)
-    if not clauses:
-        raise HTTPException(status_code=400, detail="No clauses found in document.")
 
-    # Step 3: Answer each question concurrently
+async def _answer_traced(i: int, query: str, index):
+    with question(i), span("question"):
+        return await answer_query(query, index)
+
+
+async def _ingest(documents: str) -> DocumentIndex:
+    """
+    Download, parse, split, chunk, embed and index the document once for all
+    questions, as a job on the ingest queue (shared with concurrent requests
+    and POST /documents for the same document). Bad documents raise 400.
+    """
+    job = ingest_queue.submit(documents)
     try:
+        with span("ingest_job"):
+            return await job.wait()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def _run_hackrx(request: QueryRequest) -> QueryResponse:
+    # Step 1: Ingest the document (pages stream through the pipeline as extracted)
+    index = await _ingest(request.documents)
+
+    # Step 2: Answer each question against the shared index
+    return await _answer_all(request, index)
+
+
+async def _answer_all(request: "QueryRequest | AskRequest", index: DocumentIndex) -> QueryResponse:
+    # Questions are answered concurrently; a failing question only fails its
+    # own answer
+    batch = LLM_BATCH_QUESTIONS if request.batch_questions is None else request.batch_questions
+    if batch:
+        results = await answer_queries_batched(request.questions, index)
+    else:
         results = await asyncio.gather(*[
-            answer_query(q, clauses, request.documents) for q in request.questions
-        ])
-        answers = [r.answer.strip() for r in results]
-    except Exception:
-        answers = ["Error: Failed to retrieve answer."] * len(request.questions)
+            _answer_traced(i, q, index) for i, q in enumerate(request.questions)
+        ], return_exceptions=True)
+    # Every question was turned away by a full pool: report the overload
+    # (503) rather than a page of failed answers
+    if results and all(isinstance(r, PoolSaturatedError) for r in results):
+        raise results[0]
+    answers = [
+        FAILED_ANSWER if isinstance(r, BaseException) else r.answer.strip()
+        for r in results
+    ]
 
     return QueryResponse(answers=answers)
 
+
+def _error_detail(e: BaseException) -> dict:
+    if isinstance(e, LLMError):
+        return e.to_dict()
+    if isinstance(e, PoolSaturatedError):
+        return {"kind": "overloaded", "message": str(e), "retryable": True}
+    return {"kind": "internal", "message": str(e) or type(e).__name__, "retryable": False}
+
+
+# ✅ POST /api/v1/hackrx/run/stream
+# Same request body as /hackrx/run, but each answer is sent as soon as it is
+# ready instead of after the slowest question. format=ndjson (default) sends
+# one JSON object per line; format=sse sends Server-Sent Events. Questions
+# are always answered individually here (batch_questions is ignored).
+@router.post("/hackrx/run/stream")
+async def run_hackrx_stream(request: QueryRequest, format: str = "ndjson"):
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'sse'.")
+
+    # Ingest up front so document errors still come back as a 400
+    _admit()
+    trace = start_trace()
+    try:
+        index = await _ingest(request.documents)
+    except BaseException:
+        _release()
+        raise
+
+    async def answer_one(i: int, question: str) -> dict:
+        try:
+            result = await _answer_traced(i, question, index)
+            return {"index": i, "question": question, **jsonable_encoder(result), "error": None}
+        except Exception as e:
+            return {"index": i, "question": question, "answer": FAILED_ANSWER, "clauses": [],
+                    "explanation": "", "error": _error_detail(e)}
+
+    def encode(event: str, payload: dict) -> str:
+        if format == "sse":
+            return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        return json.dumps(payload) + "\n"
+
+    async def events():
+        started = time.monotonic()
+        tasks = [asyncio.ensure_future(answer_one(i, q)) for i, q in enumerate(request.questions)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield encode("answer", await next_done)
+            done = {"done": True, "count": len(tasks), "elapsed_ms": round((time.monotonic() - started) * 1000, 1)}
+            if request.include_timings:
+                done["timings"] = trace.breakdown()
+            yield encode("done", done)
+        finally:
+            # Client went away: stop answering questions nobody will read
+            for task in tasks:
+                task.cancel()
+            _release()
+            _log_if_slow(trace, request)
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+# ✅ POST /api/v1/documents - queue a document for ingestion and return its
+# id at once; poll GET /documents/{document_id} until status is "ready"
+@router.post("/documents", status_code=202)
+async def submit_document(request: DocumentRequest):
+    return ingest_queue.submit(request.documents).to_dict()
+
+# ✅ GET /api/v1/documents/{document_id} - ingestion status and progress
+@router.get("/documents/{document_id}")
+async def document_status(document_id: str):
+    job = ingest_queue.get(document_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown document id; submit it to POST /api/v1/documents.")
+    return job.to_dict()
+
+# ✅ POST /api/v1/documents/{document_id}/ask - answer questions against an
+# ingested document; 409 while it is still being ingested (or if it failed)
+@router.post("/documents/{document_id}/ask", response_model=QueryResponse, response_model_exclude_none=True)
+async def ask_document(document_id: str, request: AskRequest):
+    job = ingest_queue.get(document_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown document id; submit it to POST /api/v1/documents.")
+    if job.status != "ready":
+        headers = {"Retry-After": "1"} if job.status != "failed" else None
+        raise HTTPException(status_code=409, detail=job.to_dict(), headers=headers)
+
+    _admit()
+    trace = start_trace()
+    try:
+        response = await _answer_all(request, job.index)
+    finally:
+        _release()
+        _log_if_slow(trace, request)
+    if request.include_timings:
+        response.timings = trace.breakdown()
+    return response
+
+# ✅ GET /api/v1/cache/stats - answer cache hit/miss counters for sizing
+@router.get("/cache/stats")
+def cache_stats():
+    return answer_cache.stats()
+
+# ✅ GET /api/v1/pools/stats - per-pool utilization and admission counters
+@router.get("/pools/stats")
+def pools_stats():
+    return {**pool_stats(), "requests": {**_in_flight, "max": MAX_CONCURRENT_REQUESTS}}
+
 # ✅ Optional GET /api/v1/ask for testing
 @router.get("/ask")
 def ask_test():
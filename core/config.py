@@ -0,0 +1,154 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+# Document cache (services/doc_cache.py)
+DOC_CACHE_DIR = os.getenv("DOC_CACHE_DIR", "doc_cache")
+DOC_CACHE_MAX_BYTES = int(os.getenv("DOC_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+DOC_CACHE_MEMORY_ENTRIES = int(os.getenv("DOC_CACHE_MEMORY_ENTRIES", "8"))
+
+# Embeddings (services/embeddings.py)
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "intfloat/e5-small-v2")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+# EMBED_BACKEND is "torch", "onnx" (ONNX Runtime) or "onnx-int8" (dynamically
+# quantized for EMBED_QUANTIZATION, exported once into EMBED_ONNX_DIR);
+# EMBED_THREADS sets intra-op threads (0 = library default)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").lower()
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))
+EMBED_ONNX_DIR = os.getenv("EMBED_ONNX_DIR", "onnx_models")
+EMBED_QUANTIZATION = os.getenv("EMBED_QUANTIZATION", "avx512_vnni")
+
+# Stored vectors (utils/vectors.py): "float32", "float16" or "int8"
+VECTOR_STORAGE_DTYPE = os.getenv("VECTOR_STORAGE_DTYPE", "float16").lower()
+
+# Embedding store (services/embedding_store.py): chunk vectors shared across
+# documents, restarts and worker processes; "" disables it. Once its vectors
+# pass EMBEDDING_STORE_MAX_BYTES (0 means no limit), it is compacted to the
+# most recently added half
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", "embedding_store")
+EMBEDDING_STORE_MAX_BYTES = int(os.getenv("EMBEDDING_STORE_MAX_BYTES", str(1024 ** 3)))
+
+# Index store (services/index_store.py): each document's chunks, vectors and
+# BM25 postings, written once by the worker that ingests it and memory-mapped
+# read-only by every worker; "" (the default, unless main.py starts several
+# workers) keeps indexes in each process's memory. Past INDEX_STORE_MAX_BYTES
+# (0 means no limit), the least recently loaded documents are removed
+INDEX_STORE_DIR = os.getenv("INDEX_STORE_DIR", "")
+INDEX_STORE_MAX_BYTES = int(os.getenv("INDEX_STORE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+# PDF extraction (services/doc_parser.py)
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+
+# Sparse retrieval (services/bm25_retriever.py)
+BM25_CACHE_ENTRIES = int(os.getenv("BM25_CACHE_ENTRIES", "32"))
+
+# Qdrant (services/vector_store.py)
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "256"))
+UPSERT_PARALLELISM = int(os.getenv("UPSERT_PARALLELISM", "4"))
+
+# Vector store backend (services/vector_store.py): "qdrant", "numpy" or "faiss"
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "qdrant").lower()
+QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
+QDRANT_PORT = int(os.getenv("QDRANT_PORT", "6333"))
+LOCAL_VECTOR_DIR = os.getenv("LOCAL_VECTOR_DIR", "")
+LOCAL_VECTOR_MAX_COLLECTIONS = int(os.getenv("LOCAL_VECTOR_MAX_COLLECTIONS", "64"))
+
+# Reranking (services/reranker.py): "cosine" or "cross-encoder"
+RERANKER = os.getenv("RERANKER", "cosine").lower()
+CROSS_ENCODER_MODEL = os.getenv("CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "20"))
+RERANK_TIME_BUDGET_MS = float(os.getenv("RERANK_TIME_BUDGET_MS", "1500"))
+
+# Context packing (services/context_packer.py): of the top CONTEXT_MAX_CHUNKS
+# reranked chunks, near-duplicates (vector cosine >= CONTEXT_DEDUP_SIMILARITY)
+# are dropped and the rest added by relevance up to CONTEXT_TOKEN_BUDGET
+# tokens (0 = no limit); with CONTEXT_SENTENCES, a chunk that does not fit
+# contributes its sentences that best match the question instead
+CONTEXT_MAX_CHUNKS = int(os.getenv("CONTEXT_MAX_CHUNKS", "10"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_DEDUP_SIMILARITY = float(os.getenv("CONTEXT_DEDUP_SIMILARITY", "0.97"))
+CONTEXT_SENTENCES = os.getenv("CONTEXT_SENTENCES", "false").lower() in ("1", "true", "yes")
+
+# Batched answering (services/logic.py answer_queries_batched)
+LLM_BATCH_QUESTIONS = os.getenv("LLM_BATCH_QUESTIONS", "false").lower() in ("1", "true", "yes")
+LLM_BATCH_MAX_PROMPT_TOKENS = int(os.getenv("LLM_BATCH_MAX_PROMPT_TOKENS", "24000"))
+LLM_BATCH_MAX_QUESTIONS = int(os.getenv("LLM_BATCH_MAX_QUESTIONS", "5"))
+
+# Answer cache (services/answer_cache.py): exact matches on the normalized
+# question; ANSWER_CACHE_SIMILARITY > 0 also reuses the answer of the most
+# similar cached question at or above that cosine similarity. Off by default:
+# templated questions ("waiting period for cataract / hernia surgery") can
+# be closer than any safe threshold, and a false hit returns another
+# question's answer. With ANSWER_CACHE_PATH set, the cache is written there
+# ANSWER_CACHE_SAVE_SECONDS after a change (and at shutdown)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(24 * 3600)))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "")
+ANSWER_CACHE_SAVE_SECONDS = float(os.getenv("ANSWER_CACHE_SAVE_SECONDS", "30"))
+
+# LLM client (services/llm_service.py): LLM_BACKEND is "gemini" or "fake"
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_RPM = float(os.getenv("LLM_RPM", "60"))
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "1"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "20"))
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "60"))
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", "30"))
+LLM_FAKE_LATENCY_MS = float(os.getenv("LLM_FAKE_LATENCY_MS", "50"))
+
+# Executors (core/executors.py): pool sizes and pending-call limits before
+# requests are turned away with 503; MAX_CONCURRENT_REQUESTS (0 = no limit)
+# caps answering requests in flight, with 429 beyond it
+IO_WORKERS = int(os.getenv("IO_WORKERS", "16"))
+IO_MAX_PENDING = int(os.getenv("IO_MAX_PENDING", "256"))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_MAX_PENDING = int(os.getenv("INFERENCE_MAX_PENDING", "64"))
+RERANK_MAX_PENDING = int(os.getenv("RERANK_MAX_PENDING", "16"))
+CPU_MAX_PENDING = int(os.getenv("CPU_MAX_PENDING", "64"))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "32"))
+
+# Document downloads (services/http_fetcher.py)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "10"))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "60"))
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(100 * 1024 ** 2)))
+
+# Chunking (services/document_index.py chunk_clauses): "tokens" for fixed
+# token windows, "structure" to prefer paragraph and sentence boundaries
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "tokens").lower()
+
+# Clause segmentation (services/clause_segmenter.py): clauses shorter than
+# CLAUSE_MIN_CHARS are merged with the next one up to CLAUSE_TARGET_CHARS
+CLAUSE_MIN_CHARS = int(os.getenv("CLAUSE_MIN_CHARS", "300"))
+CLAUSE_TARGET_CHARS = int(os.getenv("CLAUSE_TARGET_CHARS", "1500"))
+
+# Tracing (core/metrics.py): requests slower than this print their per-stage
+# timing breakdown (0 = never)
+SLOW_REQUEST_LOG_MS = float(os.getenv("SLOW_REQUEST_LOG_MS", "10000"))
+
+# Ingestion jobs (services/ingest_jobs.py): documents ingested at once by
+# background workers, jobs allowed to wait beyond that (then 503), and
+# finished jobs kept with their index for /documents/{id}/ask. A ready URL
+# job older than INGEST_REVALIDATE_SECONDS is ingested again on its next
+# submission, which revalidates the download (0: on every submission)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "32"))
+INGEST_KEEP_JOBS = int(os.getenv("INGEST_KEEP_JOBS", "32"))
+INGEST_REVALIDATE_SECONDS = float(os.getenv("INGEST_REVALIDATE_SECONDS", "300"))
+
+# Startup (services/warmup.py): load models and clients in the background
+# when the server starts; failed steps are retried every WARMUP_RETRY_SECONDS
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "5"))
+
+# Web server (main.py): WEB_WORKERS > 1 serves from that many uvicorn worker
+# processes, which share documents through the index store
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
@@ -0,0 +1,122 @@
+"""
+Dedicated, bounded executors for blocking work.
+
+Blocking calls never go to the event loop's default pool. Each kind of work
+has its own pool so one cannot starve another:
+  - io:        threads for Qdrant calls and disk writes
+  - inference: a single thread for the embedding model (torch already
+               parallelises inside one call)
+  - rerank:    a single thread for the cross-encoder, so a batch still
+               running after its query gave up never delays embedding
+  - cpu:       processes for PDF text extraction
+
+Each pool admits at most max_pending submitted-but-unfinished calls. Past
+that, run() raises PoolSaturatedError straight away instead of queueing
+without limit; the API turns it into a 503 with Retry-After.
+"""
+import asyncio
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from core.config import (
+    IO_WORKERS, IO_MAX_PENDING, INFERENCE_WORKERS, INFERENCE_MAX_PENDING, PDF_WORKERS, CPU_MAX_PENDING,
+    RERANK_MAX_PENDING,
+)
+from core.metrics import register_stats
+
+
+class PoolSaturatedError(Exception):
+    def __init__(self, pool: str, max_pending: int):
+        super().__init__(f"The {pool} pool is saturated ({max_pending} calls pending); retry shortly.")
+        self.pool = pool
+        self.max_pending = max_pending
+
+
+class BoundedExecutor:
+    """
+    An executor created on first use, with a cap on pending calls and
+    counters for utilization. run() is only called from event loop threads;
+    the lock keeps counters right when several loops share a pool.
+    """
+    def __init__(self, name: str, factory, max_workers: int, max_pending: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._factory = factory
+        self._executor: Executor = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self._factory(self.max_workers)
+        return self._executor
+
+    async def run(self, fn, *args):
+        """
+        Runs fn(*args) on this pool. Raises PoolSaturatedError when
+        max_pending calls are already queued or running.
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PoolSaturatedError(self.name, self.max_pending)
+            self.pending += 1
+        ok = False
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+            ok = True
+            return result
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                if not ok:
+                    self.failed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            running = min(self.pending, self.max_workers)
+            return {
+                "workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "running": running,
+                "queued": self.pending - running,
+                "utilization": running / self.max_workers,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+io_pool = BoundedExecutor(
+    "io", lambda n: ThreadPoolExecutor(n, thread_name_prefix="io"), IO_WORKERS, IO_MAX_PENDING
+)
+inference_pool = BoundedExecutor(
+    "inference", lambda n: ThreadPoolExecutor(n, thread_name_prefix="inference"),
+    INFERENCE_WORKERS, INFERENCE_MAX_PENDING,
+)
+rerank_pool = BoundedExecutor(
+    "rerank", lambda n: ThreadPoolExecutor(n, thread_name_prefix="rerank"), 1, RERANK_MAX_PENDING
+)
+cpu_pool = BoundedExecutor("cpu", ProcessPoolExecutor, PDF_WORKERS, CPU_MAX_PENDING)
+
+POOLS = {pool.name: pool for pool in (io_pool, inference_pool, rerank_pool, cpu_pool)}
+
+
+def pool_stats() -> dict:
+    return {name: pool.stats() for name, pool in POOLS.items()}
+
+
+register_stats("executor", pool_stats, counters=("completed", "failed", "rejected"), label="pool")
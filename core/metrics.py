@@ -0,0 +1,209 @@
+"""
+Per-stage tracing and Prometheus metrics.
+
+span("embed") times a block of pipeline work and observes it in the
+pipeline_stage_seconds histogram. While a request trace is active (see
+start_trace), the span is also recorded there, tagged with the question
+index set by question(). Both live in ContextVars, so they follow the asyncio
+tasks created inside them. Spans nest ("ingest" contains "download",
+"parse", "split", ...), so stage times are not meant to be summed.
+
+Components that already keep counters (pools, caches, the LLM client) expose
+them with register_stats; they are read when /metrics is scraped instead of
+being updated twice on the hot path.
+"""
+import asyncio
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Stage latencies range from sub-millisecond lookups to LLM retries
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds", "Time spent in each stage of the answer pipeline.", ["stage"], buckets=_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency.", ["method", "route", "status"], buckets=_BUCKETS,
+)
+PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens", "Tokens in each LLM prompt, by prompt kind (single or batched questions).", ["kind"],
+    buckets=(250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 12000, 16000, 24000, 32000),
+)
+
+
+class Trace:
+    """
+    Spans recorded during one request: (stage, question index or None,
+    start offset, seconds). Spans of concurrent work overlap, so stage sums
+    can exceed the total.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: list[tuple[str, Optional[int], float, float]] = []
+
+    def add(self, stage: str, question: Optional[int], started: float, seconds: float):
+        self.spans.append((stage, question, started - self.started, seconds))
+
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def breakdown(self) -> dict:
+        """
+        {"total_ms", "stages": {stage: {"ms", "count"}}, "questions":
+        [{stage: ms}, ...]}, where questions holds the spans recorded inside
+        question(i), by i.
+        """
+        stages, questions = {}, {}
+        for stage, question, _, seconds in self.spans:
+            summary = stages.setdefault(stage, {"ms": 0.0, "count": 0})
+            summary["ms"] += seconds * 1000
+            summary["count"] += 1
+            if question is not None:
+                per_question = questions.setdefault(question, {})
+                per_question[stage] = per_question.get(stage, 0.0) + seconds * 1000
+        return {
+            "total_ms": self.total_ms(),
+            "stages": {s: {"ms": round(v["ms"], 1), "count": v["count"]} for s, v in stages.items()},
+            "questions": [
+                {s: round(ms, 1) for s, ms in questions.get(i, {}).items()}
+                for i in range(max(questions, default=-1) + 1)
+            ],
+        }
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_question: ContextVar[Optional[int]] = ContextVar("question", default=None)
+
+
+def start_trace() -> Trace:
+    """
+    Starts recording spans for the current request (and the tasks it creates).
+    """
+    trace = Trace()
+    _trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+
+def attach(trace: Optional[Trace]):
+    """
+    Records the current task's spans (and those of tasks it creates) into
+    trace, e.g. a worker running a job on behalf of a request.
+    """
+    _trace.set(trace)
+    _question.set(None)
+
+
+def detach():
+    """
+    Stops the current task recording into the trace it inherited. For
+    long-lived workers that serve many requests (e.g. the embedding batcher).
+    """
+    attach(None)
+
+
+@contextmanager
+def question(index: int):
+    token = _question.set(index)
+    try:
+        yield
+    finally:
+        _question.reset(token)
+
+
+async def for_question(index: int, awaitable):
+    """
+    Awaits awaitable with its spans tagged as question index.
+    """
+    with question(index):
+        return await awaitable
+
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        trace = _trace.get()
+        if trace is not None:
+            trace.add(stage, _question.get(), started, seconds)
+
+
+def traced(stage: str):
+    """
+    Decorator form of span() for plain and async functions.
+    """
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class _StatsCollector:
+    """
+    Turns registered stats() dicts into metrics at scrape time.
+    """
+    def __init__(self):
+        self._sources = []
+
+    def register(self, prefix: str, fn: Callable[[], dict], counters: Iterable[str], label: Optional[str]):
+        self._sources.append((prefix, fn, set(counters), label))
+
+    def collect(self):
+        for prefix, fn, counters, label in self._sources:
+            stats = fn()
+            rows = stats.items() if label else [(None, stats)]
+            families = {}
+            for label_value, values in rows:
+                for key, value in values.items():
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        continue
+                    name = f"{prefix}_{key}"
+                    family = families.get(name)
+                    if family is None:
+                        kind = CounterMetricFamily if key in counters else GaugeMetricFamily
+                        family = families[name] = kind(name, f"{prefix} {key}", labels=[label] if label else [])
+                    family.add_metric([label_value] if label else [], value)
+            yield from families.values()
+
+
+_stats_collector = _StatsCollector()
+REGISTRY.register(_stats_collector)
+
+
+def register_stats(prefix: str, fn: Callable[[], dict], counters: Iterable[str] = (), label: Optional[str] = None):
+    """
+    Exports fn()'s numeric values as {prefix}_{key} metrics: counters for
+    keys in counters, gauges otherwise. With label, fn returns
+    {label value: stats dict} instead (e.g. one entry per pool).
+    """
+    _stats_collector.register(prefix, fn, counters, label)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """
+    The Prometheus text exposition and its content type.
+    """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
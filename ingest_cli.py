@@ -0,0 +1,71 @@
+"""
+Pre-ingests every PDF in a directory: text, clauses, chunks and vectors go
+into the document cache, the embedding store, the index store and the
+vector store, so later requests for the same documents (by URL or from
+POST /api/v1/documents) skip parsing and embedding. Documents are matched
+by content, so a renamed or re-hosted copy of the same PDF is still a hit.
+
+    python ingest_cli.py documents/ [--workers 4] [--pdf-workers 8]
+
+PDF pages are extracted on one process per core by default, and --workers
+documents are ingested at once, so extraction of one document overlaps with
+embedding of another.
+"""
+import argparse
+import asyncio
+import glob
+import os
+import sys
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory", help="directory of PDFs (searched recursively)")
+    parser.add_argument("--workers", type=int, default=4, help="documents ingested at once")
+    parser.add_argument("--pdf-workers", type=int, default=os.cpu_count() or 1,
+                        help="processes extracting PDF pages (default: one per core)")
+    return parser.parse_args()
+
+
+async def ingest_all(paths: list[str]) -> int:
+    # Imported here: the app reads its configuration at import, after main() sets it
+    from services.ingest_jobs import ingest_queue
+
+    started = time.monotonic()
+    jobs = [(path, ingest_queue.submit(path, is_file=True)) for path in paths]
+    failed = 0
+    for _, job in jobs:
+        try:
+            await job.wait()
+        except Exception:
+            pass
+    for path, job in jobs:
+        info = job.to_dict()
+        if job.status != "ready":
+            failed += 1
+            print(f"FAILED  {path}: {job.error}")
+            continue
+        stats = info["stats"]
+        reused = "cached" if stats.get("cached") else f"{stats.get('embedding_hit_ratio', 0):.0%} from embedding store"
+        print(f"ok      {path}: {stats.get('num_pages') or '-'} pages, {stats['num_chunks']} chunks, "
+              f"{reused}, {info['elapsed_s']:.1f}s")
+    print(f"\n{len(paths) - failed}/{len(paths)} documents ingested in {time.monotonic() - started:.1f}s")
+    return failed
+
+
+def main():
+    args = parse_args()
+    # Must be set before the app reads its configuration
+    os.environ["PDF_WORKERS"] = str(args.pdf_workers)
+    os.environ["INGEST_WORKERS"] = str(args.workers)
+    paths = sorted(glob.glob(os.path.join(args.directory, "**", "*.pdf"), recursive=True))
+    if not paths:
+        sys.exit(f"No PDFs found in {args.directory}")
+    os.environ["INGEST_QUEUE_SIZE"] = str(len(paths))
+    failed = asyncio.run(ingest_all(paths))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,17 @@
 import os
+import sys
+import time
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
 from api.endpoints import router
+from core.config import WEB_WORKERS
+from core.executors import POOLS, PoolSaturatedError
+from core.metrics import REQUEST_SECONDS, render_metrics
+from services.answer_cache import answer_cache
+from services.http_fetcher import document_fetcher
+from services.ingest_jobs import ingest_queue
+from services.warmup import is_ready, readiness, start_warmup, stop_warmup
 
 app = FastAPI(title="Insurance Policy Q&A API")
 
@@ -9,8 +19,72 @@ app = FastAPI(title="Insurance Policy Q&A API")
 def root():
     return {"message": "Server is live 🚀"}
 
+# Prometheus scrape endpoint: stage histograms, request latency, cache hit
+# counters and pool / LLM / batcher queue depths
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+# Latency per route template (not raw path, to keep label cardinality
+# bounded). For streaming responses this is the time to the first byte.
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_SECONDS.labels(request.method, getattr(route, "path", "unmatched"), str(status)).observe(
+            time.perf_counter() - started
+        )
+
+# A full executor queue means we are overloaded: tell the client to back off
+@app.exception_handler(PoolSaturatedError)
+async def pool_saturated_handler(request: Request, exc: PoolSaturatedError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+# Liveness: the process is up and its event loop answers
+@app.get("/health/live")
+async def health_live():
+    return {"status": "alive"}
+
+# Readiness: 503 until the startup warmup has loaded the models and clients
+@app.get("/health/ready")
+async def health_ready():
+    return JSONResponse(status_code=200 if is_ready() else 503, content=readiness())
+
+@app.on_event("startup")
+async def warm_up():
+    start_warmup()
+
+@app.on_event("shutdown")
+async def shutdown_pools():
+    stop_warmup()
+    ingest_queue.stop()
+    answer_cache.flush()
+    await document_fetcher.aclose()
+    for pool in POOLS.values():
+        pool.shutdown()
+
 app.include_router(router, prefix="/api/v1")
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))  # Use Render's assigned port
+    if WEB_WORKERS > 1:
+        # Workers import the app afresh and read their configuration from the
+        # environment: share documents through the index store rather than
+        # each worker's cache, and split the cores between their PDF pools
+        os.environ.setdefault("INDEX_STORE_DIR", "index_store")
+        if not os.environ["INDEX_STORE_DIR"]:
+            print("WEB_WORKERS > 1 without INDEX_STORE_DIR: every worker ingests and holds its own copy of each document")
+        os.environ.setdefault("PDF_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_WORKERS)))
+        os.environ.setdefault("DOC_CACHE_MEMORY_ENTRIES", "0")
+        # The supervisor only starts and restarts workers: replace this process,
+        # which has imported the whole app, with a bare uvicorn
+        os.execv(sys.executable, [sys.executable, "-m", "uvicorn", "main:app", "--host", "0.0.0.0",
+                                  "--port", str(port), "--workers", str(WEB_WORKERS)])
     uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False)
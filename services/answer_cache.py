@@ -0,0 +1,189 @@
+# services/answer_cache.py
+"""
+Answer cache in front of answer_query, keyed by document content hash.
+
+Lookup is two-step: an exact match on the normalized question, then (given
+the question's embedding, and unless similarity_threshold is 0) the most
+similar cached question for the same document if its cosine similarity is
+at least similarity_threshold. Entries expire after ttl_seconds and the
+least recently used are evicted beyond max_entries. With a persist_path the
+cache is reloaded at startup and pickled there by a timer thread
+save_seconds after a write (flush() saves at once), so answering a question
+never waits for the whole cache to be serialized.
+"""
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from core.config import (
+    ANSWER_CACHE_ENABLED, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_PATH, ANSWER_CACHE_SAVE_SECONDS,
+)
+from core.metrics import register_stats
+
+
+def normalize_question(question: str) -> str:
+    return re.sub(r"\s+", " ", question.lower()).strip().rstrip("?.! ")
+
+
+class AnswerCache:
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+                 similarity_threshold: float = ANSWER_CACHE_SIMILARITY, persist_path: str = ANSWER_CACHE_PATH,
+                 enabled: bool = ANSWER_CACHE_ENABLED, save_seconds: float = ANSWER_CACHE_SAVE_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.persist_path = persist_path
+        self.enabled = enabled
+        self.save_seconds = save_seconds
+        # (doc_id, normalized question) -> {"answer", "vector", "created"}
+        self._entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Held while writing persist_path, so saves land in snapshot order
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self.counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        if persist_path:
+            self._load()
+
+    def _expired(self, entry: dict, now: float) -> bool:
+        return now - entry["created"] > self.ttl_seconds
+
+    def get(self, doc_id: str, question: str):
+        """
+        Exact lookup on the normalized question. Does not count a miss, since
+        a semantic lookup usually follows.
+        """
+        if not self.enabled:
+            return None
+        key = (doc_id, normalize_question(question))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry, now):
+                del self._entries[key]
+                self.counters["expirations"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["exact_hits"] += 1
+            return entry["answer"]
+
+    def get_similar(self, doc_id: str, query_vector):
+        """
+        Most similar cached question for doc_id at or above the threshold.
+        Counts a miss when nothing qualifies (always, with threshold 0).
+        """
+        if not self.enabled:
+            return None
+        if not self.similarity_threshold:
+            with self._lock:
+                self.counters["misses"] += 1
+            return None
+        now = time.time()
+        with self._lock:
+            keys, vectors = [], []
+            for key, entry in list(self._entries.items()):
+                if key[0] != doc_id:
+                    continue
+                if self._expired(entry, now):
+                    del self._entries[key]
+                    self.counters["expirations"] += 1
+                    continue
+                if entry["vector"] is not None:
+                    keys.append(key)
+                    vectors.append(entry["vector"])
+
+            if vectors:
+                query = np.asarray(query_vector, dtype=np.float32)
+                sims = np.stack(vectors) @ query
+                best = int(np.argmax(sims))
+                if sims[best] >= self.similarity_threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.counters["semantic_hits"] += 1
+                    return self._entries[keys[best]]["answer"]
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, doc_id: str, question: str, answer, query_vector=None):
+        if not self.enabled:
+            return
+        key = (doc_id, normalize_question(question))
+        vector = None if query_vector is None else np.asarray(query_vector, dtype=np.float32)
+        with self._lock:
+            self._entries[key] = {"answer": answer, "vector": vector, "created": time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+            self._schedule_save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for key in self.counters:
+                self.counters[key] = 0
+            self._schedule_save()
+
+    def _schedule_save(self):
+        # Called with _lock held; one pending save covers every later write
+        if self.persist_path and self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_seconds, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        """
+        Writes the cache to persist_path now, if it has changed since the
+        last save.
+        """
+        with self._save_lock:
+            with self._lock:
+                if self._save_timer is None:
+                    return
+                self._save_timer.cancel()
+                self._save_timer = None
+                items = list(self._entries.items())
+            self._save(items)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.counters["exact_hits"] + self.counters["semantic_hits"] + self.counters["misses"]
+            hits = self.counters["exact_hits"] + self.counters["semantic_hits"]
+            return {
+                **self.counters,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+    def _save(self, items: list):
+        directory = os.path.dirname(os.path.abspath(self.persist_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.persist_path)
+
+    def _load(self):
+        try:
+            with open(self.persist_path, "rb") as f:
+                items = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return
+        now = time.time()
+        for key, entry in items[-self.max_entries:]:
+            if not self._expired(entry, now):
+                self._entries[key] = entry
+
+
+answer_cache = AnswerCache()
+register_stats("answer_cache", answer_cache.stats,
+               counters=("exact_hits", "semantic_hits", "misses", "evictions", "expirations"))
@@ -1,27 +1,155 @@
+import re
+import threading
+from collections import OrderedDict
 from typing import List
+
 import numpy as np
-from rank_bm25 import BM25Okapi
+from scipy import sparse
+
+from core.config import BM25_CACHE_ENTRIES
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:['\-][a-z0-9]+)*")
+
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have if in into is it its of on or such that the their then there
+these this to was were which will with
+""".split())
+
 
 class BM25Retriever:
-    def __init__(self):
+    """
+    Okapi BM25 over a fixed corpus, scored with a sparse term-weight matrix.
+
+    index() precomputes every document's BM25 weight for every term it contains
+    into a CSC matrix (documents x vocabulary), so a query is one column slice
+    and a row sum instead of a Python loop over the corpus. Scores match
+    rank_bm25.BM25Okapi with the same k1, b and epsilon.
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
         self.clauses: List[dict] = []
-        self.tokenized_corpus: List[List[str]] = []
-        self.bm25 = None
+        self.vocab: dict = {}
+        self.weights = None
+        self.idf = None
+
+    @classmethod
+    def from_index(cls, clauses, vocab, weights, idf, k1: float, b: float, epsilon: float) -> "BM25Retriever":
+        """
+        A retriever over precomputed index arrays (e.g. memory-mapped by the
+        index store) instead of calling index(). vocab maps term -> column.
+        """
+        retriever = cls(k1, b, epsilon)
+        retriever.clauses = clauses
+        retriever.vocab = vocab
+        retriever.weights = weights
+        retriever.idf = idf
+        return retriever
 
     def index(self, clauses: List[dict]):
         self.clauses = clauses
-        self.tokenized_corpus = [self.tokenize(clause["text"]) for clause in clauses]
-        self.bm25 = BM25Okapi(self.tokenized_corpus)
+        vocab = {}
+        rows, cols, tfs, doc_lens = [], [], [], []
+        for row, clause in enumerate(clauses):
+            tokens = self.tokenize(clause["text"])
+            doc_lens.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                col = vocab.setdefault(token, len(vocab))
+                counts[col] = counts.get(col, 0) + 1
+            rows.extend([row] * len(counts))
+            cols.extend(counts.keys())
+            tfs.extend(counts.values())
 
-    def search(self, query: str, top_k: int = 5) -> List[dict]:
-        if not self.bm25:
-            return []
+        self.vocab = vocab
+        if not clauses or not vocab:
+            self.weights = None
+            return
+
+        rows = np.asarray(rows, dtype=np.int32)
+        cols = np.asarray(cols, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.float32)
+        doc_lens = np.asarray(doc_lens, dtype=np.float32)
+
+        n_docs = len(clauses)
+        doc_freq = np.bincount(cols, minlength=len(vocab)).astype(np.float64)
+        idf = np.log(n_docs - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+        # Same floor as BM25Okapi: terms in more than half the corpus get a small positive idf
+        idf[idf < 0] = self.epsilon * idf.mean()
+        self.idf = idf.astype(np.float32)
+
+        avgdl = doc_lens.mean() or 1.0
+        norm = self.k1 * (1 - self.b + self.b * doc_lens[rows] / avgdl)
+        data = idf[cols] * tfs * (self.k1 + 1) / (tfs + norm)
+        self.weights = sparse.csc_matrix((data.astype(np.float32), (rows, cols)), shape=(n_docs, len(vocab)))
 
-        tokenized_query = self.tokenize(query)
-        scores = self.bm25.get_scores(tokenized_query)
-        top_indices = np.argsort(scores)[::-1][:top_k]
-        return [self.clauses[i] for i in top_indices if scores[i] > 0.0]
+    def get_scores(self, query: str) -> np.ndarray:
+        if self.weights is None:
+            return np.zeros(len(self.clauses), dtype=np.float32)
+        counts = {}
+        for token in self.tokenize(query):
+            col = self.vocab.get(token)
+            if col is not None:
+                counts[col] = counts.get(col, 0) + 1
+        if not counts:
+            return np.zeros(len(self.clauses), dtype=np.float32)
+        cols = np.fromiter(counts.keys(), dtype=np.int32)
+        query_tf = np.fromiter(counts.values(), dtype=np.float32)
+        return np.asarray(self.weights[:, cols] @ query_tf).ravel()
+
+    def term_weights(self, text: str) -> dict:
+        """
+        {term: idf} for the distinct terms of text that occur in the corpus.
+        """
+        if self.idf is None:
+            return {}
+        cols = {t: self.vocab[t] for t in self.tokenize(text) if t in self.vocab}
+        return {t: float(self.idf[col]) for t, col in cols.items()}
+
+    def search_indices(self, query: str, top_k: int = 5) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (row indices, scores) of the top_k positive-scoring clauses,
+        best first.
+        """
+        scores = self.get_scores(query)
+        if scores.size == 0:
+            return np.zeros(0, dtype=np.int64), scores
+        k = min(top_k, scores.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[scores[top] > 0.0]
+        return top, scores[top]
+
+    def search(self, query: str, top_k: int = 5) -> List[dict]:
+        indices, _ = self.search_indices(query, top_k)
+        return [self.clauses[i] for i in indices]
 
     @staticmethod
     def tokenize(text: str) -> List[str]:
-        return text.lower().split()
+        return [t for t in _TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+_index_cache: "OrderedDict[str, BM25Retriever]" = OrderedDict()
+_index_lock = threading.Lock()
+
+
+def get_bm25_index(doc_id: str, clauses: List[dict]) -> BM25Retriever:
+    """
+    Per-document BM25 index, built once per doc_id and kept in a small LRU.
+    """
+    with _index_lock:
+        retriever = _index_cache.get(doc_id)
+        if retriever is not None:
+            _index_cache.move_to_end(doc_id)
+            return retriever
+
+    retriever = BM25Retriever()
+    retriever.index(clauses)
+
+    with _index_lock:
+        _index_cache[doc_id] = retriever
+        _index_cache.move_to_end(doc_id)
+        while len(_index_cache) > BM25_CACHE_ENTRIES:
+            _index_cache.popitem(last=False)
+    return retriever
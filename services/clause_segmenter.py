@@ -0,0 +1,215 @@
+# services/clause_segmenter.py
+"""
+Single-pass clause segmentation.
+
+One precompiled, line-anchored pattern recognises every heading style we
+see in policy wordings ("Section 4", "3.28. In-Patient Care ...",
+"19. Illness:-", "iv) Kidney Failure ...:", "Note:"). A "Title:" line
+is body text if it has a digit after the colon or a bare number before
+it, or is an "Example:" lead-in, so contact lines ("Fax: 0674 - 2596429")
+and worked examples do not become headings. Its quantifiers are bounded and never cross a newline, so matching is linear
+in the text and cannot backtrack across a whole page. Text is scanned once, as pages
+arrive; each clause is a span [start, end) of the document with its
+heading, heading hierarchy and page. Runs of tiny clauses are merged up to
+target_chars, so list items and one-line headings do not become clauses of
+their own.
+
+Documents with fewer than two headings in their first lock_chars
+characters are segmented at blank lines instead.
+"""
+import re
+from bisect import bisect_right
+from typing import Optional
+
+from core.config import CLAUSE_MIN_CHARS, CLAUSE_TARGET_CHARS
+
+# Levels: numbered headings use their depth ("3" is 1, "3.28" is 2);
+# lettered/roman items and "Title:" lines, both ending in a colon, are leaves
+ITEM_LEVEL = 8
+TITLE_LEVEL = 9
+
+HEADING_RE = re.compile(r"""
+    ^[ \t]*(?:
+        (?P<keyword>(?:Section|Clause|Article|Chapter|Part)[ \t]+(?P<knum>\d{1,3}(?:\.\d{1,3}){0,4})\b)[^\n]{0,160}
+      | (?P<number>[1-9]\d{0,2}(?:\.\d{1,3}){0,4})[.)]?[ \t]+(?=[A-Z(])[^\n]{0,160}
+      | (?P<item>\(?(?:[a-z]|[ivx]{1,5})[.)])[ \t]+[A-Z][^\n:]{0,120}:[^\n\S]*(?:-[ \t]*)?$
+      | (?P<title>[A-Z][^\n:.;]{1,80}):[^\n\S]*(?:-[^\n\S]*)?(?:[A-Z][^\n\d]{0,200})?$
+    )
+""", re.MULTILINE | re.VERBOSE)
+
+# Titles that are body text: a bare number ("Tel 2", "Pin 600 001") or an
+# example lead-in. Checked on title matches only, as lookaheads in
+# HEADING_RE would run on every line
+BARE_NUMBER_RE = re.compile(r"(?<!\w)\d+(?!\w)")
+EXAMPLE_TITLE_RE = re.compile(r"\b(?:Examples?|Illustrations?)\s*$", re.IGNORECASE)
+
+# Blank lines, including lines holding only spaces as PDF extraction produces
+PARAGRAPH_BREAK_RE = re.compile(r"\n[ \t\xa0]*\n\s*")
+
+HEADING_MODE = "heading"
+PARAGRAPH_MODE = "paragraph"
+
+
+def _headings(text: str, start: int = 0, stop: Optional[int] = None):
+    for match in HEADING_RE.finditer(text, start, len(text) if stop is None else stop):
+        title = match.group("title")
+        if title and (BARE_NUMBER_RE.search(title) or EXAMPLE_TITLE_RE.search(title)):
+            continue
+        yield match
+
+
+def _heading_level(match: re.Match) -> int:
+    number = match.group("knum") or match.group("number")
+    if number:
+        return number.count(".") + 1
+    return ITEM_LEVEL if match.group("item") else TITLE_LEVEL
+
+
+def choose_mode(text: str) -> str:
+    headings = 0
+    for _ in _headings(text):
+        headings += 1
+        if headings >= 2:
+            return HEADING_MODE
+    return PARAGRAPH_MODE
+
+
+class ClauseSegmenter:
+    """
+    Incremental segmentation over a stream of pages. feed() returns the
+    clauses completed so far; close() returns the rest. Each clause is
+    {"section", "text", "page", "start", "end", "hierarchy"}, where start and
+    end are offsets of the stripped text in the whole document and
+    hierarchy lists the enclosing headings, outermost first.
+
+    Only complete lines are scanned, and text is dropped from the buffer as
+    soon as its clauses are emitted. The mode is chosen once lock_chars of
+    text have been seen (or at close).
+    """
+    def __init__(self, mode: Optional[str] = None, min_chars: int = CLAUSE_MIN_CHARS,
+                 target_chars: int = CLAUSE_TARGET_CHARS, lock_chars: int = 20000):
+        self.mode = mode
+        self.min_chars = min_chars
+        self.target_chars = target_chars
+        self.lock_chars = lock_chars
+        self.buffer = ""
+        self.base = 0             # document offset of buffer[0]
+        self.scanned = 0          # document offset up to which lines were scanned
+        self.page_offsets: list[int] = []
+        self.page_numbers: list[Optional[int]] = []
+        # Open segment: (start, section, hierarchy); the document starts with
+        # an untitled one holding any text before the first heading
+        self.open = (0, None, [])
+        self.stack: list[tuple[int, str]] = []
+        self.pending = None       # [start, end, section, hierarchy] awaiting merge
+        self.count = 0
+
+    def _page_at(self, offset: int) -> Optional[int]:
+        i = bisect_right(self.page_offsets, offset) - 1
+        return self.page_numbers[max(i, 0)] if self.page_numbers else None
+
+    def feed(self, page_no: Optional[int], text: str) -> list[dict]:
+        self.page_offsets.append(self.base + len(self.buffer))
+        self.page_numbers.append(page_no)
+        self.buffer += text
+        if self.mode is None:
+            if len(self.buffer) < self.lock_chars:
+                return []
+            self.mode = choose_mode(self.buffer)
+        last_newline = self.buffer.rfind("\n")
+        if last_newline < 0:
+            return []
+        # Headings are whole lines: scan through the last newline. A blank
+        # line may continue on the next page: stop before the last newline
+        if self.mode == PARAGRAPH_MODE:
+            return self._scan(self.base + last_newline)
+        return self._scan(self.base + last_newline + 1)
+
+    def close(self) -> list[dict]:
+        if self.mode is None:
+            self.mode = choose_mode(self.buffer)
+        end = self.base + len(self.buffer)
+        clauses = self._scan(end)
+        clauses.extend(self._close_segment(end))
+        if self.pending is not None:
+            clauses.extend(self._emit(*self.pending))
+            self.pending = None
+        return clauses
+
+    def _scan(self, until: int) -> list[dict]:
+        clauses = []
+        start, stop = self.scanned - self.base, until - self.base
+        if self.mode == PARAGRAPH_MODE:
+            for match in PARAGRAPH_BREAK_RE.finditer(self.buffer, start, stop):
+                clauses.extend(self._close_segment(self.base + match.end()))
+                self.open = (self.base + match.end(), None, [])
+        else:
+            for match in _headings(self.buffer, start, stop):
+                boundary = self.base + match.start()
+                clauses.extend(self._close_segment(boundary))
+                level = _heading_level(match)
+                label = match.group().strip()[:120]
+                while self.stack and self.stack[-1][0] >= level:
+                    self.stack.pop()
+                self.stack.append((level, label))
+                self.open = (boundary, label, [label for _, label in self.stack])
+        self.scanned = until
+
+        # Keep only text that is still needed: the pending merge and the open segment
+        keep_from = self.pending[0] if self.pending is not None else self.open[0]
+        self.buffer = self.buffer[keep_from - self.base:]
+        self.base = keep_from
+        return clauses
+
+    def _close_segment(self, end: int) -> list[dict]:
+        start, section, hierarchy = self.open
+        if end <= start:
+            return []
+        self.open = (end, None, [])
+        pending = self.pending
+        if pending is not None:
+            if (len(self._text(pending[0], pending[1]).strip()) < self.min_chars
+                    and end - pending[0] <= self.target_chars):
+                pending[1] = end
+                return []
+            self.pending = [start, end, section, hierarchy]
+            return self._emit(*pending)
+        self.pending = [start, end, section, hierarchy]
+        return []
+
+    def _text(self, start: int, end: int) -> str:
+        return self.buffer[start - self.base:end - self.base]
+
+    def _emit(self, start: int, end: int, section: Optional[str], hierarchy: list[str]) -> list[dict]:
+        raw = self._text(start, end)
+        text = raw.strip()
+        if not text:
+            return []
+        start += len(raw) - len(raw.lstrip())
+        self.count += 1
+        if section is None:
+            section = f"Paragraph {self.count}" if self.mode == PARAGRAPH_MODE else "Preamble"
+        return [{
+            "section": section,
+            "text": text,
+            "page": self._page_at(start),
+            "start": start,
+            "end": start + len(text),
+            "hierarchy": hierarchy,
+        }]
+
+
+def segment_clauses(text: str, page_offsets: Optional[list[int]] = None, **kwargs) -> list[dict]:
+    """
+    Segments a whole document. page_offsets (start offset of each page in
+    text) fills in each clause's page.
+    """
+    segmenter = ClauseSegmenter(**kwargs)
+    if not page_offsets:
+        return segmenter.feed(None, text) + segmenter.close()
+    clauses = []
+    bounds = list(page_offsets[1:]) + [len(text)]
+    for page_no, (start, end) in enumerate(zip(page_offsets, bounds), start=1):
+        clauses.extend(segmenter.feed(page_no, text[start:end]))
+    clauses.extend(segmenter.close())
+    return clauses
@@ -0,0 +1,166 @@
+# services/context_packer.py
+"""
+Context packing: the stage between reranking and the LLM call that decides
+which text goes into a question's prompt.
+
+Of the top CONTEXT_MAX_CHUNKS reranked chunk rows:
+
+1. Near-duplicates are dropped: a chunk whose vector has cosine similarity
+   of at least CONTEXT_DEDUP_SIMILARITY with a more relevant kept chunk, and
+   which shares most of its words with it (boilerplate repeated in several
+   sections), adds nothing new.
+2. Chunks are added in relevance order while they fit in
+   CONTEXT_TOKEN_BUDGET tokens; the most relevant one is always added. A
+   chunk that does not fit is skipped or, with CONTEXT_SENTENCES, cut down to
+   the sentences sharing the most (idf-weighted) terms with the question.
+3. Chosen chunks that are consecutive parts of the same clause (same
+   section once the " (Part N)" suffix is dropped) are merged into one
+   passage. Consecutive parts of a long clause overlap by the chunker's
+   overlap, which is sent (and counted against the budget) once. Chunks of
+   different clauses stay separate passages, each with its own section.
+"""
+import re
+
+from core.config import CONTEXT_DEDUP_SIMILARITY, CONTEXT_MAX_CHUNKS, CONTEXT_SENTENCES, CONTEXT_TOKEN_BUDGET
+from core.metrics import traced
+from services.document_index import DocumentIndex
+from utils.chunker import count_tokens
+
+_SENTENCE_BREAK = re.compile(r"(?<=[.;:!?])\s+")
+_PART_SUFFIX = re.compile(r" \(Part \d+\)$")
+
+# Shortest shared text taken as chunk overlap rather than coincidence
+_MIN_OVERLAP_CHARS = 32
+# Word-set Jaccard similarity that confirms a near-duplicate flagged by its vector
+_MIN_DUPLICATE_JACCARD = 0.8
+
+
+def _overlap(a: str, b: str) -> int:
+    """
+    Length of the longest suffix of a that is also a prefix of b.
+    """
+    if len(b) < _MIN_OVERLAP_CHARS:
+        return 0
+    probe = b[:_MIN_OVERLAP_CHARS]
+    start = a.find(probe)
+    while start != -1:
+        if b.startswith(a[start:]):
+            return len(a) - start
+        start = a.find(probe, start + 1)
+    return 0
+
+
+def _same_clause(index: DocumentIndex, a: int, b: int) -> bool:
+    return (_PART_SUFFIX.sub("", index.chunks[a]["section"])
+            == _PART_SUFFIX.sub("", index.chunks[b]["section"]))
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def _drop_near_duplicates(rows: list[int], index: DocumentIndex, threshold: float) -> list[int]:
+    if threshold >= 1.0 or len(rows) < 2:
+        return rows
+    vectors = index.vectors[rows]
+    sims = vectors @ vectors.T
+    words = {}
+
+    def word_set(i: int) -> set:
+        if i not in words:
+            words[i] = set(index.bm25.tokenize(index.chunks[rows[i]]["text"]))
+        return words[i]
+
+    kept = []
+    for i, row in enumerate(rows):
+        # Parts of one clause are similar because they overlap; they are merged instead
+        if any(sims[i, j] >= threshold and not (abs(rows[j] - row) == 1 and _same_clause(index, rows[j], row))
+               and _jaccard(word_set(i), word_set(j)) >= _MIN_DUPLICATE_JACCARD for j in kept):
+            continue
+        kept.append(i)
+    return [rows[i] for i in kept]
+
+
+def _best_sentences(query: str, text: str, max_tokens: int, index: DocumentIndex) -> str:
+    """
+    The sentences of text sharing the most idf-weighted terms with query that
+    fit in max_tokens, in text order; gaps between them are marked with "...".
+    """
+    weights = index.bm25.term_weights(query)
+    if not weights or max_tokens <= 0:
+        return ""
+    sentences = [s for s in _SENTENCE_BREAK.split(text) if s.strip()]
+    scores = [sum(weights.get(t, 0.0) for t in set(index.bm25.tokenize(s))) for s in sentences]
+    picked, used = [], 0
+    for i in sorted(range(len(sentences)), key=lambda i: -scores[i]):
+        if scores[i] <= 0:
+            break
+        cost = count_tokens(sentences[i])
+        if used + cost <= max_tokens:
+            picked.append(i)
+            used += cost
+    parts = []
+    for n, i in enumerate(sorted(picked)):
+        if n and i != parts[-1][0] + 1:
+            parts.append((i, "..."))
+        parts.append((i, sentences[i]))
+    return " ".join(s for _, s in parts)
+
+
+def _merge(rows: list[int], texts: dict, full: set, index: DocumentIndex) -> dict:
+    """
+    One passage from consecutive chunk rows of one clause, without repeating
+    their overlap.
+    """
+    first = index.chunks[rows[0]]
+    text = texts[rows[0]]
+    for prev, row in zip(rows, rows[1:]):
+        overlap = _overlap(text, texts[row]) if prev in full and row in full else 0
+        text = text + texts[row][overlap:] if overlap else f"{text}\n{texts[row]}"
+    section = _PART_SUFFIX.sub("", first["section"]) if len(rows) > 1 else first["section"]
+    return {"section": section, "text": text, "page": first.get("page")}
+
+
+@traced("pack_context")
+def pack_context(query: str, rows: list[int], index: DocumentIndex, max_chunks: int = CONTEXT_MAX_CHUNKS,
+                 token_budget: int = CONTEXT_TOKEN_BUDGET, dedup_similarity: float = CONTEXT_DEDUP_SIMILARITY,
+                 sentences: bool = CONTEXT_SENTENCES) -> list[dict]:
+    """
+    Packs reranked chunk rows (best first) into passages for the prompt:
+    {"section", "text", "page"} dicts, most relevant first. token_budget 0
+    means no limit.
+    """
+    candidates = _drop_near_duplicates(list(rows[:max_chunks]), index, dedup_similarity)
+    texts, full, rank = {}, set(), {}
+    used = 0
+    for row in candidates:
+        text = index.chunks[row]["text"]
+        # Overlap with a chosen part of the same clause is already paid for
+        start = _overlap(texts[row - 1], text) if row - 1 in full and _same_clause(index, row - 1, row) else 0
+        end = len(text)
+        if row + 1 in full and _same_clause(index, row, row + 1):
+            end -= _overlap(text, texts[row + 1])
+        cost = count_tokens(text[start:max(start, end)])
+        if token_budget and texts and used + cost > token_budget:
+            if not sentences:
+                continue
+            text = _best_sentences(query, text, token_budget - used, index)
+            if not text:
+                continue
+            cost = count_tokens(text)
+        else:
+            full.add(row)
+        texts[row] = text
+        rank[row] = len(rank)
+        used += cost
+
+    passages, group = [], []
+    for row in sorted(texts):
+        if group and (row != group[-1] + 1 or not _same_clause(index, group[-1], row)):
+            passages.append(group)
+            group = []
+        group.append(row)
+    if group:
+        passages.append(group)
+    passages.sort(key=lambda g: min(rank[r] for r in g))
+    return [_merge(g, texts, full, index) for g in passages]
@@ -0,0 +1,205 @@
+# services/doc_cache.py
+"""
+Content-addressed document cache.
+
+Entries are keyed by a hash of the document bytes (not the URL), so a signed
+blob URL with a fresh SAS token still hits the cache. Each entry is a dict that
+fills up as the pipeline runs: "text" and "meta" after parsing, "clauses" after
+splitting, "chunks" and "vectors" after embedding.
+
+Two tiers: a small in-memory LRU of hot entries in front of one pickle file per
+entry on disk. The disk tier is evicted least-recently-used first once it grows
+past DOC_CACHE_MAX_BYTES.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from core.config import DOC_CACHE_DIR, DOC_CACHE_MAX_BYTES, DOC_CACHE_MEMORY_ENTRIES
+from core.metrics import register_stats
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+# Query parameters of Azure SAS tokens and S3 / GCS presigned URLs, which
+# change when a URL is re-signed but do not select the document
+_SIGNATURE_PARAMS = {"sv", "ss", "srt", "sp", "se", "st", "spr", "sig", "sr", "si", "skoid", "sktid", "skt",
+                     "ske", "sks", "skv", "sdd", "rscc", "rscd", "rsce", "rscl", "rsct",
+                     "awsaccesskeyid", "googleaccessid", "signature", "expires"}
+_SIGNATURE_PREFIXES = ("x-amz-", "x-goog-")
+
+
+def url_key(url: str) -> str:
+    """
+    Stable key for a URL, ignoring signature parameters so that re-signed
+    blob URLs (new SAS token) map to the same entry. Other parameters are
+    kept, since they can select a different document.
+    """
+    parts = urlsplit(url)
+    query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+             if name.lower() not in _SIGNATURE_PARAMS and not name.lower().startswith(_SIGNATURE_PREFIXES)]
+    key = f"{parts.scheme}://{parts.netloc}{parts.path}"
+    return f"{key}?{urlencode(query)}" if query else key
+
+
+def _atomic_write(path: str, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class DocumentCache:
+    def __init__(self, cache_dir: str = DOC_CACHE_DIR, max_bytes: int = DOC_CACHE_MAX_BYTES,
+                 memory_entries: int = DOC_CACHE_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, dict]" = OrderedDict()
+        self._url_index: Optional[dict] = None
+        self._lock = threading.RLock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    # ---- entries keyed by content hash ----
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def _remember(self, key: str, entry: dict):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry, outcome = self._lookup(key)
+            self.counters[outcome] += 1
+            return entry
+
+    def _lookup(self, key: str) -> tuple[Optional[dict], str]:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key], "memory_hits"
+
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            return None, "misses"
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None, "misses"
+        # Touch so LRU eviction on disk sees this entry as recently used
+        os.utime(path, None)
+        self._remember(key, entry)
+        return entry, "disk_hits"
+
+    def update(self, key: str, **fields) -> dict:
+        """
+        Merges fields into the entry for key and writes it through to disk.
+        """
+        with self._lock:
+            entry = dict(self._lookup(key)[0] or {})
+            entry.update(fields)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            _atomic_write(self._entry_path(key), pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+            self._remember(key, entry)
+            self._evict()
+            return entry
+
+    def _evict(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".pkl"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path, name[:-len(".pkl")]))
+
+        total = sum(size for _, size, _, _ in files)
+        for _, size, path, key in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._memory.pop(key, None)
+            total -= size
+
+    def clear(self):
+        """
+        Drops every entry and the URL index, in memory and on disk.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._url_index = {}
+            for key in self.counters:
+                self.counters[key] = 0
+            if not os.path.isdir(self.cache_dir):
+                return
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".pkl") or name == "url_index.json":
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = sum(self.counters.values())
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            return {
+                **self.counters,
+                "memory_entries": len(self._memory),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+    # ---- URL -> content hash / validators ----
+
+    def _url_index_path(self) -> str:
+        return os.path.join(self.cache_dir, "url_index.json")
+
+    def _load_url_index(self) -> dict:
+        if self._url_index is None:
+            try:
+                with open(self._url_index_path(), "r", encoding="utf-8") as f:
+                    self._url_index = json.load(f)
+            except (OSError, ValueError):
+                self._url_index = {}
+        return self._url_index
+
+    def lookup_url(self, url: str) -> Optional[dict]:
+        """
+        Returns {"content_hash", "etag", "last_modified"} for a URL seen before.
+        """
+        with self._lock:
+            return self._load_url_index().get(url_key(url))
+
+    def remember_url(self, url: str, key: str, etag: Optional[str], last_modified: Optional[str]):
+        with self._lock:
+            index = self._load_url_index()
+            index[url_key(url)] = {"content_hash": key, "etag": etag, "last_modified": last_modified}
+            os.makedirs(self.cache_dir, exist_ok=True)
+            _atomic_write(self._url_index_path(), json.dumps(index).encode("utf-8"))
+
+
+document_cache = DocumentCache()
+register_stats("document_cache", document_cache.stats, counters=("memory_hits", "disk_hits", "misses"))
@@ -1,77 +1,234 @@
-import requests
 import fitz  # PyMuPDF
-import re
 import asyncio
-import tiktoken
+import functools
+import hashlib
 import validators  # pip install validators
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
 
-async def process_document(blob_or_text: str) -> tuple[str, dict]:
+from core.config import PDF_WORKERS, PDF_PAGES_PER_TASK
+from core.executors import cpu_pool, io_pool
+from core.metrics import span, traced
+from services.doc_cache import document_cache, content_hash
+from services.clause_segmenter import segment_clauses
+from services.http_fetcher import document_fetcher, Download, DownloadError
+
+
+@dataclass
+class SourceDocument:
     """
-    If input is a valid URL -> Download PDF and extract text.
-    If input is not a URL -> Treat it as raw plain text.
+    A document resolved by open_document. Exactly one of text/path is set:
+    text for raw input or a cache hit, path for a downloaded PDF still to
+    extract. close() releases the download once it is no longer needed.
     """
-    loop = asyncio.get_event_loop()
+    doc_id: str
+    meta: dict
+    text: Optional[str] = None
+    path: Optional[str] = None
+    download: Optional[Download] = field(default=None, repr=False)
+
+    def close(self):
+        if self.download is not None:
+            self.download.release()
+            self.download = None
+        self.path = None
+
 
+@traced("download")
+async def open_document(blob_or_text: str) -> SourceDocument:
+    """
+    If input is a valid URL -> Download the PDF (or reuse the cached text).
+    If input is not a URL -> Treat it as raw plain text.
+
+    doc_id is a hash of the document content and keys the document cache, so
+    a repeat document skips download (via If-None-Match / If-Modified-Since)
+    and parsing.
+    """
     # Case 1: PDF from URL
+    # The document cache reads and writes pickles: its calls run on the io pool
     if validators.url(blob_or_text):
-        resp = await loop.run_in_executor(None, lambda: requests.get(blob_or_text))
-        resp.raise_for_status()
-        pdf = fitz.open(stream=resp.content, filetype="pdf")
-        doc_text = ""
-        for page in pdf:
-            doc_text += page.get_text()
-        return doc_text, {"num_pages": pdf.page_count}
+        known = await io_pool.run(document_cache.lookup_url, blob_or_text)
+        headers = {}
+        if known and await io_pool.run(document_cache.get, known["content_hash"]) is not None:
+            if known.get("etag"):
+                headers["If-None-Match"] = known["etag"]
+            if known.get("last_modified"):
+                headers["If-Modified-Since"] = known["last_modified"]
+
+        # The body is streamed to a temp file; concurrent requests for the
+        # same URL share one download
+        download = document_fetcher.fetch(blob_or_text, headers)
+        try:
+            result = await download.result()
+            if result.status_code == 304:
+                entry = await io_pool.run(document_cache.get, known["content_hash"]) if known else None
+                if entry is not None and "text" in entry:
+                    download.release()
+                    return SourceDocument(known["content_hash"], {**entry["meta"], "cached": True}, text=entry["text"])
+                # Entry was evicted between the check and now: fetch unconditionally
+                download.release()
+                download = document_fetcher.fetch(blob_or_text)
+                result = await download.result()
+                if result.status_code == 304:
+                    raise DownloadError(f"Unexpected 304 Not Modified from {blob_or_text}")
+
+            doc_id = result.doc_id
+            await io_pool.run(document_cache.remember_url, blob_or_text, doc_id, result.etag, result.last_modified)
+            entry = await io_pool.run(document_cache.get, doc_id)
+            if entry is not None and "text" in entry:
+                download.release()
+                return SourceDocument(doc_id, {**entry["meta"], "cached": True}, text=entry["text"])
+        except BaseException:
+            download.release()
+            raise
+        return SourceDocument(doc_id, {"doc_id": doc_id, "cached": False}, path=result.path, download=download)
 
     # Case 2: Direct raw text
-    return blob_or_text.strip(), {"num_pages": 1}
+    doc_text = blob_or_text.strip()
+    doc_id = content_hash(doc_text.encode("utf-8"))
+    meta = {"num_pages": 1, "page_offsets": [0], "doc_id": doc_id, "cached": False}
+    return SourceDocument(doc_id, meta, text=doc_text)
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
 
 
-def split_into_clauses(text: str) -> list[dict]:
+@traced("download")
+async def open_file(path: str) -> SourceDocument:
     """
-    Tries to split text by legal-style headings like "Section 1", "Section 1.1 ...".
-    Falls back to paragraph-level splitting if no such headers are found.
-    Returns list of {"section": str, "text": str}.
+    A local PDF. doc_id is the hash of the file's bytes, as for a download,
+    so a document ingested from disk is a cache hit when it is later
+    requested by URL.
+    """
+    doc_id = await io_pool.run(_file_hash, path)
+    entry = await io_pool.run(document_cache.get, doc_id)
+    if entry is not None and "text" in entry:
+        return SourceDocument(doc_id, {**entry["meta"], "cached": True}, text=entry["text"])
+    return SourceDocument(doc_id, {"doc_id": doc_id, "cached": False}, path=path)
+
+
+def _extract_page_range(path: str, start: int, end: int) -> list[str]:
+    # Runs in a worker process; each worker opens its own handle on the file
+    pdf = fitz.open(path)
+    try:
+        return [pdf[i].get_text() for i in range(start, end)]
+    finally:
+        pdf.close()
+
+
+def _page_count(path: str) -> int:
+    # Runs in a worker process: opening a large or encrypted PDF can take a while
+    pdf = fitz.open(path)
+    try:
+        return pdf.page_count
+    finally:
+        pdf.close()
+
+
+async def iter_pdf_pages(path: str, pages_per_task: int = PDF_PAGES_PER_TASK,
+                         meta: Optional[dict] = None) -> AsyncIterator[tuple[int, str]]:
     """
-    patterns = [
-        r'(Section\s+\d+[\.\d]*\s*[\w\s]*)',
-        r'(Clause\s+\d+[\.\d]*\s*[\w\s]*)',
-        r'([A-Z][\w\s]*:\s*)',
-        r'(\d+\.\s*[A-Z][\w\s]*)'
-    ]
-    
-    for pattern in patterns:
-        sections = re.split(pattern, text)
-        if len(sections) > 3:
-            clauses = [{"section": s.strip(), "text": t.strip()} for s, t in zip(sections[1::2], sections[2::2])]
-            filtered_clauses = [c for c in clauses if c["text"]]
-            if filtered_clauses:
-                return filtered_clauses
-    
-    paragraphs = [p.strip() for p in text.split("\n\n") if len(p.strip()) > 50]
-    fallback_clauses = [{"section": f"Paragraph {i+1}", "text": p} for i, p in enumerate(paragraphs)]
-    
-    if not fallback_clauses or any(len(c["text"]) > 2000 for c in fallback_clauses):
-        sentences = re.split(r'[.!?]+', text)
-        sentences = [s.strip() for s in sentences if len(s.strip()) > 20]
-        fallback_clauses = [{"section": f"Sentence {i+1}", "text": s} for i, s in enumerate(sentences) if len(s) > 20]
-    
-    if not fallback_clauses:
-        return [{"section": "Entire Document", "text": text.strip()}]
-    
-    return fallback_clauses
-
-
-def chunk_text_by_tokens(text: str, max_tokens: int = 1000, overlap: int = 100) -> list[str]:
+    Extracts page text of the PDF at path on the cpu pool, pages_per_task
+    pages per task, and yields (page_number, text) in page order as soon as
+    each range is done. Workers open the file themselves, so the document is
+    never copied between processes. At most two tasks per worker are
+    submitted ahead of the consumer, so a long PDF does not fill the pool's
+    queue by itself. Page numbers are 1-based. meta["num_pages"], if meta
+    is given, is set before the first page is yielded.
+    """
+    page_count = await cpu_pool.run(_page_count, path)
+    if meta is not None:
+        meta["num_pages"] = page_count
+
+    starts = iter(range(0, page_count, pages_per_task))
+    window = deque()
+
+    async def extract(start: int) -> list[str]:
+        with span("parse"):
+            return await cpu_pool.run(_extract_page_range, path, start, min(start + pages_per_task, page_count))
+
+    def submit_next():
+        start = next(starts, None)
+        if start is not None:
+            window.append(asyncio.ensure_future(extract(start)))
+
+    try:
+        for _ in range(2 * PDF_WORKERS):
+            submit_next()
+        page_no = 1
+        while window:
+            page_texts = await window.popleft()
+            submit_next()
+            for page_text in page_texts:
+                yield page_no, page_text
+                page_no += 1
+    finally:
+        for future in window:
+            future.cancel()
+        await asyncio.gather(*window, return_exceptions=True)
+
+
+def _pages_from_offsets(text: str, page_offsets: Optional[list[int]]):
+    if not page_offsets:
+        yield None, text
+        return
+    bounds = list(page_offsets[1:]) + [len(text)]
+    for i, (start, end) in enumerate(zip(page_offsets, bounds), start=1):
+        yield i, text[start:end]
+
+
+async def iter_pages(doc: SourceDocument) -> AsyncIterator[tuple[int, str]]:
+    """
+    Yields (page_number, text) for a SourceDocument. For a freshly downloaded
+    PDF, the full text and page offsets are stored in doc and the document
+    cache once the last page has been extracted.
+    """
+    if doc.text is not None:
+        for page_no, page_text in _pages_from_offsets(doc.text, doc.meta.get("page_offsets")):
+            yield page_no, page_text
+        return
+
+    parts, offsets, pos = [], [], 0
+    async for page_no, page_text in iter_pdf_pages(doc.path, meta=doc.meta):
+        offsets.append(pos)
+        pos += len(page_text)
+        parts.append(page_text)
+        yield page_no, page_text
+
+    doc.text = "".join(parts)
+    doc.close()
+    doc.meta.update(num_pages=len(parts), page_offsets=offsets)
+    meta = {k: v for k, v in doc.meta.items() if k != "cached"}
+    await io_pool.run(functools.partial(document_cache.update, doc.doc_id, text=doc.text, meta=meta))
+
+
+@traced("process_document")
+async def process_document(blob_or_text: str) -> tuple[str, dict]:
+    """
+    Non-streaming helper: returns the full document text and its meta.
+    """
+    doc = await open_document(blob_or_text)
+    try:
+        async for _ in iter_pages(doc):
+            pass
+    finally:
+        doc.close()
+    return doc.text, doc.meta
+
+
+@traced("split")
+def split_into_clauses(text: str, page_offsets: Optional[list[int]] = None) -> list[dict]:
     """
-    Splits text into token-based chunks with optional overlap.
+    Splits text into clauses at headings like "Section 1", "3.28. Title" or
+    "Illness:-", falling back to blank lines when there are none (see
+    services.clause_segmenter). Returns list of {"section", "text", "page",
+    "start", "end", "hierarchy"}; page is filled in when page_offsets (start
+    offset of each page in text) is given.
     """
-    encoding = tiktoken.get_encoding("cl100k_base")
-    tokens = encoding.encode(text)
-    chunks = []
-    start = 0
-    while start < len(tokens):
-        end = start + max_tokens
-        chunk_tokens = tokens[start:end]
-        chunks.append(encoding.decode(chunk_tokens))
-        start += max_tokens - overlap
-    return chunks
+    return segment_clauses(text, page_offsets)
@@ -0,0 +1,362 @@
+import asyncio
+import functools
+from collections import deque
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import numpy as np
+
+from services.embeddings import get_vector_dim, EMBEDDING_MODEL_TAG
+from services.embedding_store import embed_with_store
+from services.index_store import index_store
+from services.vector_store import VectorStore, get_vector_store
+from services.doc_cache import document_cache
+from services.bm25_retriever import BM25Retriever, get_bm25_index
+from services import doc_parser
+from services.clause_segmenter import ClauseSegmenter
+from utils.chunker import chunk_texts_by_tokens, semantic_chunk_texts
+from utils.vectors import VectorMatrix
+from core.config import CHUNK_STRATEGY, CLAUSE_MIN_CHARS, CLAUSE_TARGET_CHARS, EMBED_BATCH_SIZE, VECTOR_STORAGE_DTYPE
+from core.executors import io_pool
+from core.metrics import span, traced
+
+# Identifies how cached clauses and chunks were produced; cache entries made
+# with other segmentation or chunking settings are rebuilt
+CHUNKING_TAG = f"segmenter-v3|{CLAUSE_MIN_CHARS}|{CLAUSE_TARGET_CHARS}|{CHUNK_STRATEGY}"
+# Identifies index store artifacts that match the current settings
+INDEX_TAG = f"{EMBEDDING_MODEL_TAG}|{CHUNKING_TAG}|{VECTOR_STORAGE_DTYPE}"
+
+# Embed batches one ingest keeps in flight: one running and one queued keeps
+# the inference worker busy while pages are extracted, without a long PDF
+# (or several ingest workers) filling the inference pool's queue
+_EMBED_WINDOW = 2
+
+
+@dataclass
+class DocumentIndex:
+    """
+    Everything built from one document that the query stage needs.
+    Built once per document and shared by every question asked against it.
+    """
+    doc_id: str
+    chunks: List[dict]
+    vectors: VectorMatrix
+    bm25: BM25Retriever
+    retriever: VectorStore
+    stats: dict = field(default_factory=dict)
+    _rows_by_text: Optional[dict] = field(default=None, repr=False)
+
+    def row_of(self, payload: dict) -> Optional[int]:
+        """
+        Row in chunks/vectors for a vector-store hit payload. Uses the stored
+        chunk_index, falling back to a text lookup for points written without it.
+        """
+        row = payload.get("chunk_index")
+        if row is not None and row < len(self.chunks) and self.chunks[row]["text"] == payload.get("text"):
+            return row
+        if self._rows_by_text is None:
+            self._rows_by_text = {c["text"]: i for i, c in enumerate(self.chunks)}
+        return self._rows_by_text.get(payload.get("text"))
+
+
+@traced("chunk")
+def chunk_clauses(clauses: list[dict], max_tokens: int = 1000, overlap: int = 100,
+                  strategy: str = CHUNK_STRATEGY) -> list[dict]:
+    """
+    Splits clauses longer than max_tokens into parts, encoding all clause
+    texts in one batch. strategy "tokens" cuts fixed token windows with
+    overlap; "structure" prefers paragraph, then sentence, boundaries.
+    """
+    texts = [clause["text"] for clause in clauses]
+    if strategy == "structure":
+        chunked_texts = semantic_chunk_texts(texts, max_tokens=max_tokens, overlap=overlap)
+    else:
+        chunked_texts = chunk_texts_by_tokens(texts, max_tokens=max_tokens, overlap=overlap)
+    chunked_clauses = []
+    for clause, chunks in zip(clauses, chunked_texts):
+        for idx, chunk in enumerate(chunks):
+            chunked_clauses.append({
+                "section": f"{clause['section']} (Part {idx+1})" if len(chunks) > 1 else clause['section'],
+                "text": chunk,
+                "page": clause.get("page"),
+            })
+    return chunked_clauses
+
+
+async def _finish_index(doc_id: str, chunked_clauses: list[dict], chunk_vectors, stats: dict) -> DocumentIndex:
+    # Entries cached before compact storage hold a float32 array
+    chunk_vectors = VectorMatrix.encode(chunk_vectors, VECTOR_STORAGE_DTYPE)
+    if index_store is not None:
+        # Written once, then served from the mapped files like in every other worker
+        with span("bm25_index"):
+            bm25 = BM25Retriever()
+            bm25.index(chunked_clauses)
+        try:
+            with span("index_save"):
+                await io_pool.run(index_store.save, doc_id, INDEX_TAG, chunked_clauses, chunk_vectors, bm25, stats)
+        except OSError as e:
+            print(f"Index store write for {doc_id} failed, keeping the index in memory: {e}")
+        else:
+            index = await _load_mapped(doc_id, stats)
+            if index is not None:
+                return index
+
+    store = get_vector_store(doc_id)
+    with span("vector_upsert"):
+        await store.upsert_vectors(chunk_vectors, chunked_clauses)
+
+    with span("bm25_index"):
+        bm25 = get_bm25_index(doc_id, chunked_clauses)
+
+    return DocumentIndex(
+        doc_id=doc_id,
+        chunks=chunked_clauses,
+        vectors=chunk_vectors,
+        bm25=bm25,
+        retriever=store,
+        stats=stats,
+    )
+
+
+async def _load_mapped(doc_id: str, stats: Optional[dict] = None) -> Optional[DocumentIndex]:
+    """
+    The document's index memory-mapped from the index store, or None if it
+    has not been stored. stats defaults to the stored ingest stats.
+    """
+    with span("index_load"):
+        artifacts = await io_pool.run(index_store.load, doc_id, INDEX_TAG)
+    if artifacts is None:
+        return None
+    chunks, vectors, bm25, stored_stats = artifacts
+    store = get_vector_store(doc_id)
+    with span("vector_upsert"):
+        await store.upsert_vectors(vectors, chunks)
+    return DocumentIndex(
+        doc_id=doc_id,
+        chunks=chunks,
+        vectors=vectors,
+        bm25=bm25,
+        retriever=store,
+        stats=stats if stats is not None else {**stored_stats, "cached": True},
+    )
+
+
+def _report(progress: Optional[dict], **fields):
+    if progress is not None:
+        progress.update(fields)
+
+
+class _EmbedCounts:
+    """
+    Chunks of one ingest taken from the embedding store vs. run through the
+    model, also counted into progress["chunks_embedded"] when given.
+    """
+    def __init__(self, progress: Optional[dict] = None):
+        self.hits = 0
+        self.embedded = 0
+        self.progress = progress
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        vectors, hits = await embed_with_store(texts, kind="passage")
+        self.hits += hits
+        self.embedded += len(texts) - hits
+        _report(self.progress, chunks_embedded=self.hits + self.embedded)
+        return vectors
+
+    def stats(self) -> dict:
+        looked_up = self.hits + self.embedded
+        return {"embedding_hits": self.hits, "embedded": self.embedded,
+                "embedding_hit_ratio": round(self.hits / looked_up, 3) if looked_up else 0.0}
+
+
+async def _embed_or_fetch(store: VectorStore, chunked_clauses: list[dict], counts: _EmbedCounts) -> np.ndarray:
+    """
+    Vectors for chunks of a document the vector store already holds (e.g. after the
+    document cache evicted it): reuse stored vectors, embed only the rest.
+    """
+    ids = store.point_ids(chunked_clauses)
+    with span("vector_fetch"):
+        stored = await store.fetch_vectors(list(dict.fromkeys(ids)))
+    missing = [i for i, pid in enumerate(ids) if pid not in stored]
+    vectors = np.zeros((len(chunked_clauses), get_vector_dim()), dtype=np.float32)
+    for i, pid in enumerate(ids):
+        if pid in stored:
+            vectors[i] = stored[pid]
+    if missing:
+        vectors[missing] = await counts.embed([chunked_clauses[i]["text"] for i in missing])
+    return vectors
+
+
+async def _cache_chunks(doc_id: str, clauses: list[dict], chunked_clauses: list[dict],
+                        chunk_vectors: VectorMatrix):
+    # With the index store on, chunks and vectors are kept there instead
+    if index_store is None:
+        await io_pool.run(functools.partial(
+            document_cache.update, doc_id, clauses=clauses, chunks=chunked_clauses, vectors=chunk_vectors,
+            vectors_model=EMBEDDING_MODEL_TAG, chunking=CHUNKING_TAG,
+        ))
+
+
+async def _cached_chunks(doc_id: str):
+    entry = await io_pool.run(document_cache.get, doc_id) or {}
+    if ("clauses" in entry and "chunks" in entry and entry.get("vectors_model") == EMBEDDING_MODEL_TAG
+            and entry.get("chunking") == CHUNKING_TAG):
+        return entry
+    return None
+
+
+async def build_document_index(clauses: list[dict], doc_id: str) -> DocumentIndex:
+    """
+    Ingestion stage for already-split clauses: chunk, embed, upsert into the vector store
+    and build BM25 once. Chunks and vectors are reused from the document cache
+    when this doc_id was ingested before.
+    """
+    if index_store is not None:
+        index = await _load_mapped(doc_id)
+        if index is not None:
+            return index
+    entry = await _cached_chunks(doc_id)
+    if entry is not None:
+        stats = {"num_clauses": len(entry["clauses"]), "num_chunks": len(entry["chunks"]), "cached": True}
+        return await _finish_index(doc_id, entry["chunks"], entry["vectors"], stats)
+
+    chunked_clauses = chunk_clauses(clauses)
+    store = get_vector_store(doc_id)
+    counts = _EmbedCounts()
+    if await store.count() > 0:
+        chunk_vectors = await _embed_or_fetch(store, chunked_clauses, counts)
+    else:
+        chunk_vectors = await counts.embed([c["text"] for c in chunked_clauses])
+    chunk_vectors = VectorMatrix.encode(chunk_vectors, VECTOR_STORAGE_DTYPE)
+    await _cache_chunks(doc_id, clauses, chunked_clauses, chunk_vectors)
+    stats = {"num_clauses": len(clauses), "num_chunks": len(chunked_clauses), "cached": False, **counts.stats()}
+    return await _finish_index(doc_id, chunked_clauses, chunk_vectors, stats)
+
+
+@traced("ingest")
+async def ingest_document(blob_or_text: str, progress: Optional[dict] = None) -> DocumentIndex:
+    """
+    Streaming ingestion: pages are extracted in a process pool and, as they
+    arrive, split into clauses, chunked and handed to the embedder, so
+    embedding of early pages overlaps with extraction of later ones.
+
+    progress, if given, is updated in place with "stage" ("downloading",
+    "waiting", "extracting", "embedding", "indexing"), "pages_done", "num_pages" (once
+    known), "chunks" and "chunks_embedded".
+
+    Raises ValueError if the document cannot be downloaded (DownloadError)
+    or has no text or no clauses.
+    """
+    _report(progress, stage="downloading")
+    doc = await doc_parser.open_document(blob_or_text)
+    try:
+        return await _ingest_source(doc, progress)
+    finally:
+        # Drops the downloaded PDF even if ingestion failed part way
+        doc.close()
+
+
+@traced("ingest")
+async def ingest_file(path: str, progress: Optional[dict] = None) -> DocumentIndex:
+    """
+    ingest_document for a local PDF (see doc_parser.open_file).
+    """
+    _report(progress, stage="reading")
+    doc = await doc_parser.open_file(path)
+    try:
+        return await _ingest_source(doc, progress)
+    finally:
+        doc.close()
+
+
+async def _ingest_source(doc: doc_parser.SourceDocument, progress: Optional[dict] = None) -> DocumentIndex:
+    if index_store is None:
+        return await _build_from_source(doc, progress)
+    # Locked by content hash, so a document reached through several URLs (or
+    # by several worker processes) is ingested by one owner while the others
+    # wait, then map what it stored
+    async with index_store.ingest_lock(doc.doc_id, on_wait=lambda: _report(progress, stage="waiting")):
+        return await _build_from_source(doc, progress)
+
+
+async def _build_from_source(doc: doc_parser.SourceDocument, progress: Optional[dict] = None) -> DocumentIndex:
+    if index_store is not None:
+        index = await _load_mapped(doc.doc_id)
+        if index is not None:
+            _report(progress, stage="indexing", num_pages=doc.meta.get("num_pages"), chunks=len(index.chunks))
+            return index
+    entry = await _cached_chunks(doc.doc_id)
+    if entry is not None:
+        _report(progress, stage="indexing", num_pages=doc.meta.get("num_pages"), chunks=len(entry["chunks"]))
+        stats = {"num_clauses": len(entry["clauses"]), "num_chunks": len(entry["chunks"]), "cached": True}
+        return await _finish_index(doc.doc_id, entry["chunks"], entry["vectors"], stats)
+
+    # If the vector store already holds this document, embedding is deferred
+    # until all chunks are known so stored vectors can be reused
+    store = get_vector_store(doc.doc_id)
+    previously_indexed = await store.count() > 0
+
+    stream = ClauseSegmenter()
+    counts = _EmbedCounts(progress)
+    clauses, chunked_clauses = [], []
+    # Chunk texts are embedded in EMBED_BATCH_SIZE batches, at most
+    # _EMBED_WINDOW at a time, waiting for the oldest when the window is full
+    unsubmitted, window, embedded = [], deque(), []
+    _report(progress, stage="extracting", pages_done=0, num_pages=doc.meta.get("num_pages"), chunks=0,
+            chunks_embedded=0)
+
+    async def submit(texts: list[str]):
+        if len(window) >= _EMBED_WINDOW:
+            embedded.append(await window.popleft())
+        window.append(asyncio.ensure_future(counts.embed(texts)))
+
+    async def add(new_clauses: list[dict]):
+        if not new_clauses:
+            return
+        new_chunks = chunk_clauses(new_clauses)
+        clauses.extend(new_clauses)
+        chunked_clauses.extend(new_chunks)
+        _report(progress, chunks=len(chunked_clauses))
+        if previously_indexed:
+            return
+        unsubmitted.extend(c["text"] for c in new_chunks)
+        while len(unsubmitted) >= EMBED_BATCH_SIZE:
+            await submit(unsubmitted[:EMBED_BATCH_SIZE])
+            del unsubmitted[:EMBED_BATCH_SIZE]
+
+    try:
+        async for page_no, page_text in doc_parser.iter_pages(doc):
+            with span("split"):
+                new_clauses = stream.feed(page_no, page_text)
+            await add(new_clauses)
+            _report(progress, pages_done=page_no, num_pages=doc.meta.get("num_pages"))
+        with span("split"):
+            new_clauses = stream.close()
+        await add(new_clauses)
+
+        if not doc.text or not doc.text.strip():
+            raise ValueError("Document text is empty.")
+        if not clauses:
+            raise ValueError("No clauses found in document.")
+
+        _report(progress, stage="embedding")
+        if previously_indexed:
+            chunk_vectors = await _embed_or_fetch(store, chunked_clauses, counts)
+        else:
+            if unsubmitted:
+                await submit(unsubmitted)
+            while window:
+                embedded.append(await window.popleft())
+            chunk_vectors = np.vstack(embedded)
+    finally:
+        for task in window:
+            task.cancel()
+        await asyncio.gather(*window, return_exceptions=True)
+    chunk_vectors = VectorMatrix.encode(chunk_vectors, VECTOR_STORAGE_DTYPE)
+    await _cache_chunks(doc.doc_id, clauses, chunked_clauses, chunk_vectors)
+    stats = {"num_pages": doc.meta.get("num_pages"), "num_clauses": len(clauses), "num_chunks": len(chunked_clauses),
+             "cached": False, **counts.stats()}
+    print(f"Ingested {doc.doc_id}: {len(chunked_clauses)} chunks, {counts.hits} from the embedding store "
+          f"({stats['embedding_hit_ratio']:.0%}), {counts.embedded} embedded")
+    _report(progress, stage="indexing")
+    return await _finish_index(doc.doc_id, chunked_clauses, chunk_vectors, stats)
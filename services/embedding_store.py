@@ -0,0 +1,321 @@
+# services/embedding_store.py
+"""
+Persistent embedding store shared across documents and processes.
+
+Insurance policies repeat a lot of boilerplate (definitions, exclusions,
+claim procedures), so many chunks of a new policy were already embedded for
+another one. Vectors are keyed by a hash of the whitespace-normalized text,
+its kind ("query" or "passage") and the embedding model tag, and each model
+tag and vector dtype gets its own directory under EMBEDDING_STORE_DIR holding:
+
+- index.sqlite3: key -> row number (WAL mode, so readers are not blocked by
+  a writer in another process)
+- vectors.bin: rows of float16 (float32 when VECTOR_STORAGE_DTYPE is
+  float32), append-only and read through a memory map
+
+Writers hold an exclusive lock on the directory's lock file while they append
+rows and record them. Rows are appended before the index commits, so a crash
+in between leaves unreferenced rows, never a key without its vector.
+
+When the vector file grows past EMBEDDING_STORE_MAX_BYTES, the writer copies
+the most recently added rows, up to half the limit, into a new file
+(vectors.<generation>.bin), renumbers the index and deletes the old file.
+Readers look up rows and the generation in one transaction, and a process
+still mapping the old file keeps reading it until it remaps.
+"""
+import fcntl
+import glob
+import hashlib
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+from core.config import EMBEDDING_STORE_DIR, EMBEDDING_STORE_MAX_BYTES, VECTOR_STORAGE_DTYPE
+from core.executors import io_pool
+from core.metrics import register_stats, span
+from services.embeddings import EMBEDDING_MODEL_TAG, embed_many_async
+
+# SQLite's default limit on bound parameters is 999 in older builds
+_LOOKUP_BATCH = 500
+
+# Rows copied at a time during compaction
+_COMPACT_BATCH = 65536
+
+
+@contextmanager
+def _file_lock(path: str):
+    with open(path, "a+b") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingStore:
+    def __init__(self, root: str = EMBEDDING_STORE_DIR, model_tag: str = EMBEDDING_MODEL_TAG,
+                 dtype: str = "float32" if VECTOR_STORAGE_DTYPE == "float32" else "float16",
+                 max_bytes: int = EMBEDDING_STORE_MAX_BYTES):
+        self.model_tag = model_tag
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        # Rows of another dtype have another size: each gets its own directory
+        directory_tag = f"{model_tag}\0{self.dtype.name}"
+        self.directory = os.path.join(root, hashlib.sha256(directory_tag.encode("utf-8")).hexdigest()[:16])
+        self._local = threading.local()  # one SQLite connection per thread
+        self._map: Optional[np.memmap] = None
+        self._map_generation = 0
+        self._map_lock = threading.Lock()
+        self._dim: Optional[int] = None
+        self._counter_lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "inserted": 0, "compactions": 0}
+
+    def key(self, text: str, kind: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{self.model_tag}\0{kind}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _vectors_path(self, generation: int) -> str:
+        return self._path(f"vectors.{generation}.bin" if generation else "vectors.bin")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self._path("index.sqlite3"), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, row INTEGER NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _get_dim(self, conn: sqlite3.Connection) -> Optional[int]:
+        if self._dim is None:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+            self._dim = int(row[0]) if row else None
+        return self._dim
+
+    @staticmethod
+    def _get_generation(conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _vectors(self, dim: int, generation: int, needed: int) -> Optional[np.memmap]:
+        """
+        The generation's vector file mapped read-only, remapped when rows past
+        the current mapping (appended since, possibly by another process) are
+        needed or the store has been compacted.
+        """
+        with self._map_lock:
+            if self._map is None or self._map_generation != generation or len(self._map) < needed:
+                path = self._vectors_path(generation)
+                rows = os.path.getsize(path) // (dim * self.dtype.itemsize)
+                self._map = np.memmap(path, dtype=self.dtype, mode="r", shape=(rows, dim)) if rows else None
+                self._map_generation = generation
+            return self._map
+
+    def _count(self, hits: int, misses: int, inserted: int = 0, compactions: int = 0):
+        with self._counter_lock:
+            self.counters["hits"] += hits
+            self.counters["misses"] += misses
+            self.counters["inserted"] += inserted
+            self.counters["compactions"] += compactions
+
+    def get_many(self, texts: list[str], kind: str) -> tuple[list[int], np.ndarray]:
+        """
+        Looks up all texts at once. Returns the positions in texts that were
+        found, ascending, and their vectors as a (len(found), dim) float32 matrix.
+        """
+        conn = self._connection()
+        dim = self._get_dim(conn)
+        keys = [self.key(t, kind) for t in texts]
+        rows, generation = {}, 0
+        if dim is not None:
+            unique = list(dict.fromkeys(keys))
+            # One read transaction, so the rows belong to the generation read
+            conn.execute("BEGIN")
+            try:
+                generation = self._get_generation(conn)
+                for start in range(0, len(unique), _LOOKUP_BATCH):
+                    part = unique[start:start + _LOOKUP_BATCH]
+                    rows.update(conn.execute(
+                        f"SELECT key, row FROM vectors WHERE key IN ({','.join('?' * len(part))})", part
+                    ))
+            finally:
+                conn.commit()
+        found = [i for i, k in enumerate(keys) if k in rows]
+        vectors = np.zeros((0, dim or 0), dtype=np.float32)
+        if found:
+            wanted = np.array([rows[keys[i]] for i in found], dtype=np.int64)
+            try:
+                mapped = self._vectors(dim, generation, int(wanted.max()) + 1)
+            except FileNotFoundError:
+                # Compacted away since the rows were read
+                mapped = None
+            # Rows past the end of the file (lost in an OS crash) count as misses
+            available = len(mapped) if mapped is not None else 0
+            found = [i for i, row in zip(found, wanted) if row < available]
+            if found:
+                vectors = np.asarray(mapped[wanted[wanted < available]], dtype=np.float32)
+        self._count(len(found), len(texts) - len(found))
+        return found, vectors
+
+    def put_many(self, texts: list[str], kind: str, vectors: np.ndarray):
+        """
+        Appends vectors for texts not stored yet (by this or another process).
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(texts):
+            return
+        conn = self._connection()
+        by_key = {}
+        for i, text in enumerate(texts):
+            by_key.setdefault(self.key(text, kind), i)
+        with _file_lock(self._path("lock")):
+            dim = self._get_dim(conn)
+            if dim is None:
+                conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('dim', ?)", (str(vectors.shape[1]),))
+                conn.commit()
+                dim = self._get_dim(conn)
+            if vectors.shape[1] != dim:
+                raise ValueError(f"Embedding store holds {dim}-dim vectors, got {vectors.shape[1]}")
+
+            keys = list(by_key)
+            for start in range(0, len(keys), _LOOKUP_BATCH):
+                part = keys[start:start + _LOOKUP_BATCH]
+                for (key,) in conn.execute(
+                    f"SELECT key FROM vectors WHERE key IN ({','.join('?' * len(part))})", part
+                ):
+                    del by_key[key]
+            if not by_key:
+                return
+
+            generation = self._get_generation(conn)
+            row_bytes = dim * self.dtype.itemsize
+            with open(self._vectors_path(generation), "ab") as f:
+                size = f.seek(0, os.SEEK_END)
+                if size % row_bytes:
+                    # A partial row left by a crashed writer
+                    size -= size % row_bytes
+                    f.truncate(size)
+                first_row = size // row_bytes
+                f.write(np.ascontiguousarray(vectors[list(by_key.values())], dtype=self.dtype).tobytes())
+            conn.executemany(
+                "INSERT OR IGNORE INTO vectors (key, row) VALUES (?, ?)",
+                [(key, first_row + n) for n, key in enumerate(by_key)],
+            )
+            conn.commit()
+            self._count(0, 0, len(by_key))
+            if self.max_bytes and (first_row + len(by_key)) * row_bytes > self.max_bytes:
+                self._compact(conn, dim, generation)
+
+    def _compact(self, conn: sqlite3.Connection, dim: int, generation: int):
+        """
+        Moves the most recently added rows, up to half of max_bytes, to the
+        next generation's vector file. Called with the write lock held.
+        """
+        row_bytes = dim * self.dtype.itemsize
+        old_path = self._vectors_path(generation)
+        total = os.path.getsize(old_path) // row_bytes
+        keep = min(total, self.max_bytes // 2 // row_bytes)
+        kept = conn.execute(
+            "SELECT key, row FROM vectors WHERE row >= ? AND row < ? ORDER BY row", (total - keep, total)
+        ).fetchall()
+        old = np.memmap(old_path, dtype=self.dtype, mode="r", shape=(total, dim))
+        new_path = self._vectors_path(generation + 1)
+        with open(new_path + ".tmp", "wb") as f:
+            for start in range(0, len(kept), _COMPACT_BATCH):
+                part = [row for _, row in kept[start:start + _COMPACT_BATCH]]
+                f.write(np.ascontiguousarray(old[part]).tobytes())
+        del old
+        os.replace(new_path + ".tmp", new_path)
+        conn.execute("DELETE FROM vectors")
+        conn.executemany("INSERT INTO vectors (key, row) VALUES (?, ?)",
+                         [(key, n) for n, (key, _) in enumerate(kept)])
+        conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('generation', ?)", (str(generation + 1),))
+        conn.commit()
+        # Processes that mapped the old file keep their mapping
+        os.remove(old_path)
+        print(f"Embedding store compacted from {total} to {len(kept)} vectors")
+        self._count(0, 0, compactions=1)
+
+    def clear(self):
+        """
+        Drops every stored vector (for benchmarks that need a cold start).
+        """
+        if not os.path.isdir(self.directory):
+            return
+        conn = self._connection()
+        with _file_lock(self._path("lock")):
+            conn.execute("DELETE FROM vectors")
+            conn.execute("DELETE FROM meta")
+            conn.commit()
+            # Removed rather than truncated, so other processes' mappings stay valid
+            for path in glob.glob(self._path("vectors*.bin")):
+                os.remove(path)
+            with self._map_lock:
+                self._map = None
+            self._dim = None
+        with self._counter_lock:
+            for key in self.counters:
+                self.counters[key] = 0
+
+    def stats(self) -> dict:
+        with self._counter_lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            stats = {**self.counters, "hit_rate": self.counters["hits"] / lookups if lookups else 0.0}
+        stats["bytes"] = 0
+        for path in glob.glob(self._path("vectors*.bin")):
+            try:
+                stats["bytes"] += os.path.getsize(path)
+            except OSError:
+                pass
+        return stats
+
+
+# None when EMBEDDING_STORE_DIR is empty
+embedding_store = EmbeddingStore() if EMBEDDING_STORE_DIR else None
+if embedding_store is not None:
+    register_stats("embedding_store", embedding_store.stats, counters=("hits", "misses", "inserted", "compactions"))
+
+
+async def embed_with_store(texts: list[str], kind: str = "passage") -> tuple[np.ndarray, int]:
+    """
+    Like embed_many_async, but only texts missing from the embedding store
+    are embedded, and their vectors are added to it. Also returns how many
+    texts came from the store. If the store cannot be read or written, texts
+    are embedded as if it were empty.
+    """
+    if embedding_store is None or not texts:
+        return await embed_many_async(texts, kind), 0
+
+    found, found_vectors = [], None
+    try:
+        with span("embedding_store"):
+            found, found_vectors = await io_pool.run(embedding_store.get_many, texts, kind)
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"Embedding store lookup failed, embedding all {len(texts)} texts: {e}")
+    if len(found) == len(texts):
+        return found_vectors, len(found)
+
+    found_set = set(found)
+    missing = [i for i in range(len(texts)) if i not in found_set]
+    new_vectors = await embed_many_async([texts[i] for i in missing], kind)
+    vectors = np.empty((len(texts), new_vectors.shape[1]), dtype=np.float32)
+    vectors[missing] = new_vectors
+    if found:
+        vectors[found] = found_vectors
+    try:
+        with span("embedding_store"):
+            await io_pool.run(embedding_store.put_many, [texts[i] for i in missing], kind, new_vectors)
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"Embedding store write failed: {e}")
+    return vectors, len(found)
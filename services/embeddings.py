@@ -17,18 +17,204 @@ async def embed_text_async(text: str) -> list[float]:
     return vector
 """
 import asyncio
-from sentence_transformers import SentenceTransformer
-from functools import lru_cache
+import os
+import threading
+import numpy as np
 
-# Load once
-model = SentenceTransformer("intfloat/e5-small-v2")
-VECTOR_DIM = model.get_sentence_embedding_dimension()
+from core.config import (
+    EMBEDDING_MODEL_NAME, EMBED_BATCH_SIZE, EMBED_MAX_WAIT_MS, EMBED_BACKEND, EMBED_THREADS, EMBED_ONNX_DIR,
+    EMBED_QUANTIZATION,
+)
+from core.executors import inference_pool
+from core.metrics import detach, register_stats, span, traced
 
-@lru_cache(maxsize=10000)
-def embed_text_cached(text: str) -> list[float]:
-    return model.encode(text, normalize_embeddings=True).tolist()
+# Loaded on first use (or by the startup warmup), not at import: importing
+# torch and loading the weights takes seconds
+_model = None
+_model_lock = threading.Lock()
+
+
+def _onnx_model_kwargs(threads: int) -> dict:
+    kwargs = {"provider": "CPUExecutionProvider"}
+    if threads:
+        import onnxruntime  # optional: only needed for the onnx backends
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        kwargs["session_options"] = options
+    return kwargs
+
+
+def _quantized_model_dir(model_name: str, quantization: str) -> str:
+    """
+    Directory holding model_name exported to ONNX with int8 weights, created
+    on first use: quantizing takes a minute, so it is done once per machine.
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    path = os.path.join(EMBED_ONNX_DIR, f"{model_name.replace('/', '__')}-qint8-{quantization}")
+    if not os.path.exists(os.path.join(path, "onnx", f"model_qint8_{quantization}.onnx")):
+        model = SentenceTransformer(model_name, backend="onnx")
+        model.save(path)
+        export_dynamic_quantized_onnx_model(model, quantization, path)
+    return path
+
+
+def load_model(backend: str = EMBED_BACKEND, threads: int = EMBED_THREADS, model_name: str = EMBEDDING_MODEL_NAME):
+    """
+    A new SentenceTransformer for backend "torch", "onnx" or "onnx-int8",
+    running inference on threads intra-op threads (0 = library default).
+    """
+    from sentence_transformers import SentenceTransformer
+    if backend == "torch":
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        return SentenceTransformer(model_name)
+    if backend == "onnx":
+        return SentenceTransformer(model_name, backend="onnx", model_kwargs=_onnx_model_kwargs(threads))
+    if backend == "onnx-int8":
+        return SentenceTransformer(
+            _quantized_model_dir(model_name, EMBED_QUANTIZATION), backend="onnx",
+            model_kwargs={**_onnx_model_kwargs(threads), "file_name": f"onnx/model_qint8_{EMBED_QUANTIZATION}.onnx"},
+        )
+    raise ValueError(f"Unknown EMBED_BACKEND: {backend!r}")
+
+
+def get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_model()
+    return _model
+
+
+def model_loaded() -> bool:
+    return _model is not None
+
+
+def get_vector_dim() -> int:
+    return get_model().get_sentence_embedding_dimension()
+
+# e5 models are trained with these prefixes; leaving them off hurts retrieval
+QUERY_PREFIX = "query: "
+PASSAGE_PREFIX = "passage: "
+
+# Identifies vectors produced by this model + prefixing scheme + inference
+# backend (and quantization target for int8, whose numerics differ), so
+# cached vectors from a different configuration are never mixed in
+EMBEDDING_MODEL_TAG = f"{EMBEDDING_MODEL_NAME}|e5-prefix|{EMBED_BACKEND}"
+if EMBED_BACKEND == "onnx-int8":
+    EMBEDDING_MODEL_TAG += f"|{EMBED_QUANTIZATION}"
+
+
+def _with_prefix(texts: list[str], kind: str) -> list[str]:
+    prefix = QUERY_PREFIX if kind == "query" else PASSAGE_PREFIX
+    return [prefix + t for t in texts]
+
+
+def embed_many(texts: list[str], kind: str = "passage", batch_size: int = EMBED_BATCH_SIZE,
+               model=None) -> np.ndarray:
+    """
+    Encodes texts in model-sized batches and returns a (len(texts), dim)
+    float32 matrix of L2-normalized vectors. kind is "query" or "passage".
+    model defaults to the shared model.
+    """
+    model = model or get_model()
+    if not texts:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    vectors = model.encode(
+        _with_prefix(texts, kind),
+        batch_size=batch_size,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=False,
+    )
+    return np.asarray(vectors, dtype=np.float32)
+
+
+@traced("embed")
+async def embed_many_async(texts: list[str], kind: str = "passage") -> np.ndarray:
+    # All model calls share the single inference worker
+    return await inference_pool.run(embed_many, texts, kind)
+
+
+class MicroBatcher:
+    """
+    Merges concurrent single-text embedding requests (from different questions
+    and HTTP requests) into one model.encode call. A batch is flushed when it
+    reaches batch_size or max_wait_ms after its first request, whichever is first.
+    """
+    def __init__(self, batch_size: int = EMBED_BATCH_SIZE, max_wait_ms: float = EMBED_MAX_WAIT_MS):
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = None
+        self._worker = None
+        self._loop = None
+        self.batches = 0
+        self.texts = 0
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def embed(self, text: str, kind: str) -> np.ndarray:
+        self._ensure_worker()
+        future = self._loop.create_future()
+        await self._queue.put((text, kind, future))
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize() if self._queue is not None else 0,
+                "batches": self.batches, "texts": self.texts}
+
+    async def _run(self):
+        # The worker outlives the request that started it: keep its model
+        # calls out of that request's trace
+        detach()
+        while True:
+            batch = await self._collect()
+            self.batches += 1
+            self.texts += len(batch)
+            for kind in {k for _, k, _ in batch}:
+                items = [(text, future) for text, k, future in batch if k == kind]
+                try:
+                    vectors = await embed_many_async([text for text, _ in items], kind)
+                except Exception as e:
+                    for _, future in items:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), vector in zip(items, vectors):
+                    if not future.done():
+                        future.set_result(vector)
+
+
+_batcher = MicroBatcher()
+register_stats("embedding_batcher", _batcher.stats, counters=("batches", "texts"))
 
-async def embed_text_async(text: str) -> list[float]:
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: embed_text_cached(text))
 
+async def embed_text_async(text: str, kind: str = "query") -> np.ndarray:
+    """
+    Embeds a single text through the shared micro-batcher.
+    """
+    with span(f"embed_{kind}"):
+        return await _batcher.embed(text, kind)
@@ -0,0 +1,169 @@
+# services/http_fetcher.py
+"""
+Shared async HTTP client for document downloads.
+
+One httpx.AsyncClient per event loop keeps connections alive between
+requests. Bodies are streamed to a temp file while being hashed, so a PDF
+is never held in memory and PyMuPDF workers open the file by path. The
+download is cut off with DownloadError past DOWNLOAD_MAX_BYTES.
+
+Concurrent fetches of the same URL (with the same conditional headers) share
+one download. Each caller gets a Download handle and must release() it; the
+temp file is removed once the last holder releases.
+"""
+import asyncio
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+
+from core.config import (
+    HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS,
+    DOWNLOAD_MAX_BYTES,
+)
+
+
+class DownloadError(ValueError):
+    """The document could not be downloaded (bad status, too large, timeout)."""
+
+
+@dataclass
+class FetchResult:
+    status_code: int
+    path: Optional[str] = None         # temp file with the body; None for 304
+    doc_id: Optional[str] = None       # content hash of the body, as doc_cache.content_hash
+    size: int = 0
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class _SharedDownload:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.refs = 0
+
+    def release(self):
+        self.refs -= 1
+        self.cleanup()
+
+    def cleanup(self, _=None):
+        # Also a done callback: every holder may have released (or been
+        # cancelled) before the download finished
+        if self.refs > 0 or not self.task.done() or self.task.cancelled() or self.task.exception() is not None:
+            return
+        path = self.task.result().path
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+class Download:
+    """A caller's handle on a (possibly shared) download."""
+    def __init__(self, shared: _SharedDownload):
+        self._shared = shared
+        self._released = False
+
+    async def result(self) -> FetchResult:
+        # shield: one caller being cancelled must not cancel the shared download
+        return await asyncio.shield(self._shared.task)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._shared.release()
+
+
+class DocumentFetcher:
+    def __init__(self, max_bytes: int = DOWNLOAD_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._loop = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight: dict[tuple, _SharedDownload] = {}
+        self.stats = {"downloads": 0, "shared": 0, "not_modified": 0, "bytes": 0}
+
+    def _bind_loop(self) -> httpx.AsyncClient:
+        # Pooled connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._inflight = {}
+            self._client = httpx.AsyncClient(
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+            )
+        return self._client
+
+    def fetch(self, url: str, headers: Optional[dict] = None) -> Download:
+        """
+        Starts (or joins) a download of url and returns a handle; await
+        handle.result() for the FetchResult and call handle.release() when
+        done with the file. Raises DownloadError from result().
+        """
+        client = self._bind_loop()
+        headers = headers or {}
+        key = (url, headers.get("If-None-Match"), headers.get("If-Modified-Since"))
+        shared = self._inflight.get(key)
+        if shared is None:
+            shared = _SharedDownload()
+            shared.task = self._loop.create_task(self._download(client, url, headers))
+            self._inflight[key] = shared
+            shared.task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            shared.task.add_done_callback(shared.cleanup)
+        else:
+            self.stats["shared"] += 1
+        # Counted before any await so the file cannot be removed under a joiner
+        shared.refs += 1
+        return Download(shared)
+
+    async def _download(self, client: httpx.AsyncClient, url: str, headers: dict) -> FetchResult:
+        try:
+            async with client.stream("GET", url, headers=headers) as resp:
+                if resp.status_code == 304:
+                    self.stats["not_modified"] += 1
+                    return FetchResult(304)
+                if resp.status_code >= 400:
+                    raise DownloadError(f"Could not download document: HTTP {resp.status_code} from {url}")
+                declared = resp.headers.get("Content-Length")
+                if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                    raise DownloadError(f"Document is larger than the {self.max_bytes} byte limit.")
+
+                fd, path = tempfile.mkstemp(suffix=".pdf")
+                digest = hashlib.sha256()
+                size = 0
+                try:
+                    # Local disk writes of network-sized chunks are cheap enough
+                    # to do on the loop
+                    with os.fdopen(fd, "wb") as f:
+                        async for chunk in resp.aiter_bytes():
+                            size += len(chunk)
+                            if size > self.max_bytes:
+                                raise DownloadError(f"Document is larger than the {self.max_bytes} byte limit.")
+                            digest.update(chunk)
+                            f.write(chunk)
+                except BaseException:
+                    os.remove(path)
+                    raise
+
+                self.stats["downloads"] += 1
+                self.stats["bytes"] += size
+                return FetchResult(
+                    resp.status_code, path=path, doc_id=digest.hexdigest()[:16], size=size,
+                    etag=resp.headers.get("ETag"), last_modified=resp.headers.get("Last-Modified"),
+                )
+        except httpx.TimeoutException:
+            raise DownloadError(f"Timed out downloading document from {url}")
+        except httpx.HTTPError as e:
+            raise DownloadError(f"Could not download document: {e}")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._loop = None
+
+
+document_fetcher = DocumentFetcher()
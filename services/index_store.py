@@ -0,0 +1,340 @@
+# services/index_store.py
+"""
+Per-document index artifacts shared by worker processes.
+
+With several web workers, each one holding its own chunks, vectors and BM25
+matrix for every document (and ingesting it separately) multiplies memory
+and work by the worker count. Instead, the first worker to ingest a document
+writes its query-time artifacts once under INDEX_STORE_DIR, and every worker
+memory-maps them read-only, so the pages are shared through the OS page
+cache:
+
+- vectors.npy (+ scales.npy for int8): the chunk embedding matrix
+- text.bin / text_offsets.npy, sections.bin / section_offsets.npy, pages.npy:
+  chunk text, section titles and page numbers
+- bm25_data.npy, bm25_indices.npy, bm25_indptr.npy, bm25_idf.npy,
+  bm25_terms.npy: the BM25 weight matrix (CSC) with its columns in term
+  order, so terms are looked up by binary search instead of a dict
+- meta.json: sizes, BM25 parameters and the ingest stats
+
+Each document's directory is written to a temporary directory and renamed
+into place, so readers see all of it or nothing. Directories live under a
+hash of the index tag (embedding model, chunking settings, vector dtype), so
+artifacts built with other settings are never read. Once the store passes
+INDEX_STORE_MAX_BYTES, each save removes the least recently loaded documents
+(renamed away first, then deleted); workers that mapped them keep their
+mappings.
+
+ingest_lock() elects the ingest owner: an exclusive lock on a per-document
+lock file, which the OS releases if the owner dies. The owner deletes the
+file before releasing it, so lock files do not pile up.
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections.abc import Sequence
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+import numpy as np
+from scipy import sparse
+
+from core.config import INDEX_STORE_DIR, INDEX_STORE_MAX_BYTES
+from core.metrics import register_stats
+from services.bm25_retriever import BM25Retriever
+from utils.vectors import VectorMatrix
+
+# How often a worker waiting for another worker's ingest checks the lock
+_LOCK_POLL_SECONDS = 0.25
+
+
+def _dir_bytes(directory: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+def _write_strings(directory: str, name: str, strings: list[str]):
+    blobs = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in blobs], out=offsets[1:])
+    with open(os.path.join(directory, f"{name}.bin"), "wb") as f:
+        f.write(b"".join(blobs))
+    np.save(os.path.join(directory, f"{name}_offsets.npy"), offsets)
+
+
+class _MappedStrings:
+    def __init__(self, directory: str, name: str):
+        path = os.path.join(directory, f"{name}.bin")
+        # An empty file cannot be mapped
+        self.data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.zeros(0, np.uint8)
+        self.offsets = np.load(os.path.join(directory, f"{name}_offsets.npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+
+class MappedChunks(Sequence):
+    """
+    Read-only list of chunk dicts ({"section", "text", "page"}) decoded on
+    access from the mapped files.
+    """
+    def __init__(self, directory: str):
+        self._text = _MappedStrings(directory, "text")
+        self._sections = _MappedStrings(directory, "sections")
+        self._pages = np.load(os.path.join(directory, "pages.npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self._text)
+
+    def __getitem__(self, i: int) -> dict:
+        if not -len(self) <= i < len(self):
+            raise IndexError("chunk index out of range")
+        i %= len(self)
+        page = int(self._pages[i])
+        return {"section": self._sections[i], "text": self._text[i], "page": page if page >= 0 else None}
+
+
+class _SortedVocab:
+    """
+    The dict interface BM25Retriever uses (get, in, []) over a sorted array
+    of terms; a term's column is its position.
+    """
+    def __init__(self, terms: np.ndarray):
+        self.terms = terms
+
+    def get(self, term: str, default=None):
+        key = term.encode("utf-8")
+        i = int(np.searchsorted(self.terms, key))
+        return i if i < len(self.terms) and self.terms[i] == key else default
+
+    def __contains__(self, term: str) -> bool:
+        return self.get(term) is not None
+
+    def __getitem__(self, term: str) -> int:
+        i = self.get(term)
+        if i is None:
+            raise KeyError(term)
+        return i
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+
+def _write_bm25(directory: str, bm25: BM25Retriever):
+    terms = sorted(bm25.vocab, key=bm25.vocab.get)  # by column
+    order = sorted(range(len(terms)), key=terms.__getitem__)
+    if bm25.weights is not None:
+        weights = bm25.weights[:, order].tocsc()
+        weights.sort_indices()
+        idf = bm25.idf[order]
+    else:
+        weights = sparse.csc_matrix((len(bm25.clauses), 0), dtype=np.float32)
+        idf = np.zeros(0, dtype=np.float32)
+    sorted_terms = [terms[c].encode("utf-8") for c in order]
+    width = max((len(t) for t in sorted_terms), default=1)
+    np.save(os.path.join(directory, "bm25_terms.npy"), np.array(sorted_terms, dtype=f"S{width}"))
+    np.save(os.path.join(directory, "bm25_data.npy"), weights.data.astype(np.float32))
+    np.save(os.path.join(directory, "bm25_indices.npy"), weights.indices.astype(np.int32))
+    np.save(os.path.join(directory, "bm25_indptr.npy"), weights.indptr.astype(np.int32))
+    np.save(os.path.join(directory, "bm25_idf.npy"), idf.astype(np.float32))
+
+
+def _read_bm25(directory: str, chunks: MappedChunks, meta: dict) -> BM25Retriever:
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(directory, f"bm25_{name}.npy"), mmap_mode="r")
+
+    vocab = _SortedVocab(load("terms"))
+    weights = idf = None
+    if len(vocab):
+        weights = sparse.csc_matrix((load("data"), load("indices"), load("indptr")),
+                                    shape=(len(chunks), len(vocab)), copy=False)
+        idf = load("idf")
+    params = meta["bm25"]
+    return BM25Retriever.from_index(chunks, vocab, weights, idf, params["k1"], params["b"], params["epsilon"])
+
+
+class IndexStore:
+    def __init__(self, root: str = INDEX_STORE_DIR, max_bytes: int = INDEX_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._counter_lock = threading.Lock()
+        self.counters = {"loads": 0, "saves": 0, "lock_waits": 0, "evictions": 0}
+
+    def _count(self, name: str):
+        with self._counter_lock:
+            self.counters[name] += 1
+
+    def _tag_dir(self, tag: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(tag.encode("utf-8")).hexdigest()[:16])
+
+    def has(self, doc_id: str, tag: str) -> bool:
+        return os.path.exists(os.path.join(self._tag_dir(tag), doc_id, "meta.json"))
+
+    def save(self, doc_id: str, tag: str, chunks: list[dict], vectors: VectorMatrix, bm25: BM25Retriever,
+             stats: dict):
+        """
+        Writes a document's artifacts unless another process already has.
+        """
+        if self.has(doc_id, tag):
+            return
+        parent = self._tag_dir(tag)
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        try:
+            np.save(os.path.join(tmp_dir, "vectors.npy"), vectors.data)
+            if vectors.scales is not None:
+                np.save(os.path.join(tmp_dir, "scales.npy"), vectors.scales)
+            _write_strings(tmp_dir, "text", [c["text"] for c in chunks])
+            _write_strings(tmp_dir, "sections", [c["section"] for c in chunks])
+            pages = [c.get("page") for c in chunks]
+            np.save(os.path.join(tmp_dir, "pages.npy"), np.array([-1 if p is None else p for p in pages], np.int32))
+            _write_bm25(tmp_dir, bm25)
+            meta = {"num_chunks": len(chunks), "dtype": vectors.dtype, "stats": stats,
+                    "bm25": {"k1": bm25.k1, "b": bm25.b, "epsilon": bm25.epsilon}}
+            with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            try:
+                os.rename(tmp_dir, os.path.join(parent, doc_id))
+            except OSError:
+                # Another process wrote the same document first
+                if not self.has(doc_id, tag):
+                    raise
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self._count("saves")
+        if self.max_bytes:
+            self._evict(keep=os.path.join(parent, doc_id))
+
+    def _evict(self, keep: str):
+        """
+        Removes the least recently loaded documents, of every tag, until the
+        store fits in max_bytes. keep (the document just saved) stays.
+        """
+        entries, total = [], 0
+        for tag_entry in os.scandir(self.root):
+            if tag_entry.name == "locks" or not tag_entry.is_dir():
+                continue
+            for entry in os.scandir(tag_entry.path):
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    size = _dir_bytes(entry.path)
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+                except OSError:
+                    continue  # removed by another process meanwhile
+                total += size
+        for _, size, directory in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if directory == keep:
+                continue
+            trash = os.path.join(os.path.dirname(directory), f".tmp-evicted-{os.path.basename(directory)}")
+            try:
+                os.rename(directory, trash)
+            except OSError:
+                continue
+            shutil.rmtree(trash, ignore_errors=True)
+            total -= size
+            self._count("evictions")
+
+    def load(self, doc_id: str, tag: str) -> Optional[tuple[MappedChunks, VectorMatrix, BM25Retriever, dict]]:
+        """
+        (chunks, vectors, bm25, stats) memory-mapped read-only, or None if the
+        document has not been saved (or its files are unreadable).
+        """
+        directory = os.path.join(self._tag_dir(tag), doc_id)
+        try:
+            with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            chunks = MappedChunks(directory)
+            data = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+            scales = np.load(os.path.join(directory, "scales.npy"), mmap_mode="r") if data.dtype == np.int8 else None
+            bm25 = _read_bm25(directory, chunks, meta)
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Index store entry {doc_id} is unreadable: {e}")
+            return None
+        if len(chunks) != meta["num_chunks"] or len(data) != len(chunks):
+            return None
+        try:
+            # The directory's mtime orders eviction
+            os.utime(directory)
+        except OSError:
+            pass
+        self._count("loads")
+        return chunks, VectorMatrix(data, scales), bm25, meta["stats"]
+
+    @asynccontextmanager
+    async def ingest_lock(self, key: str, on_wait: Optional[Callable[[], None]] = None):
+        """
+        Holds the exclusive ingest lock for key across processes. While another
+        process holds it, waits without blocking the event loop, calling
+        on_wait once.
+        """
+        lock_dir = os.path.join(self.root, "locks")
+        os.makedirs(lock_dir, exist_ok=True)
+        path = os.path.join(lock_dir, f"{key}.lock")
+        waited = False
+        while True:
+            f = open(path, "a+b")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                if not waited:
+                    waited = True
+                    self._count("lock_waits")
+                    if on_wait is not None:
+                        on_wait()
+                await asyncio.sleep(_LOCK_POLL_SECONDS)
+                continue
+            # The previous owner deleted the file before releasing it: lock
+            # the one now at the path instead
+            try:
+                current = os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                break
+            f.close()
+        try:
+            yield
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def clear(self):
+        """
+        Deletes every stored document (for benchmarks that need a cold start).
+        Processes that mapped them keep their mappings.
+        """
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                if name != "locks":
+                    shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        with self._counter_lock:
+            for key in self.counters:
+                self.counters[key] = 0
+
+    def stats(self) -> dict:
+        with self._counter_lock:
+            return dict(self.counters)
+
+
+# None when INDEX_STORE_DIR is empty
+index_store = IndexStore() if INDEX_STORE_DIR else None
+if index_store is not None:
+    register_stats("index_store", index_store.stats, counters=("loads", "saves", "lock_waits", "evictions"))
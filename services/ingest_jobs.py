@@ -0,0 +1,204 @@
+# services/ingest_jobs.py
+"""
+Background ingestion jobs.
+
+submit() registers a document and returns its job at once; INGEST_WORKERS
+worker tasks take jobs from a queue of at most INGEST_QUEUE_SIZE and run the
+ingest pipeline, which updates job.progress as pages are extracted and
+chunks embedded. Jobs are keyed by document id (a hash of the full URL, of
+the raw text, or of a local path), so submitting a document that is queued,
+running or ready returns the existing job. A failed job, or a ready URL job
+finished more than INGEST_REVALIDATE_SECONDS ago, is run again; its fetch
+revalidates the cached download, so an unchanged document is not parsed or
+embedded again. The INGEST_KEEP_JOBS most recently used finished jobs are
+kept, ready ones with their index.
+
+With the index store on, a job that has fetched its document waits
+("waiting" stage) while another job or worker process ingests the same
+content, then maps what it stored (see document_index._ingest_source).
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+import validators
+
+from core.config import INGEST_KEEP_JOBS, INGEST_QUEUE_SIZE, INGEST_REVALIDATE_SECONDS, INGEST_WORKERS
+from core.executors import PoolSaturatedError
+from core.metrics import Trace, attach, current_trace, detach, register_stats
+from services.doc_cache import content_hash
+from services.document_index import DocumentIndex, ingest_document, ingest_file
+
+
+def document_id(source: str, is_file: bool = False) -> str:
+    # URLs are kept whole: the query string can select the document
+    key = "file:" + os.path.abspath(source) if is_file else source.strip()
+    return content_hash(key.encode("utf-8"))
+
+
+@dataclass
+class IngestJob:
+    document_id: str
+    source: str = field(repr=False)
+    is_file: bool = False
+    status: str = "queued"  # "queued", "running", "ready" or "failed"
+    progress: dict = field(default_factory=lambda: {"stage": "queued"})
+    error: Optional[str] = None
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    index: Optional[DocumentIndex] = field(default=None, repr=False)
+    # Trace of the request that submitted the job: the ingest spans go there
+    trace: Optional[Trace] = field(default=None, repr=False)
+    _exception: Optional[BaseException] = field(default=None, repr=False)
+    _done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    async def wait(self) -> DocumentIndex:
+        """
+        The document's index once ingested; raises the ingest error if the job failed.
+        """
+        await self._done.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self.index
+
+    def to_dict(self) -> dict:
+        now = self.finished or time.time()
+        return {
+            "document_id": self.document_id,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "queued_s": round((self.started or now) - self.created, 3),
+            "elapsed_s": round(now - self.started, 3) if self.started else None,
+            "stats": self.index.stats if self.index is not None else None,
+        }
+
+
+class IngestQueue:
+    def __init__(self, workers: int = INGEST_WORKERS, max_queued: int = INGEST_QUEUE_SIZE,
+                 keep: int = INGEST_KEEP_JOBS, revalidate_seconds: float = INGEST_REVALIDATE_SECONDS):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.keep = keep
+        self.revalidate_seconds = revalidate_seconds
+        self.jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._queue = None
+        self._workers = []
+        self._loop = None
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Jobs left unfinished by the workers of a previous loop never complete
+            for doc_id in [d for d, job in self.jobs.items() if job.status in ("queued", "running")]:
+                del self.jobs[doc_id]
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._workers = []
+        self._workers = [w for w in self._workers if not w.done()]
+        while len(self._workers) < self.workers:
+            self._workers.append(loop.create_task(self._work()))
+
+    def _reusable(self, job: IngestJob) -> bool:
+        if job.status == "failed":
+            return False
+        if job.status == "ready" and not job.is_file and validators.url(job.source):
+            # The document behind the URL may have changed since
+            return time.time() - job.finished < self.revalidate_seconds
+        return True
+
+    def submit(self, source: str, is_file: bool = False) -> IngestJob:
+        """
+        The job for source, queued now unless one is already queued, running
+        or ready (and, for a URL, recent). Raises PoolSaturatedError when
+        INGEST_QUEUE_SIZE jobs are already waiting.
+        """
+        doc_id = document_id(source, is_file)
+        job = self.jobs.get(doc_id)
+        if job is not None and self._reusable(job):
+            self.jobs.move_to_end(doc_id)
+            return job
+
+        self._ensure_workers()
+        if self._queue.qsize() >= self.max_queued:
+            self.counters["rejected"] += 1
+            raise PoolSaturatedError("ingest", self.max_queued)
+        job = IngestJob(doc_id, source, is_file, trace=current_trace())
+        self.jobs[doc_id] = job
+        self.jobs.move_to_end(doc_id)
+        self.counters["submitted"] += 1
+        self._queue.put_nowait(job)
+        self._evict()
+        return job
+
+    def get(self, doc_id: str) -> Optional[IngestJob]:
+        job = self.jobs.get(doc_id)
+        if job is not None:
+            self.jobs.move_to_end(doc_id)
+        return job
+
+    def _evict(self):
+        finished = [d for d, job in self.jobs.items() if job.status in ("ready", "failed")]
+        for doc_id in finished[:max(0, len(finished) - self.keep)]:
+            del self.jobs[doc_id]
+
+    def clear(self):
+        """
+        Forgets finished jobs (queued and running ones are kept).
+        """
+        for doc_id in [d for d, job in self.jobs.items() if job.status in ("ready", "failed")]:
+            del self.jobs[doc_id]
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            # Spans of this job go to the trace of the request that submitted it
+            attach(job.trace)
+            try:
+                await self._run(job)
+            finally:
+                detach()
+
+    async def _run(self, job: IngestJob):
+        job.status = "running"
+        job.started = time.time()
+        try:
+            job.index = await self._ingest(job)
+        except BaseException as e:
+            job.status = "failed"
+            job.error = str(e) or type(e).__name__
+            job._exception = e
+            self.counters["failed"] += 1
+            if not isinstance(e, Exception):
+                raise
+            print(f"Ingest of {job.document_id} failed: {job.error}")
+        else:
+            job.status = "ready"
+            job.progress["stage"] = "done"
+            self.counters["completed"] += 1
+        finally:
+            job.finished = time.time()
+            job.trace = None
+            job._done.set()
+            self._evict()
+
+    async def _ingest(self, job: IngestJob) -> DocumentIndex:
+        ingest = ingest_file if job.is_file else ingest_document
+        return await ingest(job.source, progress=job.progress)
+
+    def stats(self) -> dict:
+        statuses = [job.status for job in self.jobs.values()]
+        return {**self.counters, **{s: statuses.count(s) for s in ("queued", "running", "ready", "failed")}}
+
+
+ingest_queue = IngestQueue()
+register_stats("ingest_jobs", ingest_queue.stats, counters=("submitted", "completed", "failed", "rejected"))
@@ -1,41 +1,265 @@
+"""
+Async LLM client.
+
+All LLM traffic goes through one LLMClient which:
+  - calls the backend natively async (no thread-pool hop per request),
+  - caps in-flight calls with a semaphore (LLM_MAX_CONCURRENCY),
+  - paces calls with token buckets sized to our quota (LLM_RPM requests and
+    LLM_TPM prompt tokens per minute; 0 disables a bucket),
+  - coalesces identical in-flight prompts into a single call,
+  - retries transient failures with full-jitter exponential backoff until
+    LLM_DEADLINE_SECONDS, and raises a structured LLMError otherwise.
+
+LLM_BACKEND=fake swaps Gemini for a deterministic local backend so the whole
+pipeline can run offline.
+"""
 import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
 import os
+from typing import Optional
 from dotenv import load_dotenv
 load_dotenv()
-from langchain_google_genai import ChatGoogleGenerativeAI
-from google.api_core.exceptions import ResourceExhausted
+
+from core.config import (
+    LLM_BACKEND, LLM_MAX_CONCURRENCY, LLM_RPM, LLM_TPM, LLM_MAX_RETRIES, LLM_BACKOFF_BASE_SECONDS,
+    LLM_BACKOFF_MAX_SECONDS, LLM_DEADLINE_SECONDS, LLM_REQUEST_TIMEOUT_SECONDS, LLM_FAKE_LATENCY_MS,
+)
+from core.metrics import register_stats, traced
+from utils.chunker import count_tokens
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-# Initialize LLM only if API key is provided
-if GOOGLE_API_KEY:
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash-lite",
-        temperature=0.0,
-        google_api_key=GOOGLE_API_KEY
-    )
-else:
-    llm = None
+if not GOOGLE_API_KEY and LLM_BACKEND == "gemini":
     print("Warning: GOOGLE_API_KEY not set. LLM functionality will be disabled.")
 
-async def get_llm_response_async(prompt: str) -> str:
-    if llm is None:
-        return "LLM functionality is disabled due to missing GOOGLE_API_KEY."
-    
-    loop = asyncio.get_event_loop()
-    response = await loop.run_in_executor(None, lambda: llm.invoke(prompt))
-    return response.content
-
-async def gemini_invoke_with_retry(prompt: str, max_retries=3, base_wait=2) -> str:
-    if llm is None:
-        return "LLM functionality is disabled due to missing GOOGLE_API_KEY."
-    
-    for attempt in range(max_retries):
+
+class LLMError(Exception):
+    """
+    Structured LLM failure. kind is one of "disabled", "quota", "timeout",
+    "unavailable" or "backend"; retryable says whether a later attempt could
+    succeed; attempts is how many calls were made.
+    """
+    def __init__(self, kind: str, message: str, retryable: bool = False, attempts: int = 0):
+        super().__init__(message)
+        self.kind = kind
+        self.retryable = retryable
+        self.attempts = attempts
+
+    def to_dict(self) -> dict:
+        return {"kind": self.kind, "message": str(self), "retryable": self.retryable, "attempts": self.attempts}
+
+
+class GeminiBackend:
+    """
+    Gemini through langchain. The client is built on first use (or by the
+    startup warmup) rather than at import, as the client libraries are slow
+    to import. Without GOOGLE_API_KEY every call fails with kind "disabled".
+    """
+    name = "gemini"
+
+    def __init__(self):
+        self._llm = None
+        self._lock = threading.Lock()
+
+    def get_llm(self):
+        if self._llm is None and GOOGLE_API_KEY:
+            with self._lock:
+                if self._llm is None:
+                    from langchain_google_genai import ChatGoogleGenerativeAI
+                    # LLMClient owns retries and timeouts: langchain's own
+                    # retries would spend extra requests per counted attempt
+                    self._llm = ChatGoogleGenerativeAI(
+                        model="gemini-2.5-flash-lite",
+                        temperature=0.0,
+                        google_api_key=GOOGLE_API_KEY,
+                        max_retries=0,
+                        timeout=LLM_REQUEST_TIMEOUT_SECONDS,
+                    )
+        return self._llm
+
+    async def generate(self, prompt: str) -> str:
+        from google.api_core.exceptions import (
+            ResourceExhausted, ServiceUnavailable, DeadlineExceeded, InternalServerError,
+        )
+        llm = self.get_llm()
+        if llm is None:
+            raise LLMError("disabled", "LLM functionality is disabled due to missing GOOGLE_API_KEY.")
         try:
-            return await get_llm_response_async(prompt)
-        except ResourceExhausted:
-            wait_time = base_wait * (2 ** attempt)
-            print(f"Gemini API quota exceeded. Retrying in {wait_time} seconds...")
-            await asyncio.sleep(wait_time)
-    return "Quota limit exceeded. Please try again later."
+            response = await llm.ainvoke(prompt)
+        except ResourceExhausted as e:
+            raise LLMError("quota", f"Gemini API quota exceeded: {e}", retryable=True)
+        except (ServiceUnavailable, DeadlineExceeded, InternalServerError) as e:
+            raise LLMError("unavailable", f"Gemini API unavailable: {e}", retryable=True)
+        return response.content
+
+
+class FakeLLMBackend:
+    """
+    Deterministic offline backend. Answers single prompts with the first
+    clause line after "Relevant Policy Clauses:" and multi-question prompts
+    with one numbered "Answer N:" line per "Question N:". fail_every > 0 makes
+    every n-th call raise a retryable quota error.
+    """
+    name = "fake"
+
+    def __init__(self, latency_ms: float = LLM_FAKE_LATENCY_MS, fail_every: int = 0):
+        self.latency = latency_ms / 1000.0
+        self.fail_every = fail_every
+        self.calls = 0
+
+    async def generate(self, prompt: str) -> str:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.fail_every and self.calls % self.fail_every == 0:
+            raise LLMError("quota", "Fake quota exceeded", retryable=True)
+
+        questions = re.findall(r"^Question (\d+): (.*)$", prompt, re.MULTILINE)
+        if questions:
+            return "\n".join(f"Answer {n}: Fake answer to: {q}" for n, q in questions)
+        match = re.search(r"Relevant Policy Clauses:\n(.*)", prompt)
+        return f"Fake answer based on: {match.group(1)[:200]}" if match else "Fake answer."
+
+
+class TokenBucket:
+    """
+    Async token bucket refilled continuously at per_minute / 60 per second,
+    holding at most one minute's worth. Only touched from the event loop, so
+    no lock is needed between the check and the take.
+    """
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1.0, deadline: Optional[float] = None):
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            wait = (amount - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise LLMError("timeout", "Rate limit wait would exceed the request deadline", retryable=True)
+            await asyncio.sleep(wait)
+
+
+def _make_backend():
+    if LLM_BACKEND == "fake":
+        return FakeLLMBackend()
+    return GeminiBackend()
+
+
+class LLMClient:
+    def __init__(self, backend=None, max_concurrency: int = LLM_MAX_CONCURRENCY, rpm: float = LLM_RPM,
+                 tpm: float = LLM_TPM):
+        self.backend = backend or _make_backend()
+        self.max_concurrency = max_concurrency
+        self.request_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.token_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self._loop = None
+        self._semaphore = None
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.stats = {"calls": 0, "coalesced": 0, "retries": 0, "errors": 0, "in_flight": 0}
+
+    def _bind_loop(self):
+        # Semaphore and in-flight tasks belong to one event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._inflight = {}
+
+    async def invoke(self, prompt: str, deadline_seconds: float = LLM_DEADLINE_SECONDS,
+                     max_retries: int = LLM_MAX_RETRIES) -> str:
+        """
+        Returns the model's text for prompt. Identical prompts already in
+        flight share one backend call. Raises LLMError.
+        """
+        self._bind_loop()
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._loop.create_task(self._invoke_with_retry(prompt, deadline_seconds, max_retries))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        # shield: one caller being cancelled must not cancel the shared call
+        return await asyncio.shield(task)
+
+    async def _invoke_with_retry(self, prompt: str, deadline_seconds: float, max_retries: int) -> str:
+        deadline = time.monotonic() + deadline_seconds
+        prompt_tokens = count_tokens(prompt) if self.token_bucket else 0
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await self._call_once(prompt, prompt_tokens, deadline)
+            except LLMError as e:
+                e.attempts = attempt
+                if not e.retryable or attempt > max_retries:
+                    self.stats["errors"] += 1
+                    raise
+                # Full jitter: uniform in [0, min(cap, base * 2^attempt)]
+                wait = random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+                if time.monotonic() + wait >= deadline:
+                    self.stats["errors"] += 1
+                    raise
+                self.stats["retries"] += 1
+                print(f"LLM {e.kind} error, retrying in {wait:.1f}s (attempt {attempt}/{max_retries})")
+                await asyncio.sleep(wait)
+
+    async def _call_once(self, prompt: str, prompt_tokens: int, deadline: float) -> str:
+        if self.request_bucket:
+            await self.request_bucket.acquire(1, deadline)
+        if self.token_bucket:
+            await self.token_bucket.acquire(prompt_tokens, deadline)
+        async with self._semaphore:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LLMError("timeout", "LLM request deadline exceeded", retryable=False)
+            self.stats["calls"] += 1
+            self.stats["in_flight"] += 1
+            try:
+                return await asyncio.wait_for(
+                    self.backend.generate(prompt), timeout=min(LLM_REQUEST_TIMEOUT_SECONDS, remaining)
+                )
+            except asyncio.TimeoutError:
+                raise LLMError("timeout", "LLM request timed out", retryable=True)
+            except LLMError:
+                raise
+            except Exception as e:
+                raise LLMError("backend", f"LLM backend error: {e}", retryable=False)
+            finally:
+                self.stats["in_flight"] -= 1
+
+
+llm_client = LLMClient()
+register_stats("llm", lambda: llm_client.stats, counters=("calls", "coalesced", "retries", "errors"))
+
+
+async def get_llm_response_async(prompt: str) -> str:
+    """
+    Single attempt, no retries. Raises LLMError.
+    """
+    return await llm_client.invoke(prompt, max_retries=0)
+
 
+@traced("llm")
+async def gemini_invoke_with_retry(prompt: str, max_retries: int = LLM_MAX_RETRIES) -> str:
+    """
+    The shared client with jittered retries up to the deadline. Raises LLMError.
+    """
+    return await llm_client.invoke(prompt, max_retries=max_retries)
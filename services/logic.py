@@ -1,14 +1,16 @@
 from services.embeddings import embed_text_async
-from services.vector_store import QdrantIndexer, QdrantRetriever, doc_hash
-from services.bm25_retriever import BM25Retriever
+from services.document_index import DocumentIndex
 from services.llm_service import gemini_invoke_with_retry
+from services.answer_cache import answer_cache
 from services.explain import make_explanation
-from services.reranker import rerank_by_cosine_similarity
-from utils.chunker import chunk_text_by_tokens
-from typing import List
-from collections import defaultdict
-
-bm25_retriever = BM25Retriever()
+from services.reranker import rerank
+from services.context_packer import pack_context
+from core.config import LLM_BATCH_MAX_PROMPT_TOKENS, LLM_BATCH_MAX_QUESTIONS
+from core.metrics import PROMPT_TOKENS, for_question, question, span
+from utils.chunker import count_tokens
+from typing import List, Optional
+import asyncio
+import re
 
 def compose_prompt_multi(questions: List[str], contexts: List[List[str]]) -> str:
     prompt = (
@@ -19,64 +21,56 @@ def compose_prompt_multi(questions: List[str], contexts: List[List[str]]) -> str
     for i, (q, ctx_chunks) in enumerate(zip(questions, contexts), start=1):
         combined_context = "\n\n".join(ctx_chunks)
         prompt += (
-            f"Question {i}: {q}\nContext:\n{combined_context}\n"
-            "Answer:\n"
+            f"Question {i}: {q}\nContext:\n{combined_context}\n\n"
         )
-    prompt += "\nProvide each answer starting with 'Answer 1:', 'Answer 2:', etc."
+    prompt += "Provide each answer starting with 'Answer 1:', 'Answer 2:', etc., in the same order as the questions."
     return prompt
 
-async def answer_query(query: str, clauses: list[dict], document_url: str, top_k=5, rerank_llm=True):
-    doc_id = doc_hash(document_url)
-
-    chunked_clauses = []
-    for clause in clauses:
-        chunks = chunk_text_by_tokens(clause["text"], max_tokens=1000, overlap=100)
-        for idx, chunk in enumerate(chunks):
-            chunked_clauses.append({
-                "section": f"{clause['section']} (Part {idx+1})" if len(chunks) > 1 else clause['section'],
-                "text": chunk
-            })
-
-    chunk_vectors = [await embed_text_async(c["text"]) for c in chunked_clauses]
-
-    indexer = QdrantIndexer(doc_id)
-    await indexer.upsert_vectors(chunk_vectors, chunked_clauses)
-
-    retriever = QdrantRetriever(doc_id)
-    query_vec = await embed_text_async(query)
-    qdrant_hits = await retriever.search(query_vec, top_k=top_k*2)
-    qdrant_clauses = [r.payload for r in qdrant_hits]
-
-    bm25_retriever.index(chunked_clauses)
-    bm25_clauses = bm25_retriever.search(query, top_k=top_k*2)
-
-    # Hybrid scoring approach
-    #combined_scores = defaultdict(float)
-    #qdrant_dict = {hit.payload["text"]: hit for hit in qdrant_hits}
-
+async def retrieve_rows(query: str, index: DocumentIndex, top_k=5, query_vec=None) -> list[int]:
+    """
+    Hybrid retrieval + rerank for one question. Returns candidate rows of
+    index.chunks, best first.
+    """
+    if query_vec is None:
+        query_vec = await embed_text_async(query)
+    with span("vector_search"):
+        vector_hits = await index.retriever.search(query_vec, top_k=top_k*2)
+    vector_rows = [index.row_of(hit.payload) for hit in vector_hits]
+
+    with span("bm25_search"):
+        bm25_rows, _ = index.bm25.search_indices(query, top_k=top_k*2)
+
+    # Hybrid scoring approach: candidates are rows of index.chunks / index.vectors,
+    # deduplicated by text
     scored = {}
-    for clause in qdrant_clauses:
-        scored[clause["text"]] = {"score": 0.6, "data": clause}
-    for clause in bm25_clauses:
-        if clause["text"] in scored:
-            scored[clause["text"]]["score"] += 0.4
-        else:
-            scored[clause["text"]] = {"score": 0.4, "data": clause}
+    for row in vector_rows:
+        if row is not None:
+            scored.setdefault(index.chunks[row]["text"], {"score": 0.0, "row": row})["score"] += 0.6
+    for row in bm25_rows:
+        scored.setdefault(index.chunks[row]["text"], {"score": 0.0, "row": int(row)})["score"] += 0.4
 
     all_candidates = sorted(scored.values(), key=lambda x: -x["score"])
-    all_candidates = [x["data"] for x in all_candidates]
+    candidate_rows = [x["row"] for x in all_candidates]
 
-    reranked = await rerank_by_cosine_similarity(query, all_candidates)
+    # Reuses the vectors computed at ingest time instead of re-embedding candidates
+    reranked = await rerank(query, query_vec, candidate_rows, index.chunks, index.vectors)
 
-    top_clauses = reranked[:10]
-    if not top_clauses:
+    if not reranked:
         # Fallback mechanism
-        top_clauses = all_candidates[:10]
-        if not top_clauses:
-            return make_explanation("No relevant information was found in the policy document.", [], "")
+        return candidate_rows
+    return reranked
+
 
-    rationale = "\n".join([f"{c['section']}: {c['text']}" for c in top_clauses])
-    prompt = f"""You are an expert insurance policy analyst. Answer the following question using ONLY the information provided in the clauses below.
+def compose_rationale(top_clauses: list[dict]) -> str:
+    # Clause text starts with its own heading line; don't repeat it
+    return "\n".join([
+        c["text"] if c["text"].startswith(c["section"]) else f"{c['section']}: {c['text']}"
+        for c in top_clauses
+    ])
+
+
+def compose_prompt(query: str, rationale: str) -> str:
+    return f"""You are an expert insurance policy analyst. Answer the following question using ONLY the information provided in the clauses below.
 
 Question: {query}
 
@@ -91,5 +85,170 @@ Instructions:
 
 Answer:"""
 
+
+NO_INFORMATION_ANSWER = "No relevant information was found in the policy document."
+
+
+def _log_prompt(prompt: str, kind: str, questions: int, passages: int):
+    # Prompt size drives LLM latency and quota
+    tokens = count_tokens(prompt)
+    PROMPT_TOKENS.labels(kind).observe(tokens)
+    print(f"LLM prompt: {tokens} tokens, {questions} question(s), {passages} passages")
+
+
+async def answer_query(query: str, index: DocumentIndex, top_k=5, rerank_llm=True):
+    """
+    Query stage: answers one question against a prebuilt DocumentIndex.
+    Build the index once with build_document_index and share it across questions.
+    Repeated (document, question) pairs are served from the answer cache.
+    """
+    cached, query_vec = await _cached_answer(query, index)
+    if cached is not None:
+        return cached
+
+    rows = await retrieve_rows(query, index, top_k=top_k, query_vec=query_vec)
+    # Merged, deduplicated chunks within the context token budget
+    top_clauses = pack_context(query, rows, index)
+    if not top_clauses:
+        return make_explanation(NO_INFORMATION_ANSWER, [], "")
+
+    rationale = compose_rationale(top_clauses)
+    prompt = compose_prompt(query, rationale)
+    _log_prompt(prompt, "single", 1, len(top_clauses))
     answer = await gemini_invoke_with_retry(prompt)
-    return make_explanation(answer.strip(), top_clauses, rationale)
+    result = make_explanation(answer.strip(), top_clauses, rationale)
+    answer_cache.put(index.doc_id, query, result, query_vec)
+    return result
+
+
+async def _cached_answer(query: str, index: DocumentIndex):
+    """
+    Returns (cached AnswerDetail or None, query vector or None). The query
+    vector is only computed when the exact lookup misses and is handed back
+    so retrieval doesn't embed the question twice.
+    """
+    cached = answer_cache.get(index.doc_id, query)
+    if cached is not None:
+        return cached, None
+    query_vec = await embed_text_async(query)
+    return answer_cache.get_similar(index.doc_id, query_vec), query_vec
+
+
+_ANSWER_MARKER = re.compile(r"^[\s>*#_-]*Answer\s*(\d+)\s*[*_]*\s*[:.)\-]", re.IGNORECASE | re.MULTILINE)
+
+
+def parse_multi_answers(text: str, n: int) -> list[Optional[str]]:
+    """
+    Splits a compose_prompt_multi response into n answers by its
+    "Answer 1:", "Answer 2:", ... markers (tolerating markdown bold/headers
+    and "." or ")" separators). Answers that are missing, empty or numbered
+    out of range come back as None.
+    """
+    answers: list[Optional[str]] = [None] * n
+    markers = list(_ANSWER_MARKER.finditer(text))
+    for i, m in enumerate(markers):
+        number = int(m.group(1))
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(text)
+        body = text[m.end():end].strip().strip("*_").strip()
+        if 1 <= number <= n and body and answers[number - 1] is None:
+            answers[number - 1] = body
+    return answers
+
+
+def pack_questions(prompt_tokens: list[int], max_tokens: int, max_questions: int) -> list[list[int]]:
+    """
+    Greedily groups question indices, in order, so each group's summed
+    context tokens stay under max_tokens and it holds at most max_questions.
+    A single question over the budget gets a group of its own.
+    """
+    groups, current, current_tokens = [], [], 0
+    for i, tokens in enumerate(prompt_tokens):
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_questions):
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+async def answer_queries_batched(queries: List[str], index: DocumentIndex, top_k=5,
+                                 max_prompt_tokens: int = LLM_BATCH_MAX_PROMPT_TOKENS,
+                                 max_questions: int = LLM_BATCH_MAX_QUESTIONS):
+    """
+    Answers several questions with as few LLM calls as the token budget
+    allows: retrieval runs per question as usual, then questions are packed
+    into compose_prompt_multi prompts of at most max_prompt_tokens. Any answer
+    that cannot be parsed out of a batched response, or whose batch failed, is
+    re-asked on its own.
+
+    Returns, in the order of queries, an AnswerDetail or the exception that
+    question failed with, so one failure does not fail the other questions.
+    """
+    lookups = await asyncio.gather(*[
+        for_question(i, _cached_answer(q, index)) for i, q in enumerate(queries)
+    ], return_exceptions=True)
+    results = [lookup if isinstance(lookup, BaseException) else lookup[0] for lookup in lookups]
+    query_vecs = [None if isinstance(lookup, BaseException) else lookup[1] for lookup in lookups]
+    to_answer = [i for i, cached in enumerate(results) if cached is None]
+
+    clause_lists: list[list[dict]] = [[] for _ in queries]
+    retrieved = await asyncio.gather(*[
+        for_question(i, retrieve_rows(queries[i], index, top_k=top_k, query_vec=query_vecs[i])) for i in to_answer
+    ], return_exceptions=True)
+    for i, rows in zip(list(to_answer), retrieved):
+        try:
+            if isinstance(rows, BaseException):
+                raise rows
+            with question(i):
+                clause_lists[i] = pack_context(queries[i], rows, index)
+        except Exception as e:
+            results[i] = e
+            to_answer.remove(i)
+    rationales = [compose_rationale(c) for c in clause_lists]
+    # An answer's text, or the exception its LLM call failed with
+    answers: list = [None] * len(queries)
+
+    pending = [i for i in to_answer if clause_lists[i]]
+    for i in to_answer:
+        if not clause_lists[i]:
+            answers[i] = NO_INFORMATION_ANSWER
+
+    tokens = [count_tokens(queries[i]) + count_tokens(rationales[i]) for i in pending]
+    groups = [[pending[j] for j in group] for group in pack_questions(tokens, max_prompt_tokens, max_questions)]
+
+    async def run_group(group: list[int]):
+        if len(group) == 1:
+            return
+        prompt = compose_prompt_multi([queries[i] for i in group], [[rationales[i]] for i in group])
+        _log_prompt(prompt, "batched", len(group), sum(len(clause_lists[i]) for i in group))
+        response = await gemini_invoke_with_retry(prompt)
+        for i, parsed in zip(group, parse_multi_answers(response, len(group))):
+            answers[i] = parsed
+
+    failures = await asyncio.gather(*[run_group(g) for g in groups], return_exceptions=True)
+    for group, failure in zip(groups, failures):
+        if isinstance(failure, BaseException):
+            print(f"Batched LLM call for {len(group)} questions failed, asking them one by one: {failure}")
+
+    # Per-question fallback for singletons, failed batches and anything a batch
+    # didn't answer
+    async def run_single(i: int):
+        prompt = compose_prompt(queries[i], rationales[i])
+        _log_prompt(prompt, "single", 1, len(clause_lists[i]))
+        try:
+            answers[i] = (await for_question(i, gemini_invoke_with_retry(prompt))).strip()
+        except Exception as e:
+            answers[i] = e
+
+    await asyncio.gather(*[run_single(i) for i in pending if answers[i] is None])
+
+    for i in to_answer:
+        if isinstance(answers[i], BaseException):
+            results[i] = answers[i]
+            continue
+        results[i] = make_explanation(answers[i], clause_lists[i], rationales[i])
+        if i in pending:
+            answer_cache.put(index.doc_id, queries[i], results[i], query_vecs[i])
+    return results
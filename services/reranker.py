@@ -1,14 +1,94 @@
-from sentence_transformers.util import cos_sim
-from services.embeddings import embed_text_async  # same async embedder used elsewhere
 import asyncio
+import threading
+import numpy as np
 
+from core.config import RERANKER, CROSS_ENCODER_MODEL, RERANK_BATCH_SIZE, RERANK_TOP_N, RERANK_TIME_BUDGET_MS
+from core.executors import rerank_pool
+from utils.vectors import VectorMatrix
+from core.metrics import span, traced
 
-async def rerank_by_cosine_similarity(query: str, candidates: list[dict]) -> list[dict]:
-    query_vec = await embed_text_async(query)
-    clause_vecs = await asyncio.gather(*[embed_text_async(c["text"]) for c in candidates])
-    
-    sims = cos_sim(query_vec, clause_vecs)[0]
-    scored_candidates = list(zip(sims, candidates))
-    sorted_candidates = sorted(scored_candidates, key=lambda x: x[0], reverse=True)
-    
-    return [candidate for _, candidate in sorted_candidates]
+
+def rerank_by_cosine_similarity(query_vector: np.ndarray, rows: list[int], vectors: VectorMatrix) -> list[int]:
+    """
+    Orders candidate rows of the document's embedding matrix by cosine
+    similarity to the query. Vectors are L2-normalized at embedding time,
+    so this is a single matrix-vector product over the candidates.
+    """
+    if not rows:
+        return []
+    sims = np.asarray(vectors[rows], dtype=np.float32) @ np.asarray(query_vector, dtype=np.float32)
+    order = np.argsort(-sims, kind="stable")
+    return [rows[i] for i in order]
+
+
+class CrossEncoderReranker:
+    """
+    Scores (query, passage) pairs with a sentence-transformers CrossEncoder in
+    batches of batch_size on the rerank pool. Stops at the time budget:
+    candidates not scored by then keep their incoming (cosine) order after
+    the scored ones. A batch is not started when the last one took longer
+    than the budget left, and one still running at the deadline is left to
+    finish rather than cancelled (its thread cannot be stopped).
+    """
+    def __init__(self, model_name: str = CROSS_ENCODER_MODEL, batch_size: int = RERANK_BATCH_SIZE):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name)
+        return self._model
+
+    async def rerank(self, query: str, rows: list[int], texts: list[str], time_budget_ms: float) -> list[int]:
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + time_budget_ms / 1000.0
+        scores = []
+        last_batch_s = 0.0
+        for start in range(0, len(rows), self.batch_size):
+            if deadline - loop.time() <= last_batch_s:
+                break
+            pairs = [(query, t) for t in texts[start:start + self.batch_size]]
+            started = loop.time()
+            batch = asyncio.ensure_future(rerank_pool.run(lambda: self._get_model().predict(pairs)))
+            done, _ = await asyncio.wait({batch}, timeout=max(deadline - loop.time(), 0.0))
+            if not done:
+                # Retrieves the result (or error) nobody is waiting for any more
+                batch.add_done_callback(lambda f: f.cancelled() or f.exception())
+                break
+            scores.extend(float(s) for s in batch.result())
+            last_batch_s = loop.time() - started
+
+        scored = sorted(range(len(scores)), key=lambda i: -scores[i])
+        return [rows[i] for i in scored] + rows[len(scores):]
+
+
+_cross_encoder = None
+
+
+def get_cross_encoder() -> CrossEncoderReranker:
+    global _cross_encoder
+    if _cross_encoder is None:
+        _cross_encoder = CrossEncoderReranker()
+    return _cross_encoder
+
+
+@traced("rerank")
+async def rerank(query: str, query_vector: np.ndarray, rows: list[int], chunks: list[dict],
+                 vectors: VectorMatrix, time_budget_ms: float = RERANK_TIME_BUDGET_MS) -> list[int]:
+    """
+    Reranks candidate chunk rows for a query. Always orders by cosine
+    similarity first; with RERANKER=cross-encoder the top RERANK_TOP_N are
+    then rescored by the cross-encoder within time_budget_ms.
+    """
+    ordered = rerank_by_cosine_similarity(query_vector, rows, vectors)
+    if RERANKER != "cross-encoder" or not ordered:
+        return ordered
+    head, tail = ordered[:RERANK_TOP_N], ordered[RERANK_TOP_N:]
+    with span("rerank_cross_encoder"):
+        head = await get_cross_encoder().rerank(query, head, [chunks[r]["text"] for r in head], time_budget_ms)
+    return head + tail
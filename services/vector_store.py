@@ -1,54 +1,250 @@
 # services/vector_store.py
+"""
+Per-document vector collections behind one interface.
+
+VECTOR_BACKEND selects the implementation:
+  "qdrant" - a Qdrant server (QDRANT_HOST / QDRANT_PORT), one collection per document
+  "numpy"  - in-process brute-force inner product over a float32 matrix
+  "faiss"  - in-process faiss.IndexFlatIP
+
+The in-process backends need no server at all. Vectors are held as
+VECTOR_STORAGE_DTYPE (float16 or int8 halve or quarter the memory of
+float32). With LOCAL_VECTOR_DIR set they persist each document as
+vectors.npy (+ scales.npy for int8) + payloads.json and memory-map the
+vectors back read-only on load. Qdrant collections are created with the
+matching vector datatype (float16) or scalar quantization (int8).
+"""
 import asyncio
+import json
+import os
+import tempfile
 import uuid
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import PointStruct, VectorParams, Distance
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Sequence
+from dataclasses import dataclass
+import numpy as np
 import hashlib
-from services.embeddings import VECTOR_DIM
+import threading
+from core.config import (
+    UPSERT_BATCH_SIZE, UPSERT_PARALLELISM, VECTOR_BACKEND, QDRANT_HOST, QDRANT_PORT,
+    LOCAL_VECTOR_DIR, LOCAL_VECTOR_MAX_COLLECTIONS, VECTOR_STORAGE_DTYPE,
+)
+from core.executors import io_pool
+from services.embeddings import get_vector_dim
+from utils.vectors import VectorMatrix, as_float32
 
 collection_name = "policy_chunks"
-_qdrant_client = QdrantClient(host="localhost", port=6333)
+_qdrant_client = None
+_client_lock = threading.Lock()
+
+
+def _get_qdrant_client():
+    # Imported and connected on first use: only VECTOR_BACKEND=qdrant needs it
+    global _qdrant_client
+    if _qdrant_client is None:
+        with _client_lock:
+            if _qdrant_client is None:
+                from qdrant_client import QdrantClient
+                _qdrant_client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+    return _qdrant_client
+
+
+# Namespace for deterministic point IDs (uuid5 of document + chunk content)
+_POINT_NAMESPACE = uuid.UUID("6f1c7a52-3d1b-4c1e-9a57-0b8f4f3c2d10")
+
+# Collections we have already created or seen, so we don't ask Qdrant each time
+_known_collections: set[str] = set()
+_collections_lock = threading.Lock()
+
+# Collections known to hold every chunk of their document
+_indexed_collections: set[str] = set()
+
 
 def doc_hash(url: str) -> str:
     return hashlib.sha256(url.encode()).hexdigest()[:8]
 
-class QdrantIndexer:
+
+def point_id(doc_id: str, text: str) -> str:
+    """
+    Deterministic point ID for a chunk: the same chunk of the same document
+    always maps to the same point, so re-upserting overwrites instead of
+    duplicating. Identical chunks within a document collapse into one point.
+    """
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(_POINT_NAMESPACE, f"{doc_id}:{digest}"))
+
+
+def _payload(clause: dict, chunk_index: int) -> dict:
+    return {"text": clause["text"], "section": clause["section"], "page": clause.get("page"), "chunk_index": chunk_index}
+
+
+class _Payloads(Sequence):
+    """
+    Payloads of the local backend, built on access from the document's chunks
+    (which may be memory-mapped) instead of copying every chunk's text.
+    """
+    def __init__(self, chunked_clauses, rows: list[int]):
+        self.chunked_clauses = chunked_clauses
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> dict:
+        row = self.rows[i]
+        return _payload(self.chunked_clauses[row], row)
+
+
+@dataclass
+class SearchHit:
+    """
+    Backend-neutral search result, shaped like qdrant's ScoredPoint.
+    """
+    id: str
+    score: float
+    payload: dict
+
+
+class VectorStore(ABC):
+    """
+    One document's vector collection. Subclasses implement count,
+    fetch_vectors, upsert_vectors and search.
+    """
     def __init__(self, doc_id: str):
+        self.doc_id = doc_id
         self.collection_name = f"policy_chunks_{doc_id}"
-        self._ensure_collection_exists()
+
+    def point_ids(self, chunked_clauses: list[dict]) -> list[str]:
+        return [point_id(self.doc_id, c["text"]) for c in chunked_clauses]
+
+    @abstractmethod
+    async def count(self) -> int:
+        raise NotImplementedError
+
+    async def is_indexed(self, chunked_clauses: list[dict]) -> bool:
+        """
+        True if every chunk of this document is already stored in the collection.
+        """
+        if self.collection_name in _indexed_collections:
+            return True
+        if await self.count() == len(set(self.point_ids(chunked_clauses))):
+            _indexed_collections.add(self.collection_name)
+            return True
+        return False
+
+    @abstractmethod
+    async def fetch_vectors(self, ids: list[str]) -> dict:
+        """
+        Returns {point_id: vector} for the given ids that are already stored.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upsert_vectors(self, vectors, chunked_clauses: list[dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def search(self, query_vector, top_k: int) -> list:
+        """
+        Returns the top_k hits (objects with .id, .score and .payload), best first.
+        """
+        raise NotImplementedError
+
+
+def _qdrant_collection_config() -> dict:
+    from qdrant_client.http.models import (
+        Datatype, Distance, ScalarQuantization, ScalarQuantizationConfig, ScalarType, VectorParams,
+    )
+    params = {"size": get_vector_dim(), "distance": Distance.COSINE}
+    if VECTOR_STORAGE_DTYPE == "float16":
+        params["datatype"] = Datatype.FLOAT16
+    config = {"vectors_config": VectorParams(**params)}
+    if VECTOR_STORAGE_DTYPE == "int8":
+        config["quantization_config"] = ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=True)
+        )
+    return config
+
+
+class QdrantIndexer(VectorStore):
+    async def _ensure_collection(self):
+        # Created on first use rather than in __init__: the check and the
+        # create are network round-trips, made on the io pool
+        if self.collection_name not in _known_collections:
+            await io_pool.run(self._ensure_collection_exists)
 
     def _ensure_collection_exists(self):
-        existing = _qdrant_client.get_collections().collections
-        if not any(c.name == self.collection_name for c in existing):
-            _qdrant_client.recreate_collection(
-                collection_name=self.collection_name,
-                vectors_config=VectorParams(size=VECTOR_DIM, distance=Distance.COSINE),
+        with _collections_lock:
+            if self.collection_name in _known_collections:
+                return
+            client = _get_qdrant_client()
+            if not client.collection_exists(self.collection_name):
+                try:
+                    client.create_collection(collection_name=self.collection_name, **_qdrant_collection_config())
+                except Exception:
+                    # Another worker created it between the check and the create
+                    if not client.collection_exists(self.collection_name):
+                        raise
+            _known_collections.add(self.collection_name)
+
+    async def count(self) -> int:
+        await self._ensure_collection()
+        result = await io_pool.run(
+            lambda: _get_qdrant_client().count(collection_name=self.collection_name, exact=True)
+        )
+        return result.count
+
+    async def fetch_vectors(self, ids: list[str]) -> dict:
+        await self._ensure_collection()
+        found = {}
+        for start in range(0, len(ids), UPSERT_BATCH_SIZE):
+            batch = ids[start:start + UPSERT_BATCH_SIZE]
+            records = await io_pool.run(
+                lambda: _get_qdrant_client().retrieve(
+                    collection_name=self.collection_name, ids=batch, with_payload=False, with_vectors=True
+                ),
             )
+            for record in records:
+                found[str(record.id)] = record.vector
+        return found
 
-    async def upsert_vectors(self, vectors: list[list[float]], chunked_clauses: list[dict]):
+    async def upsert_vectors(self, vectors, chunked_clauses: list[dict]):
+        """
+        Upserts chunks under deterministic IDs in batches of UPSERT_BATCH_SIZE,
+        with up to UPSERT_PARALLELISM batches in flight. Skipped entirely when
+        the document is already fully indexed.
+        """
+        if await self.is_indexed(chunked_clauses):
+            return
+        await self._ensure_collection()
+
+        from qdrant_client.http.models import PointStruct
+        vectors = as_float32(vectors).tolist()
         points = [
-            PointStruct(
-                id=str(uuid.uuid4()),
-                vector=vec,
-                payload={"text": clause["text"], "section": clause["section"]}
-            )
-            for vec, clause in zip(vectors, chunked_clauses)
+            PointStruct(id=pid, vector=vec, payload=_payload(clause, i))
+            for i, (pid, vec, clause) in enumerate(zip(self.point_ids(chunked_clauses), vectors, chunked_clauses))
         ]
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            lambda: _qdrant_client.upsert(collection_name=self.collection_name, points=points)
-        )
 
-class QdrantRetriever:
-    def __init__(self, doc_id: str):
-        self.collection_name = f"policy_chunks_{doc_id}"
+        semaphore = asyncio.Semaphore(UPSERT_PARALLELISM)
+        client = _get_qdrant_client()
+
+        async def upsert_batch(batch):
+            async with semaphore:
+                await io_pool.run(
+                    lambda: client.upsert(collection_name=self.collection_name, points=batch, wait=True)
+                )
 
-    async def search(self, query_vector: list[float], top_k: int):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None,
-            lambda: _qdrant_client.search(
+        await asyncio.gather(*[
+            upsert_batch(points[start:start + UPSERT_BATCH_SIZE])
+            for start in range(0, len(points), UPSERT_BATCH_SIZE)
+        ])
+        _indexed_collections.add(self.collection_name)
+
+    async def search(self, query_vector, top_k: int):
+        await self._ensure_collection()
+        return await io_pool.run(
+            lambda: _get_qdrant_client().search(
                 collection_name=self.collection_name,
                 query_vector=query_vector,
                 limit=top_k,
@@ -56,31 +252,160 @@ class QdrantRetriever:
             )
         )
 
-from rank_bm25 import BM25Okapi
-import nltk
-nltk.download('punkt')
 
-class HybridRetriever:
-    def __init__(self, vector_retriever, chunked_clauses):
-        self.vector_retriever = vector_retriever
-        self.chunked_clauses = chunked_clauses
-        self.tokenized_clauses = [nltk.word_tokenize(c["text"].lower()) for c in chunked_clauses]
-        self.bm25 = BM25Okapi(self.tokenized_clauses)
-
-    def keyword_search(self, query: str, top_k=5):
-        tokens = nltk.word_tokenize(query.lower())
-        scores = self.bm25.get_scores(tokens)
-        top_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k]
-        return [self.chunked_clauses[i] for i in top_indices]
-
-    async def hybrid_search(self, query_vector, query_text: str, top_k=5):
-        vector_results = await self.vector_retriever.search(query_vector, top_k=top_k)
-        bm25_results = self.keyword_search(query_text, top_k=top_k)
-
-        merged = {c["text"]: c for c in bm25_results}
-        for hit in vector_results:
-            merged[hit.payload["text"]] = {
-                "text": hit.payload["text"],
-                "section": hit.payload.get("section", "Unknown"),
-            }
-        return list(merged.values())[:top_k]
+# Search-only callers predate the shared interface; both roles are one class now
+QdrantRetriever = QdrantIndexer
+
+
+class _LocalCollection:
+    def __init__(self, ids: list[str], vectors: VectorMatrix, payloads: Sequence, use_faiss: bool):
+        self.ids = ids
+        self.row_of = {pid: i for i, pid in enumerate(ids)}
+        self.vectors = vectors
+        self.payloads = payloads
+        self.faiss_index = None
+        if use_faiss and len(ids):
+            import faiss  # optional: only needed for VECTOR_BACKEND=faiss
+            # IndexFlatIP keeps its own float32 copy
+            self.faiss_index = faiss.IndexFlatIP(vectors.shape[1])
+            self.faiss_index.add(np.ascontiguousarray(vectors.to_float32()))
+
+    def search(self, query: np.ndarray, top_k: int) -> list[SearchHit]:
+        n = len(self.ids)
+        if n == 0:
+            return []
+        k = min(top_k, n)
+        if self.faiss_index is not None:
+            scores, rows = self.faiss_index.search(query.reshape(1, -1), k)
+            scores, rows = scores[0], rows[0]
+        else:
+            all_scores = self.vectors @ query
+            rows = np.argpartition(-all_scores, k - 1)[:k]
+            rows = rows[np.argsort(-all_scores[rows], kind="stable")]
+            scores = all_scores[rows]
+        return [SearchHit(self.ids[r], float(s), self.payloads[r]) for r, s in zip(rows, scores) if r >= 0]
+
+
+_local_collections: "OrderedDict[str, _LocalCollection]" = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def _local_dir(collection: str) -> str:
+    return os.path.join(LOCAL_VECTOR_DIR, collection)
+
+
+def _save_local(collection: str, coll: _LocalCollection):
+    path = _local_dir(collection)
+    os.makedirs(path, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=path)
+    np.save(os.path.join(tmp_dir, "vectors.npy"), coll.vectors.data)
+    if coll.vectors.scales is not None:
+        np.save(os.path.join(tmp_dir, "scales.npy"), coll.vectors.scales)
+    with open(os.path.join(tmp_dir, "payloads.json"), "w", encoding="utf-8") as f:
+        json.dump({"ids": coll.ids, "payloads": list(coll.payloads)}, f)
+    # payloads.json is replaced last, so a reader never sees it without its vectors
+    if coll.vectors.scales is not None:
+        os.replace(os.path.join(tmp_dir, "scales.npy"), os.path.join(path, "scales.npy"))
+    os.replace(os.path.join(tmp_dir, "vectors.npy"), os.path.join(path, "vectors.npy"))
+    os.replace(os.path.join(tmp_dir, "payloads.json"), os.path.join(path, "payloads.json"))
+    os.rmdir(tmp_dir)
+
+
+def _load_local(collection: str, use_faiss: bool):
+    path = _local_dir(collection)
+    try:
+        with open(os.path.join(path, "payloads.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r") if vectors.dtype == np.int8 else None
+    except (OSError, ValueError):
+        return None
+    if len(meta["ids"]) != vectors.shape[0] or (scales is not None and len(scales) != vectors.shape[0]):
+        return None
+    return _LocalCollection(meta["ids"], VectorMatrix(vectors, scales), meta["payloads"], use_faiss)
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process backend: exact inner-product search over the document's
+    normalized vectors (NumPy, or FAISS IndexFlatIP with use_faiss). Per-document
+    collections are a few thousand vectors, so this beats a network hop.
+    Loaded collections are kept in an LRU of LOCAL_VECTOR_MAX_COLLECTIONS.
+    """
+    def __init__(self, doc_id: str, use_faiss: bool = False):
+        super().__init__(doc_id)
+        self.use_faiss = use_faiss
+
+    def _collection(self):
+        with _local_lock:
+            coll = _local_collections.get(self.collection_name)
+            if coll is not None:
+                _local_collections.move_to_end(self.collection_name)
+                return coll
+        if not LOCAL_VECTOR_DIR:
+            return None
+        coll = _load_local(self.collection_name, self.use_faiss)
+        if coll is not None:
+            self._remember(coll)
+        return coll
+
+    def _remember(self, coll: _LocalCollection):
+        with _local_lock:
+            _local_collections[self.collection_name] = coll
+            _local_collections.move_to_end(self.collection_name)
+            while len(_local_collections) > LOCAL_VECTOR_MAX_COLLECTIONS:
+                evicted, _ = _local_collections.popitem(last=False)
+                _indexed_collections.discard(evicted)
+
+    async def count(self) -> int:
+        coll = self._collection()
+        return len(coll.ids) if coll is not None else 0
+
+    async def is_indexed(self, chunked_clauses: list[dict]) -> bool:
+        # Not cached in _indexed_collections: an LRU-evicted collection must be rebuilt
+        coll = self._collection()
+        return coll is not None and len(coll.ids) == len(set(self.point_ids(chunked_clauses)))
+
+    async def fetch_vectors(self, ids: list[str]) -> dict:
+        coll = self._collection()
+        if coll is None:
+            return {}
+        return {pid: coll.vectors[coll.row_of[pid]] for pid in ids if pid in coll.row_of}
+
+    async def upsert_vectors(self, vectors, chunked_clauses: list[dict]):
+        if await self.is_indexed(chunked_clauses):
+            return
+        vectors = VectorMatrix.encode(vectors, VECTOR_STORAGE_DTYPE)
+        rows = {}
+        for i, pid in enumerate(self.point_ids(chunked_clauses)):
+            rows[pid] = i  # last occurrence wins, as with a Qdrant upsert
+        ids = list(rows.keys())
+        keep = list(rows.values())
+        # Without duplicate chunks the caller's matrix (possibly memory-mapped) is used as is
+        if len(keep) != len(vectors):
+            vectors = vectors.take(keep)
+        coll = _LocalCollection(ids, vectors, _Payloads(chunked_clauses, keep), self.use_faiss)
+        if LOCAL_VECTOR_DIR:
+            await io_pool.run(_save_local, self.collection_name, coll)
+        self._remember(coll)
+
+    async def search(self, query_vector, top_k: int) -> list[SearchHit]:
+        coll = self._collection()
+        if coll is None:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        return coll.search(query, top_k)
+
+
+def get_vector_store(doc_id: str) -> VectorStore:
+    """
+    The configured VECTOR_BACKEND's store for one document.
+    """
+    if VECTOR_BACKEND == "qdrant":
+        return QdrantIndexer(doc_id)
+    if VECTOR_BACKEND in ("numpy", "faiss"):
+        return LocalVectorStore(doc_id, use_faiss=VECTOR_BACKEND == "faiss")
+    raise ValueError(f"Unknown VECTOR_BACKEND: {VECTOR_BACKEND!r}")
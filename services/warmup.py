@@ -0,0 +1,99 @@
+# services/warmup.py
+"""
+Startup warmup and readiness.
+
+Heavy resources (embedding model, cross-encoder, tokenizer tables, Qdrant
+connection, Gemini client) are created lazily on first use, so importing
+the app is fast and needs no network. start_warmup() creates them in the
+background when the server starts, so the first request does not pay for
+them, and the readiness endpoint reports ready once that is done. A failed
+step (e.g. Qdrant not up yet) is retried every WARMUP_RETRY_SECONDS.
+"""
+import asyncio
+import os
+import time
+from typing import Optional
+
+from core.config import LLM_BACKEND, RERANKER, VECTOR_BACKEND, WARMUP_ON_STARTUP, WARMUP_RETRY_SECONDS
+from core.executors import cpu_pool, inference_pool, io_pool, rerank_pool
+from services import embeddings, reranker, vector_store
+from services.llm_service import llm_client
+from utils.chunker import token_offsets
+
+# "pending" until start_warmup runs, then "warming", "ready" or "failed"
+# (retrying); "skipped" when WARMUP_ON_STARTUP is off
+state = {"status": "pending", "steps": {}, "error": None, "attempts": 0, "seconds": None}
+_started = time.monotonic()
+_task: Optional[asyncio.Task] = None
+
+
+def _steps() -> list:
+    # PDF workers first: forked before the model is loaded, they don't
+    # inherit its memory
+    steps = [
+        ("pdf_workers", cpu_pool, os.getpid),
+        ("embedding_model", inference_pool, lambda: embeddings.embed_many(["warm up"], "query")),
+        ("tokenizer", io_pool, lambda: token_offsets(["warm up"])),
+    ]
+    if RERANKER == "cross-encoder":
+        steps.append(("cross_encoder", rerank_pool,
+                      lambda: reranker.get_cross_encoder()._get_model().predict([("warm up", "warm up")])))
+    if VECTOR_BACKEND == "qdrant":
+        steps.append(("qdrant", io_pool, lambda: vector_store._get_qdrant_client().get_collections()))
+    if LLM_BACKEND == "gemini":
+        steps.append(("llm_client", io_pool, llm_client.backend.get_llm))
+    return steps
+
+
+async def warmup():
+    """
+    Runs every warmup step on its own pool, retrying failed steps until all
+    succeed. Steps that already succeeded are not run again.
+    """
+    started = time.monotonic()
+    state["status"] = "warming"
+    while True:
+        state["attempts"] += 1
+        try:
+            for name, pool, fn in _steps():
+                if name in state["steps"]:
+                    continue
+                step_started = time.monotonic()
+                await pool.run(fn)
+                state["steps"][name] = round(time.monotonic() - step_started, 3)
+        except Exception as e:
+            state["status"] = "failed"
+            state["error"] = f"{name}: {e}"
+            print(f"Warmup step {name} failed, retrying in {WARMUP_RETRY_SECONDS:g}s: {e}")
+            await asyncio.sleep(WARMUP_RETRY_SECONDS)
+            continue
+        state["status"] = "ready"
+        state["error"] = None
+        state["seconds"] = round(time.monotonic() - started, 3)
+        return
+
+
+def start_warmup():
+    """
+    Called from the app's startup hook: warms up in the background so the
+    server starts accepting connections (and answering liveness) at once.
+    """
+    global _task
+    if not WARMUP_ON_STARTUP:
+        state["status"] = "skipped"
+        return
+    _task = asyncio.ensure_future(warmup())
+
+
+def stop_warmup():
+    if _task is not None:
+        _task.cancel()
+
+
+def is_ready() -> bool:
+    return state["status"] in ("ready", "skipped")
+
+
+def readiness() -> dict:
+    return {**state, "ready": is_ready(), "uptime_s": round(time.monotonic() - _started, 3),
+            "model_loaded": embeddings.model_loaded()}
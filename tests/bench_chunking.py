@@ -0,0 +1,98 @@
+"""
+Microbenchmark for clause chunking on the PDFs in documents/.
+
+Compares the previous per-clause implementation (get_encoding + encode +
+decode per window) with utils.chunker's batched encode and offset slicing,
+checks both produce identical chunks, and times structure-aware packing.
+
+    python tests/bench_chunking.py [--repeats 5] [--max-tokens 1000] [--overlap 100]
+"""
+import argparse
+import os
+import sys
+import time
+
+import tiktoken
+
+from bench_common import ROOT, document_paths, load_pages
+
+sys.path.insert(0, ROOT)
+
+from services.doc_parser import split_into_clauses
+from utils.chunker import chunk_texts_by_tokens, semantic_chunk_texts, get_encoding
+
+
+def legacy_chunk_text_by_tokens(text: str, max_tokens: int, overlap: int) -> list[str]:
+    # The implementation chunk_clauses used before the shared chunker. Unlike
+    # the new one it also emits windows lying entirely inside the previous
+    # window's overlap, which are dropped here so the outputs compare equal.
+    encoding = tiktoken.get_encoding("cl100k_base")
+    tokens = encoding.encode(text)
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        chunks.append(encoding.decode(tokens[start:start + max_tokens]))
+        if start + max_tokens >= len(tokens):
+            break
+        start += max_tokens - overlap
+    return chunks
+
+
+def best_of(repeats: int, fn):
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def load_clauses(path: str) -> list[str]:
+    return [c["text"] for c in split_into_clauses(*load_pages(path))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--max-tokens", type=int, default=1000)
+    parser.add_argument("--overlap", type=int, default=100)
+    args = parser.parse_args()
+
+    # Load the encoder (and its token length table) outside the timings
+    chunk_texts_by_tokens(["warm up"])
+    encoding = get_encoding()
+
+    print(f"{'document':45} {'clauses':>7} {'chunks':>6} {'legacy ms':>10} {'batched ms':>10} "
+          f"{'speedup':>7} {'structure ms':>12} {'struct chunks':>13}")
+    totals = [0.0, 0.0]
+    for path in document_paths():
+        texts = load_clauses(path)
+        legacy_s, legacy = best_of(args.repeats, lambda: [
+            legacy_chunk_text_by_tokens(t, args.max_tokens, args.overlap) for t in texts
+        ])
+        batched_s, batched = best_of(args.repeats, lambda: chunk_texts_by_tokens(texts, args.max_tokens, args.overlap))
+        structure_s, structured = best_of(args.repeats, lambda: semantic_chunk_texts(texts, args.max_tokens, args.overlap))
+
+        # Legacy decoding turns a window cut inside a multi-byte character
+        # into U+FFFD; slicing keeps the character whole, so skip those
+        differing = [
+            (old, new) for old_chunks, new_chunks in zip(legacy, batched) for old, new in zip(old_chunks, new_chunks)
+            if old != new and "\ufffd" not in old
+        ]
+        if differing or list(map(len, legacy)) != list(map(len, batched)):
+            raise SystemExit(f"{os.path.basename(path)}: batched chunks differ from the legacy implementation")
+        longest = max((len(encoding.encode_ordinary(c)) for chunks in structured for c in chunks), default=0)
+        if longest > args.max_tokens + 2:
+            raise SystemExit(f"{os.path.basename(path)}: structure chunk of {longest} tokens exceeds the budget")
+
+        totals[0] += legacy_s
+        totals[1] += batched_s
+        print(f"{os.path.basename(path)[:45]:45} {len(texts):7d} {sum(map(len, batched)):6d} "
+              f"{legacy_s * 1000:10.1f} {batched_s * 1000:10.1f} {legacy_s / batched_s:6.1f}x "
+              f"{structure_s * 1000:12.1f} {sum(map(len, structured)):13d}")
+    print(f"{'total':45} {'':7} {'':6} {totals[0] * 1000:10.1f} {totals[1] * 1000:10.1f} "
+          f"{totals[0] / totals[1]:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Clause segmentation benchmark and regression check on the PDFs in documents/.
+
+Times the original multi-pattern re.split splitter against
+services.clause_segmenter, checks the segmenter's invariants (every clause
+is the stripped document slice [start, end), clauses are ordered and do not
+overlap, streaming page by page gives the same spans as the whole text), and
+compares the clauses with the regression corpus in tests/regression/clauses/
+(one JSON Lines file per document, one [start, end, page, section] per line).
+
+    python tests/bench_clauses.py             # benchmark + regression check
+    python tests/bench_clauses.py --update    # rewrite the regression corpus
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+from bench_common import ROOT, document_paths, load_pages
+
+sys.path.insert(0, ROOT)
+
+from services.clause_segmenter import segment_clauses
+
+CORPUS_DIR = os.path.join(ROOT, "tests", "regression", "clauses")
+
+
+def legacy_split_into_clauses(text: str) -> list[dict]:
+    # The splitter before services.clause_segmenter, for timing comparison
+    patterns = [
+        r'(Section\s+\d+[\.\d]*\s*[\w\s]*)',
+        r'(Clause\s+\d+[\.\d]*\s*[\w\s]*)',
+        r'([A-Z][\w\s]*:\s*)',
+        r'(\d+\.\s*[A-Z][\w\s]*)'
+    ]
+    for pattern in patterns:
+        sections = re.split(pattern, text)
+        if len(sections) > 3:
+            clauses = [{"section": s.strip(), "text": t.strip()} for s, t in zip(sections[1::2], sections[2::2])]
+            filtered_clauses = [c for c in clauses if c["text"]]
+            if filtered_clauses:
+                return filtered_clauses
+    paragraphs = [p.strip() for p in text.split("\n\n") if len(p.strip()) > 50]
+    fallback_clauses = [{"section": f"Paragraph {i+1}", "text": p} for i, p in enumerate(paragraphs)]
+    if not fallback_clauses or any(len(c["text"]) > 2000 for c in fallback_clauses):
+        sentences = [s.strip() for s in re.split(r'[.!?]+', text) if len(s.strip()) > 20]
+        fallback_clauses = [{"section": f"Sentence {i+1}", "text": s} for i, s in enumerate(sentences)]
+    if not fallback_clauses:
+        return [{"section": "Entire Document", "text": text.strip()}]
+    return fallback_clauses
+
+
+def best_of(repeats: int, fn):
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def check_invariants(name: str, text: str, clauses: list[dict]) -> list[str]:
+    problems, previous_end = [], 0
+    for i, clause in enumerate(clauses):
+        if text[clause["start"]:clause["end"]] != clause["text"]:
+            problems.append(f"{name}: clause {i} text is not the document slice [start, end)")
+        if clause["start"] < previous_end:
+            problems.append(f"{name}: clause {i} overlaps the previous clause")
+        previous_end = clause["end"]
+    whole = [(c["start"], c["end"]) for c in segment_clauses(text)]
+    if whole != [(c["start"], c["end"]) for c in clauses]:
+        problems.append(f"{name}: page-by-page segmentation differs from whole-text segmentation")
+    return problems
+
+
+def snapshot(clauses: list[dict]) -> list[list]:
+    return [[c["start"], c["end"], c["page"], c["section"]] for c in clauses]
+
+
+def write_corpus(path: str, rows: list[list]):
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def read_corpus(path: str) -> list[list]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(name: str, expected: list[list], actual: list[list]) -> list[str]:
+    if expected == actual:
+        return []
+    problems = [f"{name}: {len(expected)} clauses in the corpus, {len(actual)} now"]
+    for i, (old, new) in enumerate(zip(expected, actual)):
+        if old != new:
+            problems.append(f"{name}: first difference at clause {i}: {old} != {new}")
+            break
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--update", action="store_true", help="rewrite the regression corpus")
+    args = parser.parse_args()
+
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    problems = []
+    print(f"{'document':45} {'legacy ms':>9} {'legacy n':>8} {'new ms':>7} {'speedup':>7} "
+          f"{'clauses':>7} {'median ch':>9} {'<300 ch':>7}")
+    for path in document_paths():
+        name = os.path.basename(path)
+        text, page_offsets = load_pages(path)
+        legacy_s, legacy = best_of(args.repeats, lambda: legacy_split_into_clauses(text))
+        new_s, clauses = best_of(args.repeats, lambda: segment_clauses(text, page_offsets))
+
+        lengths = [len(c["text"]) for c in clauses]
+        print(f"{name[:45]:45} {legacy_s * 1000:9.1f} {len(legacy):8d} {new_s * 1000:7.1f} "
+              f"{legacy_s / new_s:6.1f}x {len(clauses):7d} {statistics.median(lengths):9.0f} "
+              f"{sum(n < 300 for n in lengths):7d}")
+
+        problems.extend(check_invariants(name, text, clauses))
+        corpus_path = os.path.join(CORPUS_DIR, os.path.splitext(name)[0] + ".jsonl")
+        actual = snapshot(clauses)
+        if args.update or not os.path.exists(corpus_path):
+            write_corpus(corpus_path, actual)
+        else:
+            problems.extend(compare(name, read_corpus(corpus_path), actual))
+
+    if problems:
+        print("\n".join(["", "FAILED:"] + problems))
+        sys.exit(1)
+    print("\nRegression corpus matches." if not args.update else "\nRegression corpus updated.")
+
+
+if __name__ == "__main__":
+    main()
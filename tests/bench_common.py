@@ -0,0 +1,74 @@
+"""
+Shared pieces of the benchmark scripts in tests/: the sample documents and
+questions, a local HTTP server for the documents, and PDF text loading.
+"""
+import functools
+import glob
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+import fitz  # PyMuPDF
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOCUMENTS_DIR = os.path.join(ROOT, "documents")
+
+QUESTIONS = [
+    "What is the grace period for premium payment?",
+    "What is the waiting period for pre-existing diseases (PED) to be covered?",
+    "Does this policy cover maternity expenses, and what are the conditions?",
+    "What is the waiting period for cataract surgery?",
+    "Are the medical expenses for an organ donor covered under this policy?",
+    "What is the No Claim Discount (NCD) offered in this policy?",
+    "Is there a benefit for preventive health check-ups?",
+    "How does the policy define a 'Hospital'?",
+    "What is the extent of coverage for AYUSH treatments?",
+    "Are there any sub-limits on room rent and ICU charges?",
+]
+
+
+def questions(n: int) -> list[str]:
+    # QUESTIONS repeated as needed to make n
+    return (QUESTIONS * (n // len(QUESTIONS) + 1))[:n]
+
+
+def document_paths() -> list[str]:
+    return sorted(glob.glob(os.path.join(DOCUMENTS_DIR, "*.pdf")))
+
+
+def load_pages(path: str) -> tuple[str, list[int]]:
+    """
+    The PDF's text and the start offset of each page in it.
+    """
+    pdf = fitz.open(path)
+    try:
+        pages = [page.get_text() for page in pdf]
+    finally:
+        pdf.close()
+    offsets, pos = [], 0
+    for page in pages:
+        offsets.append(pos)
+        pos += len(page)
+    return "".join(pages), offsets
+
+
+def serve_documents() -> ThreadingHTTPServer:
+    """
+    Serves documents/ over HTTP on a free local port, from a daemon thread.
+    """
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=DOCUMENTS_DIR))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def document_urls(server: ThreadingHTTPServer) -> dict[str, str]:
+    """
+    {file name: URL} for each PDF in documents/ on server.
+    """
+    base = f"http://127.0.0.1:{server.server_address[1]}/"
+    return {os.path.basename(p): base + quote(os.path.basename(p)) for p in document_paths()}
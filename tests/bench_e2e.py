@@ -0,0 +1,399 @@
+"""
+End-to-end benchmark of POST /api/v1/hackrx/run over the PDFs in documents/.
+
+Runs the real pipeline (download over HTTP, PDF extraction, clause
+segmentation, chunking, embedding, indexing, retrieval, reranking) through
+the FastAPI app in-process, with the fake LLM backend and the in-memory
+vector store standing in for Gemini and Qdrant. Reports:
+
+  - cold: one request per document with every cache cleared first, and the
+    time spent in each stage
+  - load: latency p50/p95/p99 and throughput at each concurrency level with
+    warm caches (the answer cache is off, so every question reaches the LLM)
+  - startup: time to import the app in a fresh interpreter, and time for
+    the startup warmup (model load, tokenizer, worker processes)
+  - peak RSS of this process and of the PDF worker processes
+
+Stage times are summed over every call, so with concurrent requests they
+can add up to more than the wall-clock time. Results are written as JSON so
+runs can be compared.
+
+    python tests/bench_e2e.py [--concurrency 1 4 16] [--requests 24] [--questions 5] [--index-store]
+                              [--output results.json]
+
+Settings are the production defaults (the index store is off, as for a
+single worker, unless --index-store is given), with the offline stand-ins
+below and the caches in a scratch directory removed at exit. Any of them can
+be overridden from the environment (e.g. VECTOR_BACKEND=faiss or
+LLM_FAKE_LATENCY_MS=500).
+"""
+import argparse
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=24, help="requests per concurrency level")
+    parser.add_argument("--questions", type=int, default=5, help="questions per request")
+    parser.add_argument("--index-store", action="store_true", help="serve documents from the memory-mapped index store")
+    parser.add_argument("--output", default=None, help="JSON results path (default: benchmark-<timestamp>.json)")
+    return parser.parse_args()
+
+
+# Parsed before the app is imported, since the flags decide its configuration
+ARGS = parse_args()
+SCRATCH_DIR = tempfile.mkdtemp(prefix="bench-e2e-")
+atexit.register(shutil.rmtree, SCRATCH_DIR, ignore_errors=True)
+
+# Offline stand-ins; must be set before the app reads its configuration
+_DEFAULTS = {
+    "LLM_BACKEND": "fake",
+    "VECTOR_BACKEND": "numpy",
+    "LOCAL_VECTOR_DIR": "",
+    "LLM_RPM": "0",
+    "ANSWER_CACHE_ENABLED": "false",
+    "MAX_CONCURRENT_REQUESTS": "0",
+    "DOC_CACHE_DIR": os.path.join(SCRATCH_DIR, "doc_cache"),
+    "EMBEDDING_STORE_DIR": os.path.join(SCRATCH_DIR, "embedding_store"),
+}
+if ARGS.index_store:
+    _DEFAULTS["INDEX_STORE_DIR"] = os.path.join(SCRATCH_DIR, "index_store")
+for _key, _value in _DEFAULTS.items():
+    os.environ.setdefault(_key, _value)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import asyncio
+import functools
+import json
+import platform
+import resource
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+
+import httpx
+import numpy as np
+from prometheus_client import REGISTRY
+
+from main import app
+from core import config
+from core.executors import POOLS, cpu_pool
+from services import bm25_retriever, document_index, embeddings, logic, vector_store
+from services.answer_cache import answer_cache
+from services.clause_segmenter import ClauseSegmenter
+from services.doc_cache import document_cache
+from services.embedding_store import embedding_store
+from services.index_store import index_store
+from services.http_fetcher import DocumentFetcher
+from services.ingest_jobs import ingest_queue
+from services.warmup import state as warmup_state, warmup
+
+from bench_common import document_urls, questions as sample_questions, serve_documents
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+STAGES = ["download", "parse", "split", "chunk", "embed", "index", "embed_query", "retrieve", "rerank", "pack", "llm"]
+
+
+class StageTimer:
+    """
+    Sums wall-clock time per stage by wrapping the functions that implement
+    each stage. Thread-safe, since embedding runs on the inference thread.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.seconds = dict.fromkeys(STAGES, 0.0)
+            self.calls = dict.fromkeys(STAGES, 0)
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            seconds = dict(self.seconds)
+            calls = dict(self.calls)
+        # retrieve_rows includes the rerank call; report it exclusive
+        seconds["retrieve"] = max(seconds["retrieve"] - seconds["rerank"], 0.0)
+        return {stage: {"ms": round(seconds[stage] * 1000, 2), "calls": calls[stage]} for stage in STAGES}
+
+    def wrap_sync(self, owner, name: str, stage):
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.add(stage(args, kwargs) if callable(stage) else stage, time.perf_counter() - started)
+
+        setattr(owner, name, wrapper)
+
+    def wrap_async(self, owner, name: str, stage: str):
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+
+        setattr(owner, name, wrapper)
+
+
+def instrument(timer: StageTimer):
+    def embed_stage(args, kwargs):
+        kind = kwargs.get("kind", args[1] if len(args) > 1 else "passage")
+        return "embed_query" if kind == "query" else "embed"
+
+    timer.wrap_async(DocumentFetcher, "_download", "download")
+    timer.wrap_async(cpu_pool, "run", "parse")  # the cpu pool only runs PDF page extraction
+    timer.wrap_sync(ClauseSegmenter, "feed", "split")
+    timer.wrap_sync(ClauseSegmenter, "close", "split")
+    timer.wrap_sync(document_index, "chunk_clauses", "chunk")
+    timer.wrap_sync(embeddings, "embed_many", embed_stage)
+    timer.wrap_async(document_index, "_finish_index", "index")
+    timer.wrap_async(logic, "retrieve_rows", "retrieve")
+    timer.wrap_async(logic, "rerank", "rerank")
+    timer.wrap_sync(logic, "pack_context", "pack")
+    timer.wrap_async(logic, "gemini_invoke_with_retry", "llm")
+
+
+def prompt_tokens() -> tuple[float, float]:
+    """
+    (total tokens, prompts) over every LLM prompt so far, from the llm_prompt_tokens histogram.
+    """
+    total = count = 0.0
+    for kind in ("single", "batched"):
+        total += REGISTRY.get_sample_value("llm_prompt_tokens_sum", {"kind": kind}) or 0.0
+        count += REGISTRY.get_sample_value("llm_prompt_tokens_count", {"kind": kind}) or 0.0
+    return total, count
+
+
+def mean_prompt_tokens(before: tuple[float, float]) -> float:
+    total, count = prompt_tokens()
+    return round((total - before[0]) / (count - before[1]), 1) if count > before[1] else 0.0
+
+
+def reset_caches():
+    document_cache.clear()
+    answer_cache.clear()
+    vector_store._local_collections.clear()
+    vector_store._indexed_collections.clear()
+    bm25_retriever._index_cache.clear()
+    if embedding_store is not None:
+        embedding_store.clear()
+    if index_store is not None:
+        index_store.clear()
+    ingest_queue.clear()
+
+
+class RSSSampler:
+    """
+    Peak resident memory of this process and, with psutil installed, of its
+    live child processes (the PDF workers), sampled every interval seconds.
+    """
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        me = psutil.Process()
+        while not self._stop.is_set():
+            try:
+                total = me.memory_info().rss + sum(c.memory_info().rss for c in me.children(recursive=True))
+            except psutil.Error:
+                total = 0
+            self.peak_total = max(self.peak_total, total)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if psutil is not None:
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20, 1),
+        "exited_children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2 ** 20, 1),
+    }
+
+
+def measure_import_seconds() -> float:
+    # A fresh interpreter, since this one has already imported everything
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    values = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)), 1),
+        "p95_ms": round(float(np.percentile(values, 95)), 1),
+        "p99_ms": round(float(np.percentile(values, 99)), 1),
+        "mean_ms": round(float(values.mean()), 1),
+        "max_ms": round(float(values.max()), 1),
+    }
+
+
+async def post(client: httpx.AsyncClient, url: str, questions: list[str]) -> tuple[float, bool]:
+    started = time.perf_counter()
+    response = await client.post("/api/v1/hackrx/run", json={"documents": url, "questions": questions})
+    elapsed = time.perf_counter() - started
+    ok = response.status_code == 200 and len(response.json()["answers"]) == len(questions)
+    return elapsed, ok
+
+
+async def run_benchmark(args) -> dict:
+    timer = StageTimer()
+    instrument(timer)
+    server = serve_documents()
+    urls = document_urls(server)
+    documents = list(urls)
+    questions = sample_questions(args.questions)
+
+    results = {"startup": {}, "cold": [], "load": []}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        # Load the models and start the worker pools outside the request timings
+        started = time.perf_counter()
+        await warmup()
+        results["startup"] = {
+            "import_s": round(measure_import_seconds(), 3),
+            "warmup_s": round(time.perf_counter() - started, 3),
+            "warmup_steps_s": dict(warmup_state["steps"]),
+        }
+        print(f"Startup: import {results['startup']['import_s']}s, warmup {results['startup']['warmup_s']}s "
+              f"{results['startup']['warmup_steps_s']}")
+        await client.post("/api/v1/hackrx/run", json={"documents": "Warm up clause: nothing to see here.", "questions": ["?"]})
+
+        print(f"\nCold requests ({len(questions)} questions, caches cleared before each)")
+        print(f"{'document':42} {'total ms':>9} " + " ".join(f"{s:>11}" for s in STAGES) + f" {'prompt tok':>10}")
+        for name in documents:
+            reset_caches()
+            timer.reset()
+            before = prompt_tokens()
+            elapsed, ok = await post(client, urls[name], questions)
+            stages = timer.snapshot()
+            tokens = mean_prompt_tokens(before)
+            results["cold"].append({"document": name, "latency_ms": round(elapsed * 1000, 1), "ok": ok, "stages": stages,
+                                    "prompt_tokens_mean": tokens})
+            print(f"{name[:42]:42} {elapsed * 1000:9.1f} " + " ".join(f"{stages[s]['ms']:11.1f}" for s in STAGES)
+                  + f" {tokens:10.0f}")
+
+        # The cold pass left only the last document cached: ingest them all
+        for name in documents:
+            await post(client, urls[name], questions[:1])
+
+        print(f"\nWarm load ({args.requests} requests per level, {len(questions)} questions each)")
+        print(f"{'concurrency':>11} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}   per-request stage ms")
+        for concurrency in args.concurrency:
+            timer.reset()
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def one(i: int):
+                async with semaphore:
+                    return await post(client, urls[documents[i % len(documents)]], questions)
+
+            started = time.perf_counter()
+            outcomes = await asyncio.gather(*[one(i) for i in range(args.requests)])
+            wall = time.perf_counter() - started
+            stages = timer.snapshot()
+            summary = latency_summary([elapsed for elapsed, _ in outcomes])
+            errors = sum(not ok for _, ok in outcomes)
+            per_request = {s: round(stages[s]["ms"] / args.requests, 1) for s in STAGES}
+            results["load"].append({
+                "concurrency": concurrency,
+                "requests": args.requests,
+                "wall_s": round(wall, 3),
+                "throughput_rps": round(args.requests / wall, 2),
+                "errors": errors,
+                **summary,
+                "stages": stages,
+                "stages_per_request_ms": per_request,
+            })
+            busiest = ", ".join(f"{s} {v}" for s, v in sorted(per_request.items(), key=lambda kv: -kv[1])[:4])
+            print(f"{concurrency:11d} {args.requests / wall:7.2f} {summary['p50_ms']:8.1f} {summary['p95_ms']:8.1f} "
+                  f"{summary['p99_ms']:8.1f} {errors:6d}   {busiest}")
+
+    server.shutdown()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    args = ARGS
+    sampler = RSSSampler()
+    sampler.start()
+    results = asyncio.run(run_benchmark(args))
+    sampler.stop()
+    for pool in POOLS.values():
+        pool.shutdown()
+
+    rss = peak_rss_mb()
+    if psutil is not None:
+        rss["self_and_workers"] = round(sampler.peak_total / 2 ** 20, 1)
+    print(f"\nPeak RSS (MB): {rss}")
+
+    started_at = datetime.now(timezone.utc)
+    report = {
+        "meta": {
+            "timestamp": started_at.isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+            "config": {
+                key: getattr(config, key) for key in (
+                    "EMBEDDING_MODEL_NAME", "EMBED_BACKEND", "EMBED_THREADS", "VECTOR_BACKEND", "VECTOR_STORAGE_DTYPE",
+                    "RERANKER", "LLM_BACKEND", "LLM_FAKE_LATENCY_MS", "LLM_MAX_CONCURRENCY", "PDF_WORKERS",
+                    "INFERENCE_WORKERS", "EMBED_BATCH_SIZE", "CHUNK_STRATEGY", "INDEX_STORE_DIR",
+                )
+            },
+        },
+        **results,
+        "peak_rss_mb": rss,
+    }
+    output = args.output or f"benchmark-{started_at.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
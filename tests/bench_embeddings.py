@@ -0,0 +1,96 @@
+"""
+Embedding speed and recall benchmark on the PDFs in documents/.
+
+Embeds every chunk of every document and a fixed set of questions with each
+EMBED_BACKEND ("torch", "onnx", "onnx-int8"), then stores the vectors as
+float32, float16 and int8 (utils.vectors). For each combination it reports
+passage throughput, single-query latency, bytes per vector and recall@k:
+the overlap of each question's top-k chunks with the top-k of the first
+backend (torch by default) stored as float32, averaged over questions and
+documents.
+
+    python tests/bench_embeddings.py [--backends torch onnx onnx-int8] [--threads 4] [--k 10]
+
+The onnx backends need `pip install "sentence-transformers[onnx]"`; a backend
+that cannot be loaded is skipped.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from bench_common import QUESTIONS, ROOT, document_paths, load_pages
+
+sys.path.insert(0, ROOT)
+
+from services.doc_parser import split_into_clauses
+from services.document_index import chunk_clauses
+from services.embeddings import embed_many, load_model
+from utils.vectors import DTYPES, VectorMatrix
+
+
+def load_chunks(path: str) -> list[str]:
+    return [c["text"] for c in chunk_clauses(split_into_clauses(*load_pages(path)))]
+
+
+def top_k(vectors, query: np.ndarray, k: int) -> set:
+    scores = vectors @ query
+    return set(np.argsort(-scores, kind="stable")[:k].tolist())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--threads", type=int, default=0, help="intra-op threads (0 = library default)")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    documents = {os.path.basename(p): load_chunks(p) for p in document_paths()}
+    total_chunks = sum(map(len, documents.values()))
+    print(f"{len(documents)} documents, {total_chunks} chunks, {len(QUESTIONS)} questions, recall@{args.k}\n")
+
+    reference = None
+    print(f"{'backend':10} {'load s':>7} {'passages/s':>10} {'query ms':>8} {'storage':>8} {'bytes/vec':>9} "
+          f"{'recall':>7} {'min recall':>10}")
+    for backend in args.backends:
+        try:
+            started = time.perf_counter()
+            model = load_model(backend, args.threads)
+            load_s = time.perf_counter() - started
+        except Exception as e:
+            print(f"{backend:10} skipped: {type(e).__name__}: {e}")
+            continue
+        embed_many(["warm up"], "passage", model=model)
+
+        started = time.perf_counter()
+        passages = {name: embed_many(chunks, "passage", model=model) for name, chunks in documents.items()}
+        passages_per_s = total_chunks / (time.perf_counter() - started)
+        query_times, queries = [], []
+        for question in QUESTIONS:
+            started = time.perf_counter()
+            queries.append(embed_many([question], "query", model=model)[0])
+            query_times.append(time.perf_counter() - started)
+
+        if reference is None:
+            # The first backend stored as float32 is the reference
+            reference = {
+                name: [top_k(vectors, q, args.k) for q in queries] for name, vectors in passages.items()
+            }
+        for dtype in DTYPES:
+            recalls, nbytes = [], 0
+            for name, vectors in passages.items():
+                stored = VectorMatrix.encode(vectors, dtype)
+                nbytes += stored.nbytes
+                k = min(args.k, len(stored))
+                for expected, query in zip(reference[name], queries):
+                    recalls.append(len(top_k(stored, query, k) & expected) / k if k else 1.0)
+            bytes_per_vector = nbytes / max(total_chunks, 1)
+            print(f"{backend:10} {load_s:7.1f} {passages_per_s:10.1f} {statistics.median(query_times) * 1000:8.2f} "
+                  f"{dtype:>8} {bytes_per_vector:9.0f} {statistics.mean(recalls):7.3f} {min(recalls):10.2f}")
+
+
+if __name__ == "__main__":
+    main()
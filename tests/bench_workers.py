@@ -0,0 +1,184 @@
+"""
+Multi-worker serving benchmark: throughput and memory against WEB_WORKERS.
+
+For each worker count, starts `python main.py` with that many uvicorn
+workers (fake LLM, in-process vector store, fresh caches and index store),
+then:
+
+  - ingest: one request per PDF in documents/, all at once, so workers race
+    for the same documents and the ingest lock picks one owner for each
+  - load: --requests requests spread over the documents, --concurrency at
+    a time (the answer cache is off, so every question reaches the LLM)
+
+and reports req/s, latency, and memory: RSS and PSS of the whole process
+tree (PDF worker processes included), and USS of the web workers. RSS
+counts pages of the memory-mapped index store once per worker that touched
+them; PSS splits shared pages between the processes sharing them, and USS
+leaves them out. What grows with the worker count is the per-worker
+baseline (model, libraries), the heap of whichever worker ingested a
+document and its PDF workers, not a copy of every document per worker.
+
+    python tests/bench_workers.py [--workers 1 2 4] [--requests 48] [--concurrency 8] [--questions 2]
+
+Needs psutil. Settings can be overridden from the environment as for
+tests/bench_e2e.py (e.g. EMBED_BACKEND=onnx-int8).
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from bench_common import ROOT, document_urls, questions as sample_questions, serve_documents
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Offline stand-ins, as in tests/bench_e2e.py
+_DEFAULTS = {
+    "LLM_BACKEND": "fake",
+    "VECTOR_BACKEND": "numpy",
+    "LOCAL_VECTOR_DIR": "",
+    "LLM_RPM": "0",
+    "ANSWER_CACHE_ENABLED": "false",
+    "MAX_CONCURRENT_REQUESTS": "0",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def web_workers(root: psutil.Process, workers: int) -> list:
+    if workers == 1:
+        return [root]
+    # The supervisor's children, apart from multiprocessing's resource tracker
+    return [p for p in root.children() if "resource_tracker" not in " ".join(p.cmdline())]
+
+
+def tree_memory_mb(pid: int, workers: int) -> dict:
+    root = psutil.Process(pid)
+    rss = pss = uss = 0
+    worker_pids = {p.pid for p in web_workers(root, workers)}
+    for process in [root] + root.children(recursive=True):
+        try:
+            info = process.memory_full_info()
+        except psutil.Error:
+            continue
+        rss += info.rss
+        pss += getattr(info, "pss", info.rss)
+        if process.pid in worker_pids:
+            uss += info.uss
+    return {"rss_mb": round(rss / 2 ** 20, 1), "pss_mb": round(pss / 2 ** 20, 1),
+            "worker_uss_mb": round(uss / 2 ** 20, 1)}
+
+
+async def wait_ready(client: httpx.AsyncClient, workers: int, timeout: float = 300):
+    # Each worker warms up on its own; requests land on any of them, so wait
+    # for a run of ready answers
+    deadline = time.monotonic() + timeout
+    ready_in_a_row = 0
+    while ready_in_a_row < 4 * workers:
+        if time.monotonic() > deadline:
+            raise TimeoutError("server did not become ready")
+        try:
+            ready = (await client.get("/health/ready")).status_code == 200
+        except httpx.TransportError:
+            ready = False
+        ready_in_a_row = ready_in_a_row + 1 if ready else 0
+        if not ready:
+            await asyncio.sleep(0.5)
+
+
+async def post(client: httpx.AsyncClient, url: str, questions: list[str]) -> tuple[float, bool]:
+    started = time.perf_counter()
+    response = await client.post("/api/v1/hackrx/run", json={"documents": url, "questions": questions})
+    return time.perf_counter() - started, response.status_code == 200
+
+
+async def run_level(workers: int, urls: list[str], args) -> dict:
+    port = free_port()
+    scratch = tempfile.mkdtemp(prefix="bench-workers-")
+    env = {**_DEFAULTS, **os.environ, "WEB_WORKERS": str(workers), "PORT": str(port)}
+    for key in ("DOC_CACHE_DIR", "EMBEDDING_STORE_DIR", "INDEX_STORE_DIR"):
+        env.setdefault(key, os.path.join(scratch, key.lower()))
+    server = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    questions = sample_questions(args.questions)
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency * 2)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None, limits=limits) as client:
+            await wait_ready(client, workers)
+            idle = tree_memory_mb(server.pid, workers)
+
+            started = time.perf_counter()
+            ingested = await asyncio.gather(*[post(client, url, questions) for url in urls])
+            ingest_s = time.perf_counter() - started
+
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def one(i: int):
+                async with semaphore:
+                    return await post(client, urls[i % len(urls)], questions)
+
+            started = time.perf_counter()
+            results = await asyncio.gather(*[one(i) for i in range(args.requests)])
+            load_s = time.perf_counter() - started
+            loaded = tree_memory_mb(server.pid, workers)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    latencies = np.asarray([seconds for seconds, _ in results]) * 1000
+    return {
+        "workers": workers,
+        "ingest_s": round(ingest_s, 2),
+        "req_per_s": round(args.requests / load_s, 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+        "errors": sum(not ok for _, ok in ingested) + sum(not ok for _, ok in results),
+        "idle": idle,
+        "loaded": loaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=48, help="requests in the load phase")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--questions", type=int, default=2, help="questions per request")
+    args = parser.parse_args()
+    if psutil is None:
+        sys.exit("bench_workers.py needs psutil (pip install psutil)")
+
+    documents_server = serve_documents()
+    urls = list(document_urls(documents_server).values())
+
+    print(f"{'workers':>7} {'ingest s':>9} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'errors':>6} "
+          f"{'idle PSS':>9} {'RSS MB':>8} {'PSS MB':>8} {'worker USS':>10}")
+    for workers in args.workers:
+        row = asyncio.run(run_level(workers, urls, args))
+        print(f"{row['workers']:>7} {row['ingest_s']:>9} {row['req_per_s']:>7} {row['p50_ms']:>8} "
+              f"{row['p95_ms']:>8} {row['errors']:>6} {row['idle']['pss_mb']:>9} {row['loaded']['rss_mb']:>8} "
+              f"{row['loaded']['pss_mb']:>8} {row['loaded']['worker_uss_mb']:>10}")
+    documents_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
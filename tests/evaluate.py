@@ -1,6 +1,8 @@
 import asyncio
+from services.document_index import build_document_index
 from services.logic import answer_query
 from services.doc_parser import split_into_clauses
+from services.doc_cache import content_hash
 import json
 
 # Sample test cases with expected answers
@@ -37,7 +39,8 @@ async def evaluate_accuracy():
         
         try:
             # Get the answer from the system
-            result = await answer_query(test_case['question'], clauses, "test_document_url")
+            index = await build_document_index(clauses, content_hash(test_case['document_section'].encode("utf-8")))
+            result = await answer_query(test_case['question'], index)
             answer = result.answer
             
             print(f"Answer: {answer}")
@@ -1,40 +1,168 @@
+"""
+Token-based chunking shared by ingestion and prompt building.
+
+The encoder is loaded once. Texts are encoded together with
+encode_ordinary_batch, and every token's start is mapped back to a character
+offset in its text, so chunks are cut as slices of the original string
+instead of decoding token lists. Slicing at token boundaries gives the same
+text tiktoken would decode.
+"""
+import os
+import re
+from functools import lru_cache
+
+import numpy as np
 import tiktoken
 
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = "cl100k_base"):
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode_ordinary(text))
+
+
+@lru_cache(maxsize=None)
+def _token_byte_lengths(name: str = "cl100k_base") -> np.ndarray:
+    # UTF-8 byte length of every token id; ids without bytes stay 0
+    encoding = get_encoding(name)
+    lengths = np.zeros(encoding.n_vocab, dtype=np.int64)
+    for token in range(encoding.n_vocab):
+        try:
+            lengths[token] = len(encoding.decode_single_token_bytes(token))
+        except KeyError:
+            pass
+    return lengths
+
+
+def _char_offsets(text: str, tokens: list[int]) -> np.ndarray:
+    """
+    Character offset where each token starts, followed by len(text). A token
+    starting inside a multi-byte character maps to that character's offset.
+    """
+    byte_offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+    if tokens:
+        np.cumsum(_token_byte_lengths()[np.asarray(tokens, dtype=np.int64)], out=byte_offsets[1:])
+    if text.isascii():
+        return byte_offsets
+    data = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+    # Character index of every byte (continuation bytes belong to the
+    # character they continue), plus one past the end
+    char_of_byte = np.empty(len(data) + 1, dtype=np.int64)
+    np.cumsum((data & 0xC0) != 0x80, out=char_of_byte[:-1])
+    char_of_byte[:-1] -= 1
+    char_of_byte[-1] = len(text)
+    return char_of_byte[byte_offsets]
+
+
+def _encode_batch(texts: list[str]) -> list[list[int]]:
+    encoding = get_encoding()
+    threads = min(8, os.cpu_count() or 1)
+    if threads > 1 and len(texts) > 1:
+        return encoding.encode_ordinary_batch(texts, num_threads=threads)
+    # The batch API's thread pool is pure overhead on one core
+    return [encoding.encode_ordinary(text) for text in texts]
+
+
+def token_offsets(texts: list[str]) -> list[np.ndarray]:
+    """
+    Encodes all texts in one batch (across threads when there is more than
+    one core) and returns, per text, the character offset of each token
+    start followed by len(text).
+    """
+    return [_char_offsets(text, tokens) for text, tokens in zip(texts, _encode_batch(texts))]
+
+
+def _window_spans(offsets: np.ndarray, max_tokens: int, overlap: int) -> list[tuple[int, int]]:
+    n = len(offsets) - 1
+    step = max(max_tokens - overlap, 1)
+    spans = []
+    for start in range(0, n, step):
+        spans.append((int(offsets[start]), int(offsets[min(start + max_tokens, n)])))
+        # Stop at the window that reaches the end; a further one would lie
+        # entirely inside this window's overlap
+        if start + max_tokens >= n:
+            break
+    return spans
+
+
+def chunk_texts_by_tokens(texts: list[str], max_tokens: int = 2048, overlap: int = 50) -> list[list[str]]:
+    """
+    chunk_text_by_tokens for many texts with a single batched encode.
+    """
+    chunked = []
+    for text, tokens in zip(texts, _encode_batch(texts)):
+        if len(tokens) <= max_tokens:
+            # Most clauses fit in one window: no offsets needed
+            chunked.append([text] if tokens else [])
+            continue
+        offsets = _char_offsets(text, tokens)
+        chunked.append([text[start:end] for start, end in _window_spans(offsets, max_tokens, overlap)])
+    return chunked
+
+
 def chunk_text_by_tokens(text: str, max_tokens: int = 2048, overlap: int = 50) -> list[str]:
-    encoding = tiktoken.get_encoding("cl100k_base")
-    tokens = encoding.encode(text)
-    chunks = []
-    start = 0
-    length = len(tokens)
-
-    while start < length:
-        end = start + max_tokens
-        chunk_tokens = tokens[start:end]
-        chunk_text = encoding.decode(chunk_tokens)
-        chunks.append(chunk_text)
-        start += max_tokens - overlap  # move forward by chunk size minus overlap
-
-    return chunks
-
-def semantic_chunk_text(text: str, max_chunk_size: int = 1000) -> list[str]:
-    # Split by paragraphs first
-    paragraphs = text.split('\n\n')
-    chunks = []
-    current_chunk = ""
-    
-    for paragraph in paragraphs:
-        if len(current_chunk) + len(paragraph) < max_chunk_size:
-            current_chunk += paragraph + "\n\n"
+    """
+    Windows of max_tokens tokens, each starting max_tokens - overlap tokens
+    after the previous one, up to the first window that reaches the end.
+    """
+    return chunk_texts_by_tokens([text], max_tokens, overlap)[0]
+
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_BREAK = re.compile(r"(?<=[.;:!?])\s+")
+
+
+def _structure_spans(text: str, offsets: np.ndarray, max_tokens: int, overlap: int) -> list[tuple[int, int]]:
+    # Candidate cut points as token indices, paragraph breaks preferred over
+    # sentence breaks; a chunk ends at the last candidate that fits
+    n = len(offsets) - 1
+    paragraphs = np.searchsorted(offsets, [m.end() for m in _PARAGRAPH_BREAK.finditer(text)])
+    sentences = np.searchsorted(offsets, [m.end() for m in _SENTENCE_BREAK.finditer(text)])
+    spans, start = [], 0
+    while start < n:
+        limit = start + max_tokens
+        if limit >= n:
+            spans.append((int(offsets[start]), int(offsets[n])))
+            break
+        cut = None
+        for candidates in (paragraphs, sentences):
+            i = np.searchsorted(candidates, limit, side="right") - 1
+            if i >= 0 and candidates[i] > start:
+                cut = int(candidates[i])
+                break
+        if cut is None:
+            # No break inside the window: fall back to a plain token window
+            spans.append((int(offsets[start]), int(offsets[limit])))
+            start = max(limit - overlap, start + 1)
         else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = paragraph + "\n\n"
-    
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    # If no chunks were created, return the original text as a single chunk
-    if not chunks:
-        return [text]
-    
-    return chunks
+            spans.append((int(offsets[start]), int(offsets[cut])))
+            start = cut
+    return spans
+
+
+def semantic_chunk_texts(texts: list[str], max_tokens: int = 1000, overlap: int = 50) -> list[list[str]]:
+    """
+    semantic_chunk_text for many texts with a single batched encode.
+    """
+    chunked = []
+    for text, tokens in zip(texts, _encode_batch(texts)):
+        if len(tokens) <= max_tokens:
+            chunked.append([text.strip()] if text.strip() else [])
+            continue
+        offsets = _char_offsets(text, tokens)
+        chunks = (text[start:end].strip() for start, end in _structure_spans(text, offsets, max_tokens, overlap))
+        chunked.append([chunk for chunk in chunks if chunk])
+    return chunked
+
+
+def semantic_chunk_text(text: str, max_tokens: int = 1000, overlap: int = 50) -> list[str]:
+    """
+    Structure-aware packing: whole paragraphs (then sentences) are packed
+    into chunks of at most max_tokens tokens. A single sentence longer than
+    that is split into token windows with overlap. Returns [text] for text
+    with no tokens.
+    """
+    return semantic_chunk_texts([text], max_tokens, overlap)[0] or [text]
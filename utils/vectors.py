@@ -0,0 +1,91 @@
+"""
+Compact storage for matrices of L2-normalized embedding vectors.
+
+VectorMatrix keeps one contiguous array in float32, float16 or int8. int8 is
+symmetric with one float32 scale per row (the row's largest magnitude maps to
+127). Indexing a row or rows returns float32, and matrix @ query scores every
+row, so callers that only read vectors need not know the storage type.
+"""
+from typing import Optional
+
+import numpy as np
+
+DTYPES = ("float32", "float16", "int8")
+
+
+class VectorMatrix:
+    def __init__(self, data: np.ndarray, scales: Optional[np.ndarray] = None):
+        self.data = data
+        self.scales = scales  # int8 only: (n,) float32
+
+    @classmethod
+    def encode(cls, vectors, dtype: str = "float32") -> "VectorMatrix":
+        """
+        Stores vectors (an array, list of rows or VectorMatrix) as dtype. A
+        VectorMatrix already stored as dtype is returned unchanged.
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown vector dtype: {dtype!r}")
+        if isinstance(vectors, VectorMatrix):
+            if vectors.dtype == dtype:
+                return vectors
+            vectors = vectors.to_float32()
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+        if dtype != "int8":
+            return cls(np.ascontiguousarray(vectors, dtype=dtype))
+        peak = np.abs(vectors).max(axis=1) if len(vectors) else np.zeros(0, dtype=np.float32)
+        scales = np.where(peak > 0, peak / 127.0, 1.0).astype(np.float32)
+        data = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return cls(np.ascontiguousarray(data), scales)
+
+    @property
+    def dtype(self) -> str:
+        return self.data.dtype.name
+
+    @property
+    def shape(self) -> tuple:
+        return self.data.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, rows) -> np.ndarray:
+        """
+        Row(s) as float32: an int gives one vector, a list or array of row
+        indices gives a matrix.
+        """
+        rows_data = np.asarray(self.data[rows], dtype=np.float32)
+        if self.scales is not None:
+            scales = self.scales[rows]
+            rows_data = rows_data * (scales[..., None] if np.ndim(scales) else scales)
+        return rows_data
+
+    def __matmul__(self, query) -> np.ndarray:
+        scores = self.data @ np.asarray(query, dtype=np.float32)
+        if self.scales is not None:
+            scores = scores * self.scales
+        return np.asarray(scores, dtype=np.float32)
+
+    def take(self, rows) -> "VectorMatrix":
+        rows = np.asarray(rows, dtype=np.int64)
+        return VectorMatrix(
+            np.ascontiguousarray(self.data[rows]), None if self.scales is None else self.scales[rows].copy()
+        )
+
+    def to_float32(self) -> np.ndarray:
+        return self[np.arange(len(self))] if len(self) else np.zeros(self.shape, dtype=np.float32)
+
+
+def as_float32(vectors) -> np.ndarray:
+    """
+    A float32 array for a VectorMatrix or any array-like of vectors.
+    """
+    if isinstance(vectors, VectorMatrix):
+        return vectors.to_float32()
+    return np.asarray(vectors, dtype=np.float32)